@@ -181,7 +181,67 @@ class ZenPack(schema.ZenPack):
                                                      'label': 'Regex expressions to model services with generic class'},
                             'zWinClusterResourcesMonitoringDisabled': {'type': 'boolean',
                                                                        'description': 'Set to true to disable monitoring for Windows Cluster Resources if their corresponding Windows Service startup type is "Disabled".',
-                                                                       'label': 'Windows Cluster Resource monitoring disabling according to its corresponding Windows Service startup type'}
+                                                                       'label': 'Windows Cluster Resource monitoring disabling according to its corresponding Windows Service startup type'},
+                            'zWinPerfmonSharedSessions': {'type': 'boolean',
+                                                          'default': False,
+                                                          'description': 'Set to true to collect Perfmon counters of all components targeting the same Windows host through shared Get-Counter commands.',
+                                                          'label': 'Perfmon shared sessions'},
+                            'zWinPerfmonWildcardInstances': {'type': 'boolean',
+                                                             'default': False,
+                                                             'description': 'Set to true to request Perfmon counters of many instances of the same object through one wildcard path.',
+                                                             'label': 'Perfmon wildcard instances'},
+                            'zWinPerfmonCompactOutput': {'type': 'boolean',
+                                                         'default': False,
+                                                         'description': 'Set to true to receive Perfmon samples in a compact format instead of Get-Counter Readings text.',
+                                                         'label': 'Perfmon compact output'},
+                            'zWinPerfmonEventHeartbeat': {'type': 'int',
+                                                          'default': 3600,
+                                                          'description': 'Interval in seconds to send unchanged missing and corrupt Perfmon counter events again.',
+                                                          'label': 'Perfmon counter events heartbeat'},
+                            'zWinPerfmonMaxConcurrentStarts': {'type': 'int',
+                                                               'default': 0,
+                                                               'description': 'Max number of Perfmon Get-Counter commands started at the same time by a collector. Set to 0 for no limit.',
+                                                               'label': 'Perfmon max concurrent starts'},
+                            'zWinPerfmonContinuous': {'type': 'boolean',
+                                                      'default': False,
+                                                      'description': 'Set to true to run Perfmon Get-Counter commands continuously instead of restarting them every 10 minutes.',
+                                                      'label': 'Perfmon continuous collection'},
+                            'zWinCustomCommandBatching': {'type': 'boolean',
+                                                          'default': False,
+                                                          'description': 'Set to true to run all PowerShell Custom Command datasources of a device with the same cycle time in one PowerShell invocation.',
+                                                          'label': 'Batch Custom Commands'},
+                            'zWinShellKeepAlive': {'type': 'boolean',
+                                                   'default': False,
+                                                   'description': 'Set to true to run PowerShell scripts of Windows Shell datasources in a PowerShell kept running on the device instead of starting PowerShell for each collection.',
+                                                   'label': 'Keep PowerShell running for Windows Shell datasources'},
+                            'zWinMSSQLUnifiedCollection': {'type': 'boolean',
+                                                           'default': False,
+                                                           'description': 'Set to true to collect all MSSQL datasources of a SQL Server instance with one script sharing a single connection.',
+                                                           'label': 'MSSQL unified collection'},
+                            'zWinMSSQLSetBasedCollection': {'type': 'boolean',
+                                                            'default': False,
+                                                            'description': 'Get status and performance counters of all databases of a SQL Server instance with one T-SQL query instead of SMO enumeration',
+                                                            'label': 'MSSQL Set-Based Collection'},
+                            'zWinDCDiagAsync': {'type': 'boolean',
+                                                'default': False,
+                                                'description': 'Run dcdiag in a process on the device and pick up its output instead of waiting for it in a WinRS command',
+                                                'label': 'DCDiag Asynchronous'},
+                            'zWinEventLogBookmarks': {'type': 'boolean',
+                                                      'default': False,
+                                                      'description': 'Keep the EventRecordID of the last event read of each Windows EventLog datasource on the collector and query only newer events',
+                                                      'label': 'EventLog Bookmarks'},
+                            'zWinEventLogBatching': {'type': 'boolean',
+                                                     'default': False,
+                                                     'description': 'Query all Windows EventLog datasources of a device with the same cycle time in one PowerShell invocation',
+                                                     'label': 'EventLog Batching'},
+                            'zWinEventLogSubscription': {'type': 'boolean',
+                                                         'default': False,
+                                                         'description': 'Stream new events of Windows EventLog datasources from a long running command instead of polling the logs',
+                                                         'label': 'EventLog Subscription'},
+                            'zWinEventLogCoalesceThreshold': {'type': 'int',
+                                                              'default': 0,
+                                                              'description': 'Number of times an event is logged in one Windows EventLog collection before its occurrences are sent as one event. Set to 0 to send all of them.',
+                                                              'label': 'EventLog coalesce threshold'}
                             }
 
     def install(self, app):
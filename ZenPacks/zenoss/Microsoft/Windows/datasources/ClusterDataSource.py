@@ -36,7 +36,7 @@ from ..txcoroutine import coroutine
 from ..txwinrm_utils import ConnectionInfoProperties, createConnectionInfo
 from ..utils import (
     check_for_network_error, pipejoin, cluster_state_value,
-    save, errorMsgCheck, generateClearAuthEvents, get_dsconf,
+    save, errorMsgCheck, generateClearAuthEvents, get_dsconf_index,
     cluster_disk_state_string, cluster_csv_state_to_disk_map)
 from . import send_to_debug
 
@@ -107,6 +107,7 @@ class ClusterDataSourcePlugin(PythonDataSourcePlugin):
     def __init__(self, config=None):
         super(ClusterDataSourcePlugin, self).__init__(config=config)
         self.last_event_ts = {}
+        self.dsconf_index = None
 
     @classmethod
     def config_key(cls, datasource, context):
@@ -224,6 +225,8 @@ class ClusterDataSourcePlugin(PythonDataSourcePlugin):
     def onSuccess(self, results, config):
         log.debug('Cluster collection results: {}'.format(results))
         data = self.new_data()
+        self.dsconf_index = get_dsconf_index(
+            self.dsconf_index, config.datasources, param='contexttitle')
         for result in results.stdout:
             # ignore any empty lines
             if len(result) <= 0:
@@ -242,8 +245,7 @@ class ClusterDataSourcePlugin(PythonDataSourcePlugin):
                     result, config.id))
                 continue
             comp = prepId(comp)
-            dsconf = get_dsconf(
-                config.datasources, str(comp), param='contexttitle')
+            dsconf = self.dsconf_index.get(str(comp))
             if dsconf is None:
                 # component probably not modeled, see ZEN-23142
                 continue
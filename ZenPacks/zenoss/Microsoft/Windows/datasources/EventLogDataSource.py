@@ -11,20 +11,24 @@
 A datasource that uses Powershell comandlet to collect Windows Event Logs
 """
 
+import collections
+import copy
 import logging
 import json
 import re
 from xml.parsers.expat import ExpatError
 import xml.dom.minidom
 from StringIO import StringIO
-from twisted.internet.defer import returnValue
-from zope.component import adapts
+from twisted.internet.defer import returnValue, CancelledError
+from twisted.python.failure import Failure
+from zope.component import adapts, queryUtility
 from zope.interface import implements
 from Products.Zuul.infos import InfoBase
 from Products.Zuul.interfaces import IInfo
 from Products.Zuul.form import schema
 from Products.Zuul.infos import ProxyProperty
 from Products.Zuul.utils import ZuulMessageFactory as _t
+from Products.ZenCollector.interfaces import IEventService
 from Products.ZenEvents import ZenEventClasses
 
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource \
@@ -32,12 +36,13 @@ from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource \
 
 from ..txcoroutine import coroutine
 
-from ..utils import save, errorMsgCheck, generateClearAuthEvents
+from ..utils import save, errorMsgCheck, generateClearAuthEvents, DeviceStateStore
 
 from ..txwinrm_utils import ConnectionInfoProperties, createConnectionInfo
 # Requires that txwinrm_utils is already imported.
-from txwinrm.WinRMClient import SingleCommandClient
+from txwinrm.WinRMClient import SingleCommandClient, LongCommandClient
 from . import send_to_debug
+from .PerfmonDataSource import CMD_LINE_LIMIT
 
 
 log = logging.getLogger("zen.MicrosoftWindows")
@@ -46,6 +51,203 @@ ZENPACKID = 'ZenPacks.zenoss.Microsoft.Windows'
 FILTER_XML = '<QueryList><Query Id="0" Path="{logname}"><Select Path="{logname}">*[System[TimeCreated[timediff(@SystemTime) &lt;= {time}]]]</Select></Query></QueryList>'
 TIME_CREATED = '[timediff(@SystemTime) &lt;= {time}]'
 INSERT_TIME = 'TimeCreated[timediff(@SystemTime) &lt;= {time}] and '
+# Time filter of queries, replaced by a range of EventRecordID when
+# bookmarks are kept on the collector. {latest} is the EventRecordID of
+# the latest event of the log when the query runs.
+TIME_FILTER = re.compile(r'TimeCreated\[timediff\(@SystemTime\) &lt;= \{time\}\]')
+RECORD_FILTER = 'EventRecordID &gt; {bookmark} and EventRecordID &lt;= {{latest}}'
+BOOKMARK_MARKER = '##zenbookmark##'
+# Prefix of the number of events found when more than max_events were.
+COUNT_MARKER = '##zencount##'
+# Lines of an event record, wrapped by PowerShell, after which its json is
+# considered invalid.
+MAX_RECORD_LINES = 100
+# Prefix of the lines delimiting queries of datasources run in a batch.
+EVENTLOG_MARKER = '##zeneventlog##'
+# Seconds between checks for new events of subscriptions on the device.
+SUBSCRIPTION_INTERVAL = 5
+# Max number of subscriptions of a device, each keeping a WinRM shell on
+# it. Datasources subscribed beyond it poll their log.
+MAX_SUBSCRIPTIONS = 5
+
+BatchResult = collections.namedtuple('BatchResult', 'stdout stderr exit_code')
+
+# Fields of events that can be selected on datasources. RecordId is
+# always written.
+EVENT_FIELDS = (
+    'EntryType',
+    'TimeGenerated',
+    'Source',
+    'InstanceId',
+    'Message',
+    'UserName',
+    'MachineName',
+    'EventID',
+)
+
+
+class BookmarkStore(DeviceStateStore):
+
+    """EventRecordID of the last event read for each log and datasource
+    of a device.
+
+    Bookmarks are kept in memory and saved to a json file in the
+    collector's var directory, so that they survive restarts of
+    zenpython. They are written every flush_interval seconds, and when
+    the tasks of the device are cleaned up.
+
+    """
+
+    directory = 'windows_eventlog'
+    description = 'Windows EventLog bookmarks'
+
+    def bookmarks(self, device):
+        return self.load(device)
+
+    def get(self, device, eventlog, datasource):
+        """Return the last EventRecordID read, or -1 if unknown."""
+        bookmarks = self.bookmarks(device).get(eventlog)
+        if not isinstance(bookmarks, dict):
+            return -1
+        return bookmarks.get(datasource, -1)
+
+    def set(self, device, eventlog, datasource, record_id):
+        bookmarks = self.bookmarks(device)
+        if not isinstance(bookmarks.get(eventlog), dict):
+            bookmarks[eventlog] = {}
+        bookmarks[eventlog][datasource] = record_id
+        self.touch(device)
+
+
+BOOKMARKS = BookmarkStore()
+
+# Datasources running a subscription on each device.
+SUBSCRIPTIONS = {}
+
+
+def split_markers(stdout):
+    """Return the EventRecordID and the number of events written by the
+    query, or None, and the other lines of stdout.
+    """
+    values = {BOOKMARK_MARKER: None, COUNT_MARKER: None}
+    lines = []
+    for line in stdout:
+        marker = line.split(' ', 1)[0]
+        if marker in values:
+            try:
+                values[marker] = int(line[len(marker):])
+            except ValueError:
+                pass
+        else:
+            lines.append(line)
+    return values[BOOKMARK_MARKER], values[COUNT_MARKER], lines
+
+
+def iter_records(lines):
+    """Yield the events of the json array written by the query, one record
+    at a time.
+
+    Records are written one per line, but PowerShell may wrap long ones.
+    Undecodable bytes are replaced.
+    """
+    decoder = json.JSONDecoder()
+    buf = u''
+    buf_lines = 0
+    for line in lines:
+        if isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        buf = buf + u'\n' + line if buf else line
+        buf_lines += 1
+        while True:
+            # Separators of the array between records.
+            buf = buf.lstrip(u' \t\r\n[],')
+            if not buf:
+                buf_lines = 0
+                break
+            try:
+                record, end = decoder.raw_decode(buf)
+            except ValueError:
+                if buf_lines >= MAX_RECORD_LINES:
+                    raise ValueError('Invalid event record: {!r}'.format(buf[:200]))
+                break
+            if isinstance(record, list):
+                for evt in record:
+                    yield evt
+            else:
+                yield record
+            buf = buf[end:]
+            buf_lines = 1
+    if buf.strip(u' \t\r\n[],'):
+        raise ValueError('Incomplete event record: {!r}'.format(buf[:200]))
+
+
+def get_max_events(dsconf):
+    """Return the max number of events of a collection, 0 for no limit."""
+    try:
+        return max(int(dsconf.params.get('max_events') or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def get_max_message_length(dsconf):
+    """Return the length Message of events is truncated to, 0 for none."""
+    try:
+        return max(int(dsconf.params.get('max_message_length') or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def get_fields(dsconf):
+    """Return the fields of events to get, or None for all of them."""
+    names = set(n.lower() for n in re.split(r'[\s,]+', dsconf.params.get('fields') or '') if n)
+    fields = tuple(f for f in EVENT_FIELDS if f.lower() in names)
+    if len(fields) < len(names):
+        log.warn('Unknown event fields on datasource %s: %s', dsconf.params.get('eventid'),
+                 ', '.join(sorted(names - set(f.lower() for f in fields))))
+    return fields or None
+
+
+def get_coalesce_threshold(dsconf):
+    """Return the number of repeats of an event coalesced into one, 0 to
+    send them all.
+    """
+    try:
+        return max(int(getattr(dsconf, 'zWinEventLogCoalesceThreshold', 0) or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def coalesce_events(events, threshold):
+    """Return events with those logged at least threshold times with the
+    same source, instance id, severity and summary replaced by one event.
+
+    The event, in place of the first occurrence, has the message and
+    fields of the last one, with the number of occurrences and the times
+    of the first and last ones.
+    """
+    if not threshold:
+        return events
+    key = lambda evt: (evt['component'], evt['ntevid'], evt['severity'], evt['summary'])
+    counts = collections.Counter(key(evt) for evt in events)
+    coalesced = []
+    bursts = {}
+    for evt in events:
+        evt_key = key(evt)
+        if counts[evt_key] < threshold:
+            coalesced.append(evt)
+            continue
+        burst = bursts.get(evt_key)
+        if burst is None:
+            burst = bursts[evt_key] = dict(evt, first_originaltime=evt['originaltime'])
+            coalesced.append(burst)
+        else:
+            burst.update(evt, first_originaltime=burst['first_originaltime'])
+    for burst in bursts.itervalues():
+        burst['occurrences'] = counts[key(burst)]
+        burst['last_originaltime'] = burst['originaltime']
+        burst['message'] = u'{}\n\nLogged {} times from {} to {}.'.format(
+            burst['message'], burst['occurrences'], burst['first_originaltime'], burst['last_originaltime'])
+    return coalesced
 
 
 class EventLogDataSource(PythonDataSource):
@@ -58,6 +260,10 @@ class EventLogDataSource(PythonDataSource):
     eventlog = ''
     query = '*'
     max_age = '24'
+    max_events = '0'
+    fields = ''
+    max_message_length = '0'
+    translate_sid = True
     eventClass = '/Unknown'
 
     plugin_classname = ZENPACKID + \
@@ -67,6 +273,10 @@ class EventLogDataSource(PythonDataSource):
         {'id': 'eventlog', 'type': 'string'},
         {'id': 'query', 'type': 'string'},
         {'id': 'max_age', 'type': 'string'},
+        {'id': 'max_events', 'type': 'string'},
+        {'id': 'fields', 'type': 'string'},
+        {'id': 'max_message_length', 'type': 'string'},
+        {'id': 'translate_sid', 'type': 'boolean'},
     )
 
 
@@ -106,6 +316,22 @@ class IEventLogInfo(IInfo):
         group=_t(u'WindowsEventLog'),
         title=_t('Max age of events to get (hours)'),
     )
+    max_events = schema.TextLine(
+        group=_t(u'WindowsEventLog'),
+        title=_t('Max events to get per collection (0 for no limit)'),
+    )
+    fields = schema.TextLine(
+        group=_t(u'WindowsEventLog'),
+        title=_t('Fields of events to get (comma separated, empty for all)'),
+    )
+    max_message_length = schema.TextLine(
+        group=_t(u'WindowsEventLog'),
+        title=_t('Max length of event messages (0 for no limit)'),
+    )
+    translate_sid = schema.Bool(
+        group=_t(u'WindowsEventLog'),
+        title=_t('Translate user SIDs to account names'),
+    )
 
 
 class EventLogInfo(InfoBase):
@@ -139,6 +365,10 @@ class EventLogInfo(InfoBase):
     cycletime = ProxyProperty('cycletime')
     eventlog = ProxyProperty('eventlog')
     max_age = ProxyProperty('max_age')
+    max_events = ProxyProperty('max_events')
+    fields = ProxyProperty('fields')
+    max_message_length = ProxyProperty('max_message_length')
+    translate_sid = ProxyProperty('translate_sid')
 
     def set_query(self, value):
         if self._object.query != value:
@@ -182,10 +412,28 @@ def string_to_lines(string):
 
 
 class EventLogPlugin(PythonDataSourcePlugin):
-    proxy_attributes = ConnectionInfoProperties
+    proxy_attributes = ConnectionInfoProperties + (
+        'zWinEventLogBookmarks',
+        'zWinEventLogBatching',
+        'zWinEventLogSubscription',
+        'zWinEventLogCoalesceThreshold',
+    )
+
+    subscription = None
+    # Results received by the subscription, when events can not be sent
+    # right away.
+    pending = ()
 
     @classmethod
     def config_key(cls, datasource, context):
+        if getattr(context, 'zWinEventLogBatching', False) and \
+                not getattr(context, 'zWinEventLogSubscription', False):
+            # All datasources of the device with the same cycle time.
+            return (
+                context.device().id,
+                datasource.getCycleTime(context),
+                datasource.plugin_classname,
+            )
         params = cls.params(datasource, context)
         return(
             context.device().id,
@@ -218,6 +466,10 @@ class EventLogPlugin(PythonDataSourcePlugin):
             query=query,
             query_error=query_error,
             max_age=te(datasource.max_age),
+            max_events=te(datasource.max_events),
+            fields=te(datasource.fields),
+            max_message_length=te(datasource.max_message_length),
+            translate_sid=datasource.translate_sid,
             eventid=te(datasource.id),
             use_xml=use_xml,
             eventClass=datasource.eventClass
@@ -238,17 +490,145 @@ class EventLogPlugin(PythonDataSourcePlugin):
 
         query = EventLogQuery(conn_info)
 
-        eventlog = ds0.params['eventlog']
-        select = ds0.params['query']
-        max_age = ds0.params['max_age']
-        eventid = ds0.params['eventid']
-        isxml = ds0.params['use_xml']
+        if getattr(ds0, 'zWinEventLogSubscription', False):
+            results = yield self.collect_subscription(config, query)
+            returnValue(results)
+
+        if getattr(ds0, 'zWinEventLogBatching', False):
+            results = yield self.collect_batch(config, query)
+            returnValue(results)
 
-        results = yield query.run(eventlog, select, max_age, eventid, isxml)
+        results = yield query.run(*self.query_args(config, ds0))
         returnValue(results)
 
+    def query_args(self, config, dsconf):
+        """Return the arguments of EventLogQuery.run for a datasource."""
+        eventlog = dsconf.params['eventlog']
+        eventid = dsconf.params['eventid']
+        bookmark = None
+        if getattr(dsconf, 'zWinEventLogBookmarks', False) or \
+                getattr(dsconf, 'zWinEventLogSubscription', False):
+            bookmark = BOOKMARKS.get(config.id, eventlog, eventid)
+        return (
+            eventlog,
+            dsconf.params['query'],
+            dsconf.params['max_age'],
+            eventid,
+            dsconf.params['use_xml'],
+            bookmark,
+            get_max_events(dsconf),
+            get_fields(dsconf),
+            get_max_message_length(dsconf),
+            dsconf.params.get('translate_sid', True),
+        )
+
+    @coroutine
+    def collect_batch(self, config, query):
+        """Run the queries of all datasources in batches.
+
+        Returns (dsconf, result) pairs, where result is the exception of
+        a datasource with an incorrect query.
+        """
+        results = []
+        dsconfs = []
+        for dsconf in config.datasources:
+            if dsconf.params['query_error']:
+                results.append((dsconf, EventLogException(
+                    'Please verify EventQuery on datasource %s' % dsconf.params['eventid'])))
+            else:
+                dsconfs.append(dsconf)
+        outputs = yield query.run_batch([self.query_args(config, dsconf) for dsconf in dsconfs])
+        results.extend(zip(dsconfs, outputs))
+        returnValue(results)
+
+    @coroutine
+    def collect_subscription(self, config, query):
+        """Start the subscription of the datasource, or return the results
+        it received since the last collection that were not sent yet.
+
+        Until the EventRecordID of the latest event of the log is known,
+        or while the device runs MAX_SUBSCRIPTIONS subscriptions of other
+        datasources, events are polled instead.
+        """
+        ds0 = config.datasources[0]
+        results = [(ds0, result) for result in self.pending]
+        self.pending = []
+        subscription = self.subscription
+        if subscription and subscription.running:
+            returnValue(results)
+        if subscription and subscription.error:
+            # Restarted in the next collection.
+            error, subscription.error = subscription.error, None
+            raise error
+
+        args = self.query_args(config, ds0)
+        bookmark = max(args[5], subscription.bookmark if subscription else -1)
+        subscribed = SUBSCRIPTIONS.setdefault(config.id, set())
+        if bookmark < 0 or (ds0.params['eventid'] not in subscribed and
+                            len(subscribed) >= MAX_SUBSCRIPTIONS):
+            result = yield query.run(*args)
+            returnValue(results + [(ds0, result)])
+
+        subscribed.add(ds0.params['eventid'])
+        script = query.subscribe(*(args[:5] + (bookmark,) + args[6:]))
+        self.subscription = EventLogSubscription(
+            query.conn_info, script, bookmark, lambda result: self.onSubscriptionResult(result, config))
+        yield self.subscription.start()
+        log.debug('%s: Windows EventLog subscription started for %s after EventRecordID %s',
+                  config.id, ds0.params['eventid'], bookmark)
+        returnValue(results)
+
+    def onSubscriptionResult(self, result, config):
+        """Send the events of a result of the subscription right away,
+        or keep it for the next collection.
+        """
+        event_service = queryUtility(IEventService)
+        if event_service is None:
+            self.pending = list(self.pending) + [result]
+            return
+        try:
+            data = self.parse_results(result, config)
+        except Exception:
+            data = self.onError(Failure(), config)
+        for evt in data['events']:
+            event_service.sendEvent(evt)
+
+    def cleanup(self, config):
+        """Write changed bookmarks and stop the subscription."""
+        if config.id in BOOKMARKS.dirty:
+            BOOKMARKS.save(config.id)
+        subscribed = SUBSCRIPTIONS.get(config.id, set())
+        subscribed.discard(config.datasources[0].params.get('eventid'))
+        if not subscribed:
+            SUBSCRIPTIONS.pop(config.id, None)
+        if self.subscription:
+            subscription, self.subscription = self.subscription, None
+            return subscription.stop()
+
     @save
     def onSuccess(self, results, config):
+        if not isinstance(results, list):
+            data = self.parse_results(results, config)
+        else:
+            # Results of batched datasources.
+            data = self.new_data()
+            for dsconf, result in results:
+                ds_config = copy.copy(config)
+                ds_config.datasources = [dsconf]
+                if isinstance(result, Exception):
+                    ds_data = self.onError(Failure(result), ds_config)
+                else:
+                    try:
+                        ds_data = self.parse_results(result, ds_config)
+                    except Exception:
+                        ds_data = self.onError(Failure(), ds_config)
+                data['events'].extend(ds_data['events'])
+
+        generateClearAuthEvents(config, data['events'])
+
+        return data
+
+    def parse_results(self, results, config):
         # Should only ever be 1 datasource
         log.debug('EventLog Results: {}'.format(results))
         ds0 = config.datasources[0]
@@ -265,21 +645,27 @@ class EventLogPlugin(PythonDataSourcePlugin):
                 'SuccessAudit': ZenEventClasses.Info,
                 'FailureAudit': ZenEventClasses.Info,
                 'Critical': ZenEventClasses.Critical,
-            }.get(str(evt['EntryType']).strip(), ZenEventClasses.Info)
+            }.get(str(evt.get('EntryType', '')).strip(), ZenEventClasses.Info)
+            source = evt.get('Source', '')
+            instance_id = evt.get('InstanceId', '')
+            # Message may not be among the fields of the datasource.
+            message = evt.get('Message', '')
+            summary = message.split('.')[0] if 'Message' in evt else \
+                u'{} event {}'.format(source or eventlog, instance_id or evt.get('EventID', ''))
 
             evt = dict(
                 device=config.id,
-                eventClassKey='{}_{}'.format(evt['Source'], evt['InstanceId']),
+                eventClassKey='{}_{}'.format(source, instance_id),
                 eventGroup=ds['eventlog'],
-                component=evt['Source'],
-                ntevid=evt['InstanceId'],
-                summary=evt.get('Message', '').split('.')[0],
-                message=evt.get('Message', ''),
+                component=source,
+                ntevid=instance_id,
+                summary=summary,
+                message=message,
                 severity=severity,
-                user=evt['UserName'],
-                originaltime=evt['TimeGenerated'],
-                computername=evt['MachineName'],
-                eventidentifier=evt['EventID'],
+                user=evt.get('UserName', ''),
+                originaltime=evt.get('TimeGenerated', ''),
+                computername=evt.get('MachineName', ''),
+                eventidentifier=evt.get('EventID', ''),
             )
             # Fixes ZEN-23024
             # only assign event class if other than '/Unknown', otherwise
@@ -290,6 +676,7 @@ class EventLogPlugin(PythonDataSourcePlugin):
             return evt
 
         data = self.new_data()
+        bookmark = None
         try:
             if results.stderr:
                 str_err = '\n'.join(results.stderr)
@@ -297,7 +684,7 @@ class EventLogPlugin(PythonDataSourcePlugin):
                 if str_err.find('No events were found that match the specified selection criteria') != -1:
                     # no events found.  expected error.
                     pass
-                elif (str_err.startswith('Get-WinEvent : The specified channel could not be found.')) \
+                elif 'The specified channel could not be found.' in str_err \
                         or "does not exist" in str_err:
                     err_msg = "Event Log '{}' does not exist in {}".format(eventlog, config.id)
                     raise MissedEventLogException(err_msg)
@@ -318,32 +705,62 @@ class EventLogPlugin(PythonDataSourcePlugin):
                     })
                 else:
                     raise EventLogException(str_err)
-            output = '\n'.join(results.stdout)
+            bookmark, found, stdout = split_markers(results.stdout)
         except AttributeError:
-            output = '[]'
-            pass
+            bookmark, found, stdout = None, None, []
+
+        max_events = get_max_events(ds0)
+        read = 0
+        last_record = None
+        # The oldest events are kept when the bookmark carries the
+        # remainder forward, the newest otherwise.
+        if bookmark is None:
+            events = collections.deque(maxlen=max_events or None)
+        else:
+            events = []
         try:
-            event_results = json.loads(output or '[]')  # ConvertTo-Json for empty list returns nothing
-            if isinstance(event_results, dict):  # ConvertTo-Json for list of one element returns just that element
-                event_results = [event_results]
-        except UnicodeDecodeError:
-            # replace unknown characters with '?'
-            event_results = json.loads(unicode(output.decode("utf-8", "replace")))
-            if isinstance(event_results, dict):  # ConvertTo-Json for list of one element returns just that element
-                event_results = [event_results]
+            for evt in iter_records(stdout):
+                if bookmark is not None and max_events and read >= max_events:
+                    found = max(found or 0, read + 1)
+                    break
+                events.append(_makeEvent(evt))
+                read += 1
+                last_record = evt.get('RecordId')
         except ValueError as e:
-            log.error('%s: Could not parse json: %r\n%s' % (config.id, output, e))
+            log.error('%s: Could not parse json: %s', config.id, e)
             raise
+        events = list(events)
+        collected = len(events)
+        if read > collected:
+            found = max(found or 0, read)
+        coalesced = coalesce_events(events, get_coalesce_threshold(ds0))
+        if len(coalesced) < len(events):
+            log.debug('%s: %s events of %s coalesced into %s', config.id,
+                      len(events), eventlog, len(coalesced))
+        data['events'].extend(coalesced)
 
-        for evt in event_results:
-            data['events'].append(_makeEvent(evt))
-        data['events'].append({
+        collection_event = {
             'device': config.id,
             'summary': 'Windows EventLog: successful event collection',
             'severity': ZenEventClasses.Clear,
             'eventKey': 'WindowsEventCollection: {}'.format(ds0.params.get('eventid', '')),
             'eventClassKey': 'WindowsEventLogCollection',
-        })
+        }
+        if found is not None and found > collected:
+            if bookmark is not None and last_record:
+                # Collect the remaining events in the next cycles.
+                bookmark = int(last_record)
+                remainder = 'deferred to the next collection'
+            else:
+                remainder = 'dropped, the newest {} were collected'.format(collected)
+            collection_event.update(
+                summary='Windows EventLog: {} of {} events of {} {}'.format(
+                    found - collected, found, eventlog, remainder),
+                message='The {} datasource collects at most {} events per collection.'.format(
+                    ds0.params.get('eventid', ''), max_events),
+                severity=ZenEventClasses.Warning)
+            log.warn('%s: %s', config.id, collection_event['summary'])
+        data['events'].append(collection_event)
 
         if 'ps_err_msg' not in locals():
             data['events'].append({
@@ -354,7 +771,8 @@ class EventLogPlugin(PythonDataSourcePlugin):
 	        'eventClassKey': 'WindowsEventLogCollection',
 	})
 
-        generateClearAuthEvents(config, data['events'])
+        if bookmark is not None:
+            BOOKMARKS.set(config.id, eventlog, ds0.params['eventid'], bookmark)
 
         return data
 
@@ -394,6 +812,7 @@ class EventLogPlugin(PythonDataSourcePlugin):
 
 class EventLogQuery(object):
     def __init__(self, conn_info):
+        self.conn_info = conn_info
         self.winrs = SingleCommandClient(conn_info)
 
     PS_COMMAND = "powershell -NoLogo -NonInteractive -NoProfile " \
@@ -406,7 +825,7 @@ class EventLogQuery(object):
             if ($s -eq $null) {{
                 return "";
             }};
-            if ($s.GetType() -eq [System.Security.Principal.SecurityIdentifier]) {{
+            if ($translate -ne $false -and $s.GetType() -eq [System.Security.Principal.SecurityIdentifier]) {{
                 [String]$s = $s.Translate( [System.Security.Principal.NTAccount]);
             }} elseif ($s.GetType() -ne [String]) {{
                 [String]$s = $s;
@@ -416,6 +835,18 @@ class EventLogQuery(object):
             $s = $s.replace("`t", " ");
             return "$($s)".replace('\\','\\\\').trim();
         }};
+        function want($name) {{
+            return $null -eq $fields -or $fields -contains $name;
+        }};
+        function jfield($name, $value) {{
+            return "`"$($name)`": `"$(sstring($value))`"";
+        }};
+        function message($m) {{
+            if ($max_message -gt 0 -and $m.Length -gt $max_message) {{
+                $m = $m.Substring(0, $max_message);
+            }};
+            return $m;
+        }};
         function EventLogToJSON {{
             begin {{
                 $first = $True;
@@ -428,16 +859,17 @@ class EventLogQuery(object):
                 }} else {{
                     $separator = ",";
                 }}
-                $separator + "{{
-                    `"EntryType`": `"$(sstring($_.EntryType))`",
-                    `"TimeGenerated`": `"$(sstring($_.TimeGenerated))`",
-                    `"Source`": `"$(sstring($_.Source))`",
-                    `"InstanceId`": `"$(sstring($_.InstanceId))`",
-                    `"Message`": `"$(sstring($_.Message))`",
-                    `"UserName`": `"$(sstring($_.UserName))`",
-                    `"MachineName`": `"$(sstring($_.MachineName))`",
-                    `"EventID`": `"$(sstring($_.EventID))`"
-                }}"
+                $separator + '{{' + ((@(
+                    $(if (want 'EntryType') {{ jfield 'EntryType' $_.EntryType }}),
+                    $(if (want 'TimeGenerated') {{ jfield 'TimeGenerated' $_.TimeGenerated }}),
+                    $(if (want 'Source') {{ jfield 'Source' $_.Source }}),
+                    $(if (want 'InstanceId') {{ jfield 'InstanceId' $_.InstanceId }}),
+                    $(if (want 'Message') {{ jfield 'Message' (message $_.Message) }}),
+                    $(if (want 'UserName') {{ jfield 'UserName' $_.UserName }}),
+                    $(if (want 'MachineName') {{ jfield 'MachineName' $_.MachineName }}),
+                    $(if (want 'EventID') {{ jfield 'EventID' $_.EventID }}),
+                    (jfield 'RecordId' $_.Index)
+                ) -ne $null) -join ', ') + '}}'
             }}
             end {{
                 ']'
@@ -455,60 +887,150 @@ class EventLogQuery(object):
                 }} else {{
                     $separator = ",";
                 }}
-                $separator + "{{
-                    `"EntryType`": `"$(sstring($_.LevelDisplayName))`",
-                    `"TimeGenerated`": `"$(sstring($_.TimeCreated))`",
-                    `"Source`": `"$(sstring($_.ProviderName))`",
-                    `"InstanceId`": `"$(sstring($_.Id))`",
-                    `"Message`": `"$(if ($_.Message){{$(sstring($_.Message))}}else{{$(sstring($_.FormatDescription()))}})`",
-                    `"UserName`": `"$(sstring($_.UserId))`",
-                    `"MachineName`": `"$(sstring($_.MachineName))`",
-                    `"EventID`": `"$(sstring($_.Id))`"
-                }}"
+                $separator + '{{' + ((@(
+                    $(if (want 'EntryType') {{ jfield 'EntryType' $_.LevelDisplayName }}),
+                    $(if (want 'TimeGenerated') {{ jfield 'TimeGenerated' $_.TimeCreated }}),
+                    $(if (want 'Source') {{ jfield 'Source' $_.ProviderName }}),
+                    $(if (want 'InstanceId') {{ jfield 'InstanceId' $_.Id }}),
+                    $(if (want 'Message') {{ jfield 'Message' (message $(if ($_.Message){{$_.Message}}else{{$_.FormatDescription()}})) }}),
+                    $(if (want 'UserName') {{ jfield 'UserName' $_.UserId }}),
+                    $(if (want 'MachineName') {{ jfield 'MachineName' $_.MachineName }}),
+                    $(if (want 'EventID') {{ jfield 'EventID' $_.Id }}),
+                    (jfield 'RecordId' $_.RecordId)
+                ) -ne $null) -join ', ') + '}}'
             }}
             end {{
                 ']'
             }}
         }};
-        function get_new_recent_entries($logname, $selector, $max_age, $eventid) {{
-            $x=New-Item HKCU:\SOFTWARE\zenoss -ea SilentlyContinue;
-            $x=New-Item HKCU:\SOFTWARE\zenoss\logs -ea SilentlyContinue;
-            $last_read = Get-ItemProperty -Path HKCU:\SOFTWARE\zenoss\logs -Name  $eventid -ea SilentlyContinue;
+        function get_new_recent_entries($logname, $selector, $max_age, $eventid, $bookmark, $query, $max_events, $fields, $max_message, $translate, $reader) {{
             [DateTime]$yesterday = (Get-Date).AddHours(-$max_age);
             [DateTime]$after = $yesterday;
-            if ($last_read) {{
-                $last_read = [DateTime]$last_read.$eventid;
-                if ($last_read -gt $yesterday) {{
-                    $after = $last_read;
+            if ($bookmark -eq $null) {{
+                $x=New-Item HKCU:\SOFTWARE\zenoss -ea SilentlyContinue;
+                $x=New-Item HKCU:\SOFTWARE\zenoss\logs -ea SilentlyContinue;
+                $last_read = Get-ItemProperty -Path HKCU:\SOFTWARE\zenoss\logs -Name  $eventid -ea SilentlyContinue;
+                if ($last_read) {{
+                    $last_read = [DateTime]$last_read.$eventid;
+                    if ($last_read -gt $yesterday) {{
+                        $after = $last_read;
+                    }};
                 }};
             }};
             $win2003 = [environment]::OSVersion.Version.Major -lt 6;
             $dotnets = ($PSVersionTable.CLRVersion.Major + ($PSVersionTable.CLRVersion.Minor/10)) -ge 3.5;
             if ($win2003 -eq $false -and $dotnets -eq $true) {{
-                $query = '{filter_xml}';
-                [Array]$events = Get-WinEvent -FilterXml $query.replace("{{logname}}",$logname).replace("{{time}}", ((Get-Date) - $after).TotalMilliseconds);
+                $latest = 0;
+                if ($bookmark -ne $null) {{
+                    $latest = (Get-WinEvent -LogName $logname -MaxEvents 1 -ea SilentlyContinue).RecordId;
+                    if ($latest -eq $null) {{
+                        return;
+                    }};
+                    '{bookmark_marker} ' + $latest;
+                }};
+                $filter = $query.replace("{{logname}}",$logname).replace("{{time}}", ((Get-Date) - $after).TotalMilliseconds).replace("{{bookmark}}", $bookmark).replace("{{latest}}", $latest);
+                if ($reader) {{
+                    $q = New-Object System.Diagnostics.Eventing.Reader.EventLogQuery($logname, 'LogName', $filter);
+                    $q.ReverseDirection = $true;
+                    $r = New-Object System.Diagnostics.Eventing.Reader.EventLogReader($q);
+                    [Array]$events = @(for ($e = $r.ReadEvent(); $e; $e = $r.ReadEvent()) {{ $e }});
+                }} else {{
+                    [Array]$events = Get-WinEvent -FilterXml $filter;
+                }};
             }} else {{
-                [Array]$events = Get-EventLog -After $after -LogName $logname;
+                if ($bookmark -ne $null) {{
+                    $latest = (Get-EventLog -LogName $logname -Newest 1 -ea SilentlyContinue).Index;
+                    if ($latest -eq $null) {{
+                        return;
+                    }};
+                    '{bookmark_marker} ' + $latest;
+                    [Array]$events = Get-EventLog -After $after -LogName $logname | ? {{ $_.Index -gt $bookmark -and $_.Index -le $latest }};
+                }} else {{
+                    [Array]$events = Get-EventLog -After $after -LogName $logname;
+                }};
+            }};
+            if ($bookmark -eq $null) {{
+                [DateTime]$last_read = get-date;
+                Set-Itemproperty -Path HKCU:\SOFTWARE\zenoss\logs -Name $eventid -Value ([String]$last_read);
             }};
-            [DateTime]$last_read = get-date;
-            Set-Itemproperty -Path HKCU:\SOFTWARE\zenoss\logs -Name $eventid -Value ([String]$last_read);
             if ($events -eq $null) {{
                 return;
             }};
             if($events) {{
                 [Array]::Reverse($events);
             }};
+            $events = @($events | ? $selector);
+            if ($max_events -gt 0 -and $events.Count -gt $max_events) {{
+                '{count_marker} ' + $events.Count;
+                if ($bookmark -ne $null) {{
+                    $events = $events[0..($max_events - 1)];
+                    '{bookmark_marker} ' + @($events[-1].RecordId, $events[-1].Index -ne $null)[0];
+                }} else {{
+                    $events = $events[($events.Count - $max_events)..($events.Count - 1)];
+                }};
+            }};
             if ($win2003 -and $dotnets -eq $null) {{
-                @($events | ? $selector) | EventLogToJSON
+                $events | EventLogToJSON
             }}
             else {{
-                @($events | ? $selector) | EventLogRecordToJSON
+                $events | EventLogRecordToJSON
             }}
         }};
-        get_new_recent_entries -logname "{eventlog}" -selector {selector} -max_age {max_age} -eventid "{eventid}";
     '''
+    PS_CALL = (
+        'get_new_recent_entries -logname "{eventlog}" -selector {selector} -max_age {max_age} '
+        '-eventid "{eventid}" -bookmark {bookmark} -query \'{filter_xml}\' -max_events {max_events} '
+        '-fields {fields} -max_message {max_message} -translate {translate} -reader {reader}'
+    )
+    # Query of a datasource in a batch. Errors are written to stdout after
+    # the events, each line prefixed with ERR.
+    PS_BATCH_CALL = (
+        "'{marker} {index} BEGIN'; try {{ $o = @({call} 2>&1) }} catch {{ $o = @($_) }}; "
+        "$o | ? {{ $_ -isnot [Management.Automation.ErrorRecord] }}; "
+        "$o | ? {{ $_ -is [Management.Automation.ErrorRecord] }} | Out-String -Stream -Width 4096 | "
+        "% {{ '{marker} {index} ERR ' + $_ }}; "
+        "'{marker} {index} END'"
+    )
+
+    # Query run in a loop by subscriptions, each time new events are logged,
+    # as a section of a batch.
+    PS_SUBSCRIBE = (
+        "$bookmark = {bookmark}; while ($true) {{ "
+        "$latest = (Get-WinEvent -LogName \"{eventlog}\" -MaxEvents 1 -ea SilentlyContinue).RecordId; "
+        "if ($latest -gt $bookmark) {{ {section} "
+        "$m = @($o | ? {{ \"$_\".StartsWith('{bookmark_marker} ') }}); "
+        "if ($m) {{ $bookmark = [int64](\"$($m[-1])\".Split(' ')[1]) }} }}; "
+        "Start-Sleep -Seconds {interval} }}"
+    )
+
+    def functions(self):
+        """Return the definitions of the script, escaped for the command line."""
+        ps_script = ' '.join([x.strip() for x in self.PS_SCRIPT.split('\n')]).strip()
+        return ps_script.replace('\n', ' ').replace('"', r'\"').format(
+            bookmark_marker=BOOKMARK_MARKER, count_marker=COUNT_MARKER)
 
-    def run(self, eventlog, selector, max_age, eventid, isxml):
+    def call(self, eventlog, selector, max_age, eventid, isxml, bookmark=None, max_events=0,
+             fields=None, max_message=0, translate=True, loop=False):
+        """Return the query of events not read yet, escaped for the command line.
+
+        bookmark is None to keep the time of the last read in the registry
+        of the device, or else the EventRecordID of the last event read,
+        -1 if unknown. The EventRecordID of the latest event is then
+        written to stdout, prefixed with BOOKMARK_MARKER. When more than
+        max_events events are found, their number is written prefixed with
+        COUNT_MARKER, followed by the oldest max_events with a bookmark, so
+        that the next query carries on from them, or else by the newest.
+
+        Only the fields of events given are written, all if None, with
+        Message truncated to max_message characters unless 0. SIDs of
+        users are not translated to account names unless translate.
+        Without Message nor a PowerShell selector, events are read with
+        an EventLogReader, which, unlike Get-WinEvent, does not format the
+        message of each event.
+
+        With loop, the bookmark is read from the $bookmark variable of the
+        script each time the query runs.
+        """
         if selector.strip() == '*':
             selector = '{$True}'
         else:
@@ -519,19 +1041,197 @@ class EventLogQuery(object):
             selector = '{$True}'
         else:
             filter_xml = FILTER_XML.replace('"', r'\"')
-        ps_script = ' '.join([x.strip() for x in self.PS_SCRIPT.split('\n')])
-        script = "\"& {{{}}}\"".format(
-            ps_script.replace('\n', ' ').replace('"', r'\"').format(
-                eventlog=eventlog or 'System',
-                selector=selector or '{$True}',
-                max_age=max_age or '24',
-                eventid=eventid,
-                filter_xml=filter_xml
-            )
+        if loop:
+            filter_xml = TIME_FILTER.sub(RECORD_FILTER.format(bookmark='{bookmark}'), filter_xml)
+        elif bookmark is not None:
+            if bookmark >= 0:
+                filter_xml = TIME_FILTER.sub(RECORD_FILTER.format(bookmark=bookmark), filter_xml)
+            else:
+                # Events of the last max_age hours up to the latest one.
+                filter_xml = TIME_FILTER.sub(
+                    lambda match: match.group(0) + ' and EventRecordID &lt;= {latest}', filter_xml)
+        return self.PS_CALL.replace('"', r'\"').format(
+            eventlog=eventlog or 'System',
+            selector=selector or '{$True}',
+            max_age=max_age or '24',
+            eventid=eventid,
+            filter_xml=filter_xml,
+            bookmark='$bookmark' if loop else '$null' if bookmark is None else bookmark,
+            max_events=max_events,
+            fields="@('{}')".format("','".join(fields)) if fields else '$null',
+            max_message=max_message,
+            translate='$true' if translate else '$false',
+            reader='$true' if fields and 'Message' not in fields and selector == '{$True}' else '$false',
         )
+
+    def run(self, eventlog, selector, max_age, eventid, isxml, bookmark=None, max_events=0,
+            fields=None, max_message=0, translate=True):
+        """Run the query of events not read yet."""
+        script = "\"& {{{}}}\"".format(
+            self.functions() + ' ' +
+            self.call(eventlog, selector, max_age, eventid, isxml, bookmark, max_events,
+                      fields, max_message, translate) + ';')
         log.debug('sending event script: {}'.format(script))
         return self.winrs.run_command(self.PS_COMMAND, ps_script=script)
 
+    def subscribe(self, eventlog, selector, max_age, eventid, isxml, bookmark, max_events=0,
+                  fields=None, max_message=0, translate=True):
+        """Return the script of a subscription to the events of a log
+        after the bookmark.
+
+        Each SUBSCRIPTION_INTERVAL seconds, new events are queried and
+        written as section 0 of a batch, and the bookmark is moved to
+        the last event written.
+        """
+        section = self.PS_BATCH_CALL.replace('"', r'\"').format(
+            marker=EVENTLOG_MARKER, index=0, call=self.call(
+                eventlog, selector, max_age, eventid, isxml, bookmark, max_events,
+                fields, max_message, translate, loop=True)) + ';'
+        return "\"& {{{}}}\"".format(self.functions() + ' ' + self.PS_SUBSCRIBE.replace('"', r'\"').format(
+            bookmark=bookmark,
+            eventlog=eventlog or 'System',
+            section=section,
+            bookmark_marker=BOOKMARK_MARKER,
+            interval=SUBSCRIPTION_INTERVAL,
+        ))
+
+    def build_batch(self, queries):
+        """Return the number of queries run by the script and the script
+        running them in sections, as many as fit the command line.
+        """
+        functions = self.functions()
+        length = len(self.PS_COMMAND) + len(functions) + 6
+        sections = []
+        for index, query in enumerate(queries):
+            section = self.PS_BATCH_CALL.replace('"', r'\"').format(
+                marker=EVENTLOG_MARKER, index=index, call=self.call(*query)) + ';'
+            length += len(section) + 1
+            if sections and length > CMD_LINE_LIMIT:
+                break
+            sections.append(section)
+        return len(sections), "\"& {{{}}}\"".format(' '.join([functions] + sections))
+
+    @coroutine
+    def run_batch(self, queries):
+        """Run queries, each a tuple of the arguments of run, in as few
+        commands as the command line allows.
+
+        Returns a result for each query.
+        """
+        results = []
+        pending = list(queries)
+        while pending:
+            count, script = self.build_batch(pending)
+            log.debug('sending event script: {}'.format(script))
+            result = yield self.winrs.run_command(self.PS_COMMAND, ps_script=script)
+            sections = split_batch(result)[:count]
+            if not sections:
+                # The script failed before its first query.
+                sections = [result] * count
+            results.extend(sections)
+            pending = pending[len(sections):]
+        returnValue(results)
+
+
+def split_batch(result):
+    """Return a result for each section of the output of a batch."""
+    sections = []
+    current = None
+    for line in result.stdout:
+        if line.startswith(EVENTLOG_MARKER):
+            parts = line[len(EVENTLOG_MARKER):].strip().split(' ', 2)
+            if parts[1:2] == ['BEGIN']:
+                current = BatchResult([], [], 0)
+                sections.append(current)
+            elif parts[1:2] == ['ERR'] and sections:
+                sections[-1].stderr.append(parts[2] if len(parts) > 2 else '')
+            else:
+                current = None
+        elif current is not None:
+            current.stdout.append(line)
+    return sections
+
+
+class EventLogSubscription(object):
+
+    """Long running query of the events of a datasource.
+
+    The script checks the log for new events every SUBSCRIPTION_INTERVAL
+    seconds and writes them right away, so each receive returns as soon
+    as events are logged. callback is called with a result for each
+    section received.
+    """
+
+    def __init__(self, conn_info, script, bookmark, callback):
+        self.command = LongCommandClient(conn_info)
+        self.script = script
+        self.bookmark = bookmark
+        self.callback = callback
+        self.shell_cmd = None
+        self.receiving = None
+        self.error = None
+        self.lines = []
+
+    @property
+    def running(self):
+        return self.shell_cmd is not None
+
+    @coroutine
+    def start(self):
+        self.error = None
+        self.lines = []
+        self.shell_cmd = yield self.command.start(EventLogQuery.PS_COMMAND, ps_script=self.script)
+        self.receive()
+
+    def receive(self):
+        if not self.running:
+            return
+        self.receiving = self.command.receive(self.shell_cmd)
+        self.receiving.addCallbacks(self.onReceive, self.onReceiveFail)
+
+    def onReceive(self, response):
+        if response.stderr:
+            log.debug('Windows EventLog subscription error: %s', '\n'.join(response.stderr))
+        self.lines.extend(response.stdout)
+        ends = [i for i, line in enumerate(self.lines)
+                if line.startswith(EVENTLOG_MARKER) and line.endswith(' END')]
+        if ends:
+            # Sections may be split over receives.
+            sections = split_batch(BatchResult(self.lines[:ends[-1] + 1], [], 0))
+            self.lines = self.lines[ends[-1] + 1:]
+            for section in sections:
+                bookmark = split_markers(section.stdout)[0]
+                if bookmark is not None:
+                    self.bookmark = bookmark
+                self.callback(section)
+        if response.exit_code is not None:
+            log.debug('Windows EventLog subscription exited with %s', response.exit_code)
+            # Delete the shell, the command is restarted in the next collection.
+            return self.stop()
+        self.receive()
+
+    def onReceiveFail(self, failure):
+        if isinstance(failure.value, CancelledError):
+            return
+        if 'OperationTimeout' in str(failure.value):
+            # No events during the operation timeout.
+            self.receive()
+            return
+        log.debug('Windows EventLog subscription receive failure: %s', failure.value)
+        self.error = failure.value
+        return self.stop()
+
+    @coroutine
+    def stop(self):
+        shell_cmd, self.shell_cmd = self.shell_cmd, None
+        if self.receiving and not self.receiving.called:
+            self.receiving.cancel()
+        if shell_cmd:
+            try:
+                yield self.command.stop(shell_cmd)
+            except Exception as e:
+                log.debug('Windows EventLog subscription failed to stop: %s', e)
+
 
 class EventLogException(Exception):
     pass
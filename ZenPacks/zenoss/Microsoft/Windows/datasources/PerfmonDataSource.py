@@ -15,16 +15,21 @@ via WinRS.
 '''
 
 import re
+import sys
+import heapq
 import logging
 import collections
+import itertools
 import time
+import zlib
+from fractions import gcd
 
 from twisted.internet import defer, reactor
 from twisted.internet.error import ConnectError, TimeoutError
 from twisted.web.error import Error
 from twisted.python.failure import Failure
 
-from twisted.internet.task import LoopingCall
+from twisted.internet.task import LoopingCall, deferLater
 
 from zope.component import adapts, queryUtility
 from zope.interface import implements
@@ -43,7 +48,9 @@ from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
 )
 
 from ..txwinrm_utils import ConnectionInfoProperties, createConnectionInfo, modify_connection_info
-from ..utils import append_event_datasource_plugin, errorMsgCheck, generateClearAuthEvents
+from ..utils import (
+    append_event_datasource_plugin, errorMsgCheck, generateClearAuthEvents, DeviceStateStore,
+)
 
 from ..txcoroutine import coroutine
 
@@ -61,11 +68,33 @@ SOURCETYPE = 'Windows Perfmon'
 
 # This should match OperationTimeout in txwinrm's receive.xml.
 OPERATION_TIMEOUT = 60
-# Store corrupt counters for each device in module scope, not to doublecheck
-# them when configuration for the device changes.
-CORRUPT_COUNTERS = collections.defaultdict(list)
+# The max length of the cmd.exe command line.
+CMD_LINE_LIMIT = 8191
+PS_COMMAND = 'powershell -NoLogo -NonInteractive -NoProfile -Command '
+# Corrupt and known good counters are checked again after a day.
+COUNTER_STATE_TTL = 24 * 60 * 60
+# The max number of concurrent probes searching for corrupt counters.
+CORRUPT_SEARCH_PROBES = 4
+# Counters of an object instance, e.g. '\\process(svchost#1)\\% processor time'.
+INSTANCE_COUNTER_RE = re.compile(r'^(?P<object>\\[^\\(]+)\((?P<instance>.+)\)(?P<counter>\\[^\\]+)$')
+# The min number of instances of a counter requested through a wildcard path.
+WILDCARD_MIN_INSTANCES = 2
+# Cached paths of a CounterIndex per requested counter before the cache is
+# cleared, so paths of churning wildcard instances don't accumulate.
+MAX_PATHS_PER_COUNTER = 4
+MIN_MAX_PATHS = 1000
+# Approximate size of a buffered (value, collect_time) sample.
+SAMPLE_SIZE = sys.getsizeof((0.0, 0.0)) + 2 * sys.getsizeof(0.0)
 MAX_NETWORK_FAILURES = 3
 MAX_RETRIES = 3
+# Delay before restarting a failed command, doubled on each failure.
+CHUNK_RETRY_DELAY = 30
+DEFAULT_EVENT_CLASS = '/Status/Winrm'
+DEFAULT_EVENT_HEARTBEAT = 3600
+# Id of the datasource publishing pipeline instrumentation datapoints.
+PIPELINE_DATASOURCE = 'PerfmonPipeline'
+BOM = unicode(codecs.BOM_UTF8, 'utf8')
+READINGS_MARKER = 'Readings : '
 
 
 class PowerShellError(Error):
@@ -124,6 +153,12 @@ class DataPersister(object):
     Designed to be used in module scope to preserve data that comes in
     between the return of a plugin's collect and cleanup calls.
 
+    Only the latest (value, collect_time) sample is kept for each
+    (component, datasource) pair, and at most max_events events are
+    kept for each device, so that memory use stays bounded when data
+    arrives faster than it is collected. Clear events are dropped last. Devices are expired through a
+    heap ordered by the time they were last touched.
+
     """
 
     # Dictionary containing data for all monitored devices.
@@ -135,9 +170,15 @@ class DataPersister(object):
     # Data older than this (in seconds) will be dropped on maintenance.
     max_data_age = 3600
 
+    # The max number of events kept for each device.
+    max_events = 100
+
     def __init__(self):
         self.looping_call = LoopingCall(self.maintenance)
         self.devices = {}
+        # (last touched, device) pairs. Entries are refreshed lazily.
+        self.expiry = []
+        self.dropped_events = 0
 
     def start(self, result=None):
         if result:
@@ -150,43 +191,87 @@ class DataPersister(object):
 
     def maintenance(self):
         LOG.debug("Windows Perfmon performing periodic data maintenance")
-        for device, data in self.devices.items():
-            data_age = time.time() - data['last']
-            if data_age > self.max_data_age:
-                LOG.debug(
-                    "dropping data for %s (%d seconds old)",
-                    device, data_age)
+        LOG.info("Windows Perfmon pipeline summary: %s", ', '.join(
+            '{}={}'.format(key, value) for key, value in sorted(pipeline_summary().iteritems())))
+        expired = time.time() - self.max_data_age
+        while self.expiry and self.expiry[0][0] < expired:
+            last, device = heapq.heappop(self.expiry)
+            data = self.devices.get(device)
+            if data is None or data['expiry'] != last:
+                # Removed or pushed again with a later time.
+                continue
+            if data['last'] > expired:
+                data['expiry'] = data['last']
+                heapq.heappush(self.expiry, (data['last'], device))
+                continue
+            LOG.debug(
+                "dropping data for %s (%d seconds old)",
+                device, time.time() - data['last'])
 
-                self.remove(device)
+            self.remove(device)
 
     def touch(self, device):
-        if device not in self.devices:
+        now = time.time()
+        data = self.devices.get(device)
+        if data is None:
             self.devices[device] = {
-                'last': time.time(),
-                'values': collections.defaultdict(dict),
+                'last': now,
+                'expiry': now,
+                'values': {},
                 'events': [],
                 'maps': [],
             }
+            heapq.heappush(self.expiry, (now, device))
+        else:
+            data['last'] = now
 
     def get(self, device):
-        return self.devices[device].copy()
+        data = self.devices[device]
+        values = collections.defaultdict(dict)
+        for (component, datasource), sample in data['values'].iteritems():
+            values[component][datasource] = sample
+        return {
+            'values': values,
+            'events': data['events'],
+            'maps': data['maps'],
+        }
 
     def get_events(self, device):
         self.touch(device)
         return self.devices[device]['events']
 
+    def count(self, device):
+        """Return the number of samples buffered for the device."""
+        data = self.devices.get(device)
+        if data is None:
+            return 0
+        return len(data['values'])
+
     def remove(self, device):
         if device in self.devices:
             del(self.devices[device])
 
     def add_event(self, device, datasources, event):
         self.touch(device)
-        append_event_datasource_plugin(datasources, self.devices[device]['events'], event)
+        events = self.devices[device]['events']
+        append_event_datasource_plugin(datasources, events, event)
+        if len(events) > self.max_events:
+            # Drop the oldest events other than Clear events first, so
+            # that the problems cleared are not left open.
+            excess = len(events) - self.max_events
+            kept = []
+            for queued in events:
+                if excess and queued.get('severity') != ZenEventClasses.Clear:
+                    excess -= 1
+                else:
+                    kept.append(queued)
+            del kept[:excess]
+            self.dropped_events += len(events) - len(kept)
+            events[:] = kept
 
     def add_value(self, device, component, datasource, value, collect_time):
         self.touch(device)
-        self.devices[device]['values'][component][datasource] = (
-            value, collect_time)
+        self.devices[device]['values'][(component, datasource)] = (value, collect_time)
 
     def pop(self, device):
         if device in self.devices:
@@ -194,12 +279,496 @@ class DataPersister(object):
             self.remove(device)
             return data
 
+    def stats(self):
+        """Return entry counts and approximate memory use in bytes."""
+        samples = events = 0
+        size = sys.getsizeof(self.devices) + sys.getsizeof(self.expiry)
+        for data in self.devices.itervalues():
+            samples += len(data['values'])
+            events += len(data['events'])
+            size += sys.getsizeof(data) + sys.getsizeof(data['values']) + sys.getsizeof(data['events'])
+            size += len(data['values']) * SAMPLE_SIZE
+        return {
+            'devices': len(self.devices),
+            'samples': samples,
+            'events': events,
+            'dropped_events': self.dropped_events,
+            'bytes': size,
+        }
+
 
 # Module-scoped to allow persistence of data across recreation of
 # collector tasks.
 PERSISTER = DataPersister()
 
 
+# Routing record for a counter: the counter itself and a tuple of
+# (component, datasource) pairs its values are stored for.
+CounterRoute = collections.namedtuple('CounterRoute', ['counter', 'targets'])
+
+
+class CounterIndex(object):
+    """Index of requested counters used to route Get-Counter values.
+
+    Routes and event classes are computed once per counter. Lookups are
+    made by the host-qualified path exactly as Get-Counter returns it,
+    e.g. '\\\\host\\web service(site)\\move requests/sec :', so each
+    path is only split once during the life of the index. Paths of
+    counters which are not requested, like instances returned through
+    a wildcard path or counters of other members of a session, are
+    cached as well. The cache is cleared when it outgrows the requested
+    counters, as instances of wildcard paths come and go.
+    """
+
+    def __init__(self, counter_map):
+        self.routes = {}
+        self.event_classes = {}
+        for counter, comp_ds_ec_l in counter_map.iteritems():
+            self.routes[counter] = CounterRoute(counter, tuple(
+                (component, datasource)
+                for component, datasource, _ in comp_ds_ec_l if datasource))
+            self.event_classes[counter] = tuple(
+                event_class or DEFAULT_EVENT_CLASS
+                for _, _, event_class in comp_ds_ec_l)
+        self.all_event_classes = frozenset(
+            event_class
+            for event_classes in self.event_classes.itervalues()
+            for event_class in event_classes)
+        self.paths = {}
+        self.max_paths = max(
+            MAX_PATHS_PER_COUNTER * len(self.routes), MIN_MAX_PATHS)
+
+    def __contains__(self, counter):
+        return counter in self.routes
+
+    def __len__(self):
+        return len(self.routes)
+
+    def get(self, path):
+        """Return the CounterRoute for a Get-Counter path or None."""
+        try:
+            return self.paths[path]
+        except KeyError:
+            pass
+        try:
+            route = self.routes.get(counter_from_path(path))
+        except IndexError:
+            LOG.debug('Windows Perfmon could not parse counter path: %s', path)
+            route = None
+        if len(self.paths) >= self.max_paths:
+            self.paths.clear()
+        self.paths[path] = route
+        return route
+
+    def missing(self, returned):
+        """Return requested counters which are not in returned."""
+        if len(returned) >= len(self.routes):
+            return ()
+        return [counter for counter in self.routes if counter not in returned]
+
+    def group_by_event_class(self, counters):
+        """Return a dict of event class to counters for the supplied counters."""
+        events = {}
+        for counter in counters:
+            for event_class in self.event_classes.get(counter, ()):
+                events.setdefault(event_class, []).append(counter)
+        return events
+
+
+class PerfmonSession(object):
+    """Get-Counter session shared by the plugins targeting one host.
+
+    The owner runs the long running commands for the counters of all
+    members at the greatest common divisor of their cycle times, and
+    routes the values to each member. The version is bumped each time
+    the membership changes so that the owner knows to rebuild its
+    command lines.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.owner = None
+        self.members = {}
+        self.version = 0
+
+    def counters(self):
+        """Return the sorted union of counters requested by all members."""
+        counters = set()
+        for member in self.members.itervalues():
+            counters.update(member.ps_counter_map)
+        return sorted(counters)
+
+    def sample_interval(self):
+        """Return the greatest common divisor of members' cycle times."""
+        return reduce(gcd, (int(member.cycletime) for member in self.members.itervalues()))
+
+
+class PerfmonSessionManager(object):
+
+    """Registry of shared Get-Counter sessions keyed by target host.
+
+    Designed to be used in module scope, like the DataPersister, so that
+    sessions survive recreation of collector tasks.
+
+    """
+
+    def __init__(self):
+        self.sessions = {}
+
+    def join(self, plugin):
+        """Add plugin to the session of its target host and return it."""
+        key = session_key(plugin.config.datasources[0])
+        if key is None:
+            return None
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = PerfmonSession(key)
+        if session.members.get(plugin.unique_id) is not plugin:
+            session.members[plugin.unique_id] = plugin
+            session.version += 1
+        # A new instance for the same unique_id replaces the owner.
+        if session.owner is None or session.owner.unique_id == plugin.unique_id:
+            session.owner = plugin
+        LOG.debug('%s joined Windows Perfmon session for %s with %d member(s)',
+                  plugin.unique_id, key[0], len(session.members))
+        return session
+
+    def leave(self, plugin):
+        """Remove plugin from its session, handing ownership over if needed."""
+        session = plugin.session
+        if session is None:
+            return
+        if session.members.get(plugin.unique_id) is plugin:
+            del session.members[plugin.unique_id]
+            session.version += 1
+        if session.owner is plugin:
+            session.owner = next(session.members.itervalues(), None)
+        if not session.members and self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+        plugin.session = None
+
+
+# Module-scoped to share sessions between collector tasks.
+SESSIONS = PerfmonSessionManager()
+
+
+def session_key(dsconf):
+    """Return the target host key of a datasource config or None."""
+    try:
+        conn_info = modify_connection_info(createConnectionInfo(dsconf), dsconf)
+    except UnauthorizedError:
+        return None
+    if not conn_info:
+        return None
+    return (conn_info.hostname, conn_info.ipaddress, conn_info.username,
+            conn_info.scheme, conn_info.port)
+
+
+class StartScheduler(object):
+
+    """Collector-wide limit of concurrent Get-Counter command starts.
+
+    Each start creates a WinRM shell and possibly authenticates, so
+    starts beyond limit wait in a FIFO queue. A limit of 0 means no
+    limit. Designed to be used in module scope. Each task configures
+    its own limit, and the lowest non-zero limit of the configured
+    tasks applies to the collector.
+
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.limits = {}
+        self.active = 0
+        self.queue = collections.deque()
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, key, limit):
+        """Set the limit of a task, and apply the limits of all tasks."""
+        if limit > 0:
+            self.limits[key] = limit
+        else:
+            self.limits.pop(key, None)
+        self._apply_limits()
+
+    def unconfigure(self, key):
+        """Forget the limit of a task, and apply the limits of the others."""
+        self.limits.pop(key, None)
+        self._apply_limits()
+
+    def _apply_limits(self):
+        """Set the lowest limit, starting queued commands it allows."""
+        self.limit = min(self.limits.itervalues()) if self.limits else 0
+        self._release_queued()
+
+    def jitter(self, key, interval):
+        """Return a delay in [0, interval) seconds, fixed for the key."""
+        if interval <= 0:
+            return 0.0
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % int(interval * 1000) / 1000.0
+
+    def acquire(self):
+        """Return a deferred firing with the time waited for a slot."""
+        if not self.limit or self.active < self.limit:
+            self.active += 1
+            return defer.succeed(0.0)
+        d = defer.Deferred()
+        self.queue.append((time.time(), d))
+        return d
+
+    def release(self):
+        self.active -= 1
+        self._release_queued()
+
+    def _release_queued(self):
+        while self.queue and (not self.limit or self.active < self.limit):
+            queued, d = self.queue.popleft()
+            self.active += 1
+            wait = time.time() - queued
+            self.waited += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            d.callback(wait)
+
+    @coroutine
+    def run(self, func, *args):
+        """Call func(*args) once a slot is free, and return its result."""
+        wait = yield self.acquire()
+        if wait:
+            LOG.debug('Windows Perfmon command start waited %.1f seconds, %d more queued',
+                      wait, len(self.queue))
+        try:
+            result = yield func(*args)
+        finally:
+            self.release()
+        defer.returnValue(result)
+
+    def stats(self):
+        """Return queue depth and wait times in seconds."""
+        return {
+            'active': self.active,
+            'queued': len(self.queue),
+            'waited': self.waited,
+            'average_wait': self.total_wait / self.waited if self.waited else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+# Module-scoped to limit concurrent starts of all collector tasks.
+START_SCHEDULER = StartScheduler()
+
+
+class PipelineStats(object):
+
+    """Instrumentation of the Get-Counter pipeline of a collector task.
+
+    Receive counters are totals since the last call of values(), which
+    returns them as datapoint values of the PerfmonPipeline datasource.
+
+    """
+
+    def __init__(self):
+        self.restarts = collections.deque()
+        self.reset()
+
+    def reset(self):
+        self.receives = 0
+        self.receive_time = 0.0
+        self.lines = 0
+        self.bytes = 0
+        self.lag = None
+        self.corrupt_searches = 0
+        self.corrupt_probes = 0
+
+    def record_receive(self, seconds, stdout_lists):
+        self.receives += 1
+        self.receive_time += seconds
+        for stdout in stdout_lists:
+            self.lines += len(stdout)
+            self.bytes += sum(len(line) for line in stdout)
+
+    def record_restart(self):
+        now = time.time()
+        self.restarts.append(now)
+        while self.restarts[0] < now - 3600:
+            self.restarts.popleft()
+
+    def record_search(self, probes):
+        self.corrupt_searches += 1
+        self.corrupt_probes += probes
+
+    def values(self, shells, buffered):
+        """Return datapoint values and reset receive counters."""
+        while self.restarts and self.restarts[0] < time.time() - 3600:
+            self.restarts.popleft()
+        scheduler = START_SCHEDULER.stats()
+        values = {
+            'receives': self.receives,
+            'receiveTime': self.receive_time / self.receives * 1000 if self.receives else 0.0,
+            'receiveLines': self.lines,
+            'receiveBytes': self.bytes,
+            'activeShells': shells,
+            'restartsPerHour': len(self.restarts),
+            'corruptSearches': self.corrupt_searches,
+            'corruptProbes': self.corrupt_probes,
+            'bufferedSamples': buffered,
+            'startQueueDepth': scheduler['queued'],
+            'startWait': scheduler['average_wait'],
+        }
+        if self.lag is not None:
+            values['sampleLag'] = self.lag
+        self.reset()
+        return values
+
+
+# Pipeline instrumentation of all collector tasks by unique_id.
+PIPELINES = {}
+
+
+def pipeline_summary():
+    """Return collector-wide totals of the Perfmon pipelines."""
+    summary = {
+        'tasks': len(PIPELINES),
+        'receives': sum(stats.receives for stats in PIPELINES.itervalues()),
+        'receiveBytes': sum(stats.bytes for stats in PIPELINES.itervalues()),
+        'restartsPerHour': sum(len(stats.restarts) for stats in PIPELINES.itervalues()),
+        'corruptSearches': sum(stats.corrupt_searches for stats in PIPELINES.itervalues()),
+    }
+    summary.update(('persister_' + key, value) for key, value in PERSISTER.stats().iteritems())
+    summary.update(('start_' + key, value) for key, value in START_SCHEDULER.stats().iteritems())
+    return summary
+
+
+class CounterStateStore(DeviceStateStore):
+
+    """Corrupt and known good counters of each device with expiration.
+
+    The state of each device is kept in memory and saved to a json file
+    in the collector's var directory, so that it survives restarts of
+    zenpython. Counters expire after ttl seconds to be checked again.
+
+    """
+
+    directory = 'windows_perfmon'
+    description = 'Windows Perfmon counter state'
+
+    def __init__(self, path=None, ttl=COUNTER_STATE_TTL):
+        super(CounterStateStore, self).__init__(path)
+        self.ttl = ttl
+
+    def parse(self, saved):
+        state = {'corrupt': {}, 'good': {}}
+        for kind in state:
+            if isinstance(saved.get(kind), dict):
+                state[kind].update(saved[kind])
+        return state
+
+    def get(self, device):
+        """Return {'corrupt': {counter: time}, 'good': {...}} for device."""
+        state = self.load(device)
+        expired = time.time() - self.ttl
+        for counters in state.itervalues():
+            for counter, added in counters.items():
+                if added < expired:
+                    del counters[counter]
+        return state
+
+    def corrupt(self, device):
+        return sorted(self.get(device)['corrupt'])
+
+    def good(self, device):
+        return set(self.get(device)['good'])
+
+    def add(self, device, kind, counters):
+        state = self.get(device)
+        now = time.time()
+        for counter in counters:
+            state[kind][counter] = now
+            if kind == 'corrupt':
+                state['good'].pop(counter, None)
+
+    def discard_good(self, device, counters):
+        state = self.get(device)
+        for counter in counters:
+            state['good'].pop(counter, None)
+
+
+# Module-scoped to keep corrupt counters of each device across recreation
+# of collector tasks, not to doublecheck them when configuration for the
+# device changes.
+COUNTER_STATE = CounterStateStore()
+
+
+class CorruptCounterSearch(object):
+
+    """Adaptive group testing for counters which make Get-Counter fail.
+
+    Disjoint groups of counters are probed concurrently. Good groups are
+    recorded as such, bad groups are split for the next round so that
+    each round keeps all probes busy. probe(counters) should return a
+    deferred firing True for a good group, False for a bad one and None
+    if the result is inconclusive.
+
+    """
+
+    def __init__(self, probe, store, device, parallel=CORRUPT_SEARCH_PROBES):
+        self.probe = probe
+        self.store = store
+        self.device = device
+        self.parallel = max(parallel, 1)
+        self.probes = 0
+
+    @coroutine
+    def search(self, counters):
+        """Return the corrupt counters among the given ones."""
+        corrupt = []
+        groups = split(counters, min(len(counters), self.parallel))
+        while groups:
+            results = yield defer.DeferredList(
+                [self._probe(group) for group in groups], consumeErrors=True)
+            bad_groups = []
+            for group, (success, good) in zip(groups, results):
+                if not success or good is None:
+                    LOG.debug('%s: Windows Perfmon inconclusive check of %d counter(s)',
+                              self.device, len(group))
+                elif good:
+                    self.store.add(self.device, 'good', group)
+                elif len(group) == 1:
+                    corrupt.extend(group)
+                    self.store.add(self.device, 'corrupt', group)
+                else:
+                    bad_groups.append(group)
+            self.store.save(self.device)
+
+            # Split bad groups to keep all probes busy in the next round.
+            parts = max(2, self.parallel // max(len(bad_groups), 1))
+            groups = []
+            for group in bad_groups:
+                groups.extend(split(group, min(len(group), parts)))
+
+        defer.returnValue(corrupt)
+
+    def _probe(self, group):
+        self.probes += 1
+        return self.probe(group)
+
+
+def split(lst, n):
+    """Split the list into n contiguous parts of nearly equal length."""
+    size, extra = divmod(len(lst), n) if n else (0, 0)
+    parts = []
+    start = 0
+    for i in xrange(n):
+        end = start + size + (1 if i < extra else 0)
+        parts.append(lst[start:end])
+        start = end
+    return parts
+
+
 class ComplexLongRunningCommand(object):
     """A complex command containing one or more long running commands,
     according to the number of commands supplied.
@@ -210,9 +779,13 @@ class ComplexLongRunningCommand(object):
         self.unique_id = unique_id
         self.num_commands = num_commands
         self.commands = self._create_commands(num_commands)
-        self.ps_command = 'powershell -NoLogo -NonInteractive -NoProfile -Command '
+        self.ps_command = PS_COMMAND
         self._shells = {}
 
+    def shell_count(self):
+        """Return the number of started commands."""
+        return len(self._shells)
+
     def get_id(self, cmd):
         try:
             return self._shells[cmd]
@@ -294,12 +867,31 @@ class ComplexLongRunningCommand(object):
             LOG.debug('{}: Starting Perfmon collection script: {}'.format(
                 self.dsconf.device, command_line))
             if command is not None:
-                deferreds.append(add_timeout(command.start(self.ps_command,
-                                                           ps_script=command_line),
-                                             self.dsconf.zWinRMLongRunningCommandOperationTimeout))
+                deferreds.append(START_SCHEDULER.run(self._start_command, command, command_line))
 
         return defer.DeferredList(deferreds, consumeErrors=True)
 
+    def _start_command(self, command, command_line):
+        return add_timeout(command.start(self.ps_command, ps_script=command_line),
+                           self.dsconf.zWinRMLongRunningCommandOperationTimeout)
+
+    @coroutine
+    def start_command(self, command, command_line):
+        """Start a single command, e.g. after its shell failed."""
+        shell_cmd = yield START_SCHEDULER.run(self._start_command, command, command_line)
+        self._shells[command] = shell_cmd
+        defer.returnValue(shell_cmd)
+
+    @coroutine
+    def stop_command(self, command):
+        """Stop a single command, ignoring errors of a failed shell."""
+        shell_cmd = self._shells.pop(command, None)
+        if shell_cmd:
+            try:
+                yield command.stop(shell_cmd)
+            except Exception as e:
+                LOG.debug('Windows Perfmon failed to stop command for %s: %s', self.unique_id, e)
+
     @coroutine
     def stop(self):
         """Stop all started commands."""
@@ -314,7 +906,13 @@ class ComplexLongRunningCommand(object):
 class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
     proxy_attributes = ConnectionInfoProperties + (
         'cluster_node_server',
-        'replica_perfdata_node'
+        'replica_perfdata_node',
+        'zWinPerfmonSharedSessions',
+        'zWinPerfmonWildcardInstances',
+        'zWinPerfmonCompactOutput',
+        'zWinPerfmonEventHeartbeat',
+        'zWinPerfmonMaxConcurrentStarts',
+        'zWinPerfmonContinuous',
     )
 
     config = None
@@ -324,10 +922,24 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
     data_deferred = None
     command = None
     sample_interval = None
-    sample_buffer = collections.deque([])
     max_samples = None
     collected_samples = None
     counter_map = None
+    counter_index = None
+    session = None
+    _session_version = None
+    _started = False
+    _delayed_start = None
+    continuous = False
+    checkpoint = None
+    receiving = ()
+    receive_started = 0
+    pipeline = PipelineStats()
+    pipeline_datasource = None
+    # Incremented each time all commands are started.
+    generation = 0
+    # Counters of each command line, kept when command lines are rebuilt.
+    counter_groups = ()
 
     ps_lang_mod_msg = "Received \"Cannot create type. Only core types are supported"\
                       " in ConstrainedLanguage mode.\" Ensure that PowerShell is running in FullLanguage mode "
@@ -342,12 +954,32 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
         '$FormatEnumerationLimit = -1; '
         '$Host.UI.RawUI.BufferSize = New-Object Management.Automation.Host.Size (4096, 1024); '
         'get-counter -ea silentlycontinue '
-        '-SampleInterval {SampleInterval} -MaxSamples {MaxSamples} '
+        '-SampleInterval {SampleInterval} {Samples} '
         '-counter @({Counters}) '
         '| Format-List -Property Readings;'
         ' }}"'
     )
 
+    # Each sample is written as one line of the command number, the
+    # timestamp and space separated index:CookedValue pairs. A counter
+    # path is written once on a '#<command> <index> <path>' line before
+    # its index is first used.
+    compact_command_line = (
+        '"& {{'
+        '[System.Console]::OutputEncoding = New-Object System.Text.UTF8Encoding($False); '
+        '$p = @{{}}; $c = [Globalization.CultureInfo]::InvariantCulture; '
+        'get-counter -ea silentlycontinue '
+        '-SampleInterval {SampleInterval} {Samples} '
+        '-counter @({Counters}) '
+        '| % {{ $l = New-Object \'System.Collections.Generic.List[string]\'; '
+        '$l.Add(\'{Command} \' + [int64]($_.Timestamp.ToUniversalTime() - [datetime]\'1970-01-01\').TotalSeconds); '
+        'foreach ($s in $_.CounterSamples) {{ $i = $p[$s.Path]; '
+        'if ($i -eq $null) {{ $i = $p.Count; $p[$s.Path] = $i; \'#{Command} \' + $i + \' \' + $s.Path }}; '
+        '$l.Add([string]$i + \':\' + $s.CookedValue.ToString(\'R\', $c)) }}; '
+        '$l -join \' \' }};'
+        ' }}"'
+    )
+
     def __init__(self, config):
         self.config = config
         self.cycletime = config.datasources[0].cycletime
@@ -364,9 +996,33 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
             self.max_samples = 1
 
         self._start_counter = 0
+
+        # Run Get-Counter until it fails instead of restarting it after
+        # max_samples.
+        self.continuous = self.cycling and getattr(config.datasources[0], 'zWinPerfmonContinuous', False)
+        self.checkpoint = None
+
+        # Missing and corrupt counters events are only sent on change
+        # and every zWinPerfmonEventHeartbeat seconds.
+        self.counter_events = {}
+        # Failures in a row, restarts in progress and failed restarts of
+        # single commands.
+        self.chunk_failures = {}
+        self.restarting_chunks = set()
+        self.failed_chunks = set()
+        self.event_heartbeat = getattr(
+            config.datasources[0], 'zWinPerfmonEventHeartbeat', DEFAULT_EVENT_HEARTBEAT)
+
+        # Use compact Get-Counter output instead of Readings text.
+        self.compact_readings = None
+        if getattr(config.datasources[0], 'zWinPerfmonCompactOutput', False):
+            self.command_line = self.compact_command_line
+            self.compact_readings = CompactReadings()
+
         # Get counters from all components in the device.
         self.counter_map = {}
         self.ps_counter_map = {}
+        self.pipeline_datasource = None
         for dsconf in self.config.datasources:
             counter = dsconf.params.get('counter', '').decode('utf-8').lower()
             if counter:
@@ -375,12 +1031,17 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
                     self.ps_counter_map[counter] = []
                 self.counter_map[counter].append((dsconf.component, dsconf.datasource, dsconf.eventClass))
                 self.ps_counter_map[counter].append((dsconf.component, dsconf.datasource))
+            elif dsconf.datasource == PIPELINE_DATASOURCE:
+                self.pipeline_datasource = dsconf
             else:
                 LOG.warn("Error during extraction counter from a datasource - {} for the component - {}. "
                          "Check counter configuration on the device - {}.".format(dsconf.datasource, dsconf.component,
                                                                                   self.config.id))
-
-        self._build_commandlines()
+        # Leave out counters found corrupt before, not to fail the first start.
+        for counter in COUNTER_STATE.corrupt(self.config.id):
+            self.ps_counter_map.pop(counter, None)
+        self.counter_index = CounterIndex(self.counter_map)
+        self.collected_counters = set()
 
         self.unique_id = '_'.join(
             (self.config.id,
@@ -389,6 +1050,20 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
              str(getattr(self.config.datasources[0], 'replica_perfdata_node', ''))
              )
         )
+
+        self.pipeline = PIPELINES.setdefault(self.unique_id, PipelineStats())
+
+        # The limit of concurrent starts applies to the whole collector,
+        # so the lowest limit of all tasks is used.
+        START_SCHEDULER.configure(
+            self, getattr(self.config.datasources[0], 'zWinPerfmonMaxConcurrentStarts', 0) or 0)
+
+        # Share a single Get-Counter session with other plugins
+        # targeting the same host.
+        if self.cycling and getattr(self.config.datasources[0], 'zWinPerfmonSharedSessions', False):
+            self.session = SESSIONS.join(self)
+
+        self._build_commandlines()
         self._shells = []
         self.reset()
 
@@ -404,32 +1079,59 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
 
     def _build_commandlines(self):
         """Return a list of command lines needed to get data for all counters."""
-        # The max length of the cmd.exe command is 8192.
-        # The length of the powershell command line is ~ 420 chars.
-        # Thus the line containing counters should not go beyond 7700 limit.
-        counters_limit = 7700
-
-        counters = sorted(self.ps_counter_map.keys())
+        if self.session:
+            counters = self.session.counters()
+            self.sample_interval = self.session.sample_interval()
+            self.max_samples = max(600 / self.sample_interval, 1)
+            self._session_version = self.session.version
+        else:
+            counters = sorted(self.ps_counter_map.keys())
         if not counters:
             self.num_commands = 0
+            self.commandlines = []
             return
 
-        # The number of long running commands needed to get data for all
-        # counters of the device equals to floor division of the current
-        # counters_line length by the calculated limit, incremented by 1.
-        self.num_commands = len(format_counters(counters)) // counters_limit + 1
+        # Request all instances of an object through one wildcard path.
+        if getattr(self.config.datasources[0], 'zWinPerfmonWildcardInstances', False):
+            counters = wildcard_counters(counters)
+
+        # The line containing counters should not go beyond the cmd.exe
+        # limit minus the length of the powershell command line.
+        counters_limit = CMD_LINE_LIMIT - len(PS_COMMAND) - len(self.command_line.format(
+            SampleInterval=self.sample_interval,
+            Samples=self.samples_argument(),
+            Counters='',
+            Command=len(counters)))
+
+        # Keep the previous assignment of counters to command lines,
+        # so that unchanged command lines stay the same.
+        self.counter_groups = pack_counters(counters, counters_limit, self.counter_groups)
+
+        self.num_commands = len(self.counter_groups)
         LOG.debug('{}: Windows Perfmon Creating {} long running command(s)'.format(
             self.config.id,
             self.num_commands))
 
-        # Chunk a counter list into num_commands equal parts.
-        counters = chunkify(counters, self.num_commands)
-
         self.commandlines = [self.command_line.format(
             SampleInterval=self.sample_interval,
-            MaxSamples=self.max_samples,
-            Counters=format_counters(counter_group)
-        ) for counter_group in counters]
+            Samples=self.samples_argument(),
+            Counters=format_counters(counter_group),
+            Command=command
+        ) for command, counter_group in enumerate(self.counter_groups)]
+
+    def samples_argument(self):
+        """Return the Get-Counter argument defining the number of samples."""
+        if self.continuous:
+            return '-Continuous'
+        return '-MaxSamples {}'.format(self.max_samples)
+
+    def stalled(self):
+        """Return True if continuous commands stopped returning samples."""
+        if not self.continuous or self.state != PluginStates.STARTED or self.checkpoint is None:
+            return False
+        timeout = 2 * max(self.sample_interval, OPERATION_TIMEOUT) + \
+            self.config.datasources[0].zWinRMLongRunningCommandOperationTimeout
+        return time.time() - self.checkpoint > timeout
 
     @classmethod
     def config_key(cls, datasource, context):
@@ -477,6 +1179,23 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
         LOG.debug('Running collect method for id %s and commandline %s', self.unique_id, self.commandlines)
 
         self.check_for_update(config)
+
+        if self.session and self.session.owner is not self:
+            # Values are routed here by the owner of the shared session.
+            LOG.debug('Windows Perfmon data for id %s is collected by %s',
+                      self.unique_id, self.session.owner.unique_id)
+            defer.returnValue(PERSISTER.pop(self.unique_id))
+
+        if self.session and self._session_version != self.session.version:
+            LOG.debug('Windows Perfmon session members changed for id %s', self.unique_id)
+            commandlines = self.commandlines
+            self._build_commandlines()
+            yield self.restart_changed_chunks(commandlines)
+
+        if self.state == PluginStates.STARTED:
+            for index in sorted(self.failed_chunks):
+                self.retry_chunk(index)
+
         self._start_counter += 1
 
         if self.num_commands == 0:
@@ -496,11 +1215,24 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
 
         # double check to make sure we aren't continuing to try
         # and receive from a finished collection
-        if self._start_counter > self.max_samples:
+        if self.continuous:
+            if self.stalled():
+                LOG.debug('Windows Perfmon restarting stalled Get-Counter for id %s', self.unique_id)
+                yield self.stop()
+        elif self._start_counter > self.max_samples:
             yield self.stop()
         yield self.start()
 
         data = yield self.get_data()
+
+        # Publish pipeline instrumentation if the PerfmonPipeline
+        # template is bound to the device.
+        if self.pipeline_datasource:
+            if data is None:
+                data = self.new_data()
+            data['values'][self.pipeline_datasource.component].update(self.pipeline.values(
+                self.complex_command.shell_count(), PERSISTER.count(self.unique_id)))
+
         try:
             evt_summaries = [x.get('summary', '') for x in data['events']]
         except Exception:
@@ -535,8 +1267,23 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
         if self.state != PluginStates.STOPPED:
             defer.returnValue(None)
 
+        # Spread the first starts of all tasks over the sample interval,
+        # without holding up collect.
+        if self._delayed_start and self._delayed_start.active():
+            defer.returnValue(None)
+        if self.cycling and not self._started:
+            self._started = True
+            delay = START_SCHEDULER.jitter(self.unique_id, self.sample_interval)
+            LOG.debug('Windows Perfmon delaying first start for id %s by %.1f seconds', self.unique_id, delay)
+            self._delayed_start = reactor.callLater(delay, self.start)
+            defer.returnValue(None)
+        self._started = True
+
         self._start_counter = 0
         shells = []
+        # Counter paths are written again by new commands.
+        if self.compact_readings:
+            self.compact_readings.reset()
 
         LOG.debug("Windows Perfmon starting Get-Counter (PluginStates %s) on %s with id %s and commandline %s",
                   self.state, self.config.id, self.unique_id, self.commandlines)
@@ -597,6 +1344,12 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
                 'ipAddress': self.config.manageIp})
         self.collected_samples = 0
         self.collected_counters = set()
+        self.checkpoint = time.time()
+        self.chunk_failures = {}
+        self.failed_chunks = set()
+        if self.generation:
+            self.pipeline.record_restart()
+        self.generation += 1
         self.complex_command.store_ids(shells)
 
         self.receive()
@@ -710,12 +1463,16 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
         if self.state != PluginStates.STARTED:
             return
         deferreds = []
-        for cmd in self.complex_command.commands:
+        # Indexes of the commands received from, in order of deferreds.
+        self.receiving = []
+        self.receive_started = time.time()
+        for index, cmd in enumerate(self.complex_command.commands):
             if cmd is not None:
                 try:
                     shell_cmd = self.complex_command.get_id(cmd)
                     if shell_cmd:
                         deferreds.append(cmd.receive(shell_cmd))
+                        self.receiving.append(index)
                 except Exception as err:
                     LOG.error('{}: Windows Perfmon receive error {}'.format(
                         self.config.id, err))
@@ -730,12 +1487,13 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
     def _parse_deferred_result(self, result):
         """Parse out results from deferred response.
 
-        Group all stdout data and failures from each command result
-        and return them as a tuple of two lists: (filures, results)
+        Group stdout data and failures from each command result and
+        return them as a tuple of two lists: (failures, results), where
+        results holds the non-empty stdout line list of each command.
         """
         failures, results = [], []
 
-        for index, command_result in enumerate(result):
+        for command_result in result:
             # The DeferredList result is of type:
             # [(True/False, [stdout, stderr]/failure), ]
             success, data = command_result
@@ -767,12 +1525,8 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
                             'summary': self.ps_lang_mod_msg,
                             'ipAddress': self.config.manageIp})
 
-                # Leave sample start marker in first command result
-                # to properly report missing counters.
-                if index == 0:
-                    results.extend(stdout)
-                else:
-                    results.extend(format_stdout(stdout)[0])
+                if stdout:
+                    results.append(stdout)
             else:
                 failures.append(data)
 
@@ -781,66 +1535,67 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
     @coroutine
     def onReceive(self, result):
         """Group the result of all commands into a single result."""
+        result = self.restart_failed_chunks(result)
         failures, results = self._parse_deferred_result(result)
+        self.pipeline.record_receive(time.time() - self.receive_started, results)
 
         LOG.debug("Get-Counter results for id %s: %s %s", self.unique_id, self.config.id, result)
         collect_time = int(time.time())
 
-        # Initialize sample buffer. Start of a new sample.
-        stdout_lines, sample_start = format_stdout(results)
-
-        if stdout_lines:
+        if results:
             LOG.debug("Windows Perfmon received Get-Counter data for %s", self.config.id)
-            # Data persister will take care of data order.
-            self.sample_buffer = collections.deque(stdout_lines)
-
-            if sample_start:
+            self.checkpoint = time.time()
+            # Only the first command's output is checked for the sample
+            # start marker to properly report missing counters.
+            if not self.compact_readings and is_sample_start(results[0]):
                 self.collected_samples += 1
 
-        # Continue while we have counter/value pairs.
-        while len(self.sample_buffer) > 1:
-            # Make sure no exceptions happen here. Otherwise all data
-            # collection would go down.
-            try:
-                # Buffer to counter conversion:
-                #   '\\\\amazona-q2r281f\\web service(another web site)\\move requests/sec :'
-                #   '\\\\amazona-q2r281f\\web service(another web site)\\move requests/sec'
-                #   '\\web service(another web site)\\move requests/sec'
-                counter = '\\{}'.format(
-                    self.sample_buffer.popleft().strip(' :').split('\\', 3)[3]).decode('utf-8')
-
-                value = self.sample_buffer.popleft()
-
-                # ZEN-12024: Some locales use ',' as the decimal point.
-                if ',' in value:
-                    value = value.replace(',', '.', 1)
-
-                comp_ds_ec_l = self.counter_map.get(counter, [])
-                for component, datasource, event_class in comp_ds_ec_l:
-                    if datasource:
-                        self.collected_counters.add(counter)
-
-                        # We special-case the sysUpTime datapoint to convert
-                        # from seconds to centi-seconds. Due to its origin in
-                        # SNMP monitor Zenoss expects uptime in centi-seconds
-                        # in many places.
-                        if datasource == 'sysUpTime' and value is not None:
-                            value = float(value) * 100
-
-                        PERSISTER.add_value(
-                            self.unique_id, component, datasource, value, collect_time)
-            except Exception, err:
-                LOG.debug('{}: Windows Perfmon could not process a sample. Error: {}'.format(self.config.id, err))
+        # Each command's output is parsed in a single pass, pairs are
+        # handed over to the data persister as they are read.
+        members = self.session_members()
+        decode = self.compact_readings.decode if self.compact_readings else iter_readings
+        for stdout in results:
+            for path, value in decode(stdout):
+                for member in members:
+                    # Make sure no exceptions happen here. Otherwise all data
+                    # collection would go down.
+                    try:
+                        route = member.counter_index.get(path)
+                        if route is None:
+                            continue
+                        member.collected_counters.add(route.counter)
+                        for component, datasource in route.targets:
+                            # We special-case the sysUpTime datapoint to convert
+                            # from seconds to centi-seconds. Due to its origin in
+                            # SNMP monitor Zenoss expects uptime in centi-seconds
+                            # in many places.
+                            if datasource == 'sysUpTime' and value is not None:
+                                dp_value = float(value) * 100
+                            else:
+                                dp_value = value
+
+                            PERSISTER.add_value(
+                                member.unique_id, component, datasource, dp_value, collect_time)
+                    except Exception, err:
+                        LOG.debug('{}: Windows Perfmon could not process a sample. Error: {}'.format(
+                            member.config.id, err))
+
+        if self.compact_readings:
+            self.collected_samples += self.compact_readings.samples
+            self.compact_readings.samples = 0
+            if self.compact_readings.timestamp:
+                self.pipeline.lag = collect_time - self.compact_readings.timestamp
 
         if self.data_deferred and not self.data_deferred.called:
             self.data_deferred.callback(None)
 
-        # Report missing counters every sample interval.
-        if self.collected_counters and self.collected_samples >= 0:
-            self.reportMissingCounters(
-                self.counter_map, self.collected_counters)
-            # Reinitialize collected counters for reporting.
-            self.collected_counters = set()
+        # Report missing counters every sample interval, unless some of
+        # them are not collected while their command restarts.
+        for member in members:
+            if member.collected_counters and self.collected_samples >= 0 and not self.restarting_chunks:
+                member.reportMissingCounters(member.collected_counters)
+                # Reinitialize collected counters for reporting.
+                member.collected_counters = set()
 
         # Log error message and wait for the data.
         if failures and not results:
@@ -849,7 +1604,7 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
             yield self.onReceiveFail(failures[0])
 
         # Continue to receive if MaxSamples value has not been reached yet.
-        elif self.collected_samples < self.max_samples and results:
+        elif (self.continuous or self.collected_samples < self.max_samples) and results:
             LOG.debug('Continuing to receive for %s', self.unique_id)
             self.receive()
             self.retry_count = 0
@@ -864,12 +1619,13 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
             except Exception as e:
                 LOG.debug('Fail to remove corrupted counters for id %s. Exception %s', self.unique_id, e)
                 pass
-            if self.ps_counter_map.keys():
+            if self.num_commands:
                 yield self.restart()
             # Report corrupt counters
-            dsconf0 = self.config.datasources[0]
-            if CORRUPT_COUNTERS[dsconf0.device]:
-                self.reportCorruptCounters(self.counter_map)
+            for member in members:
+                corrupt_counters = COUNTER_STATE.corrupt(member.config.id)
+                if corrupt_counters:
+                    member.reportCorruptCounters(corrupt_counters)
             self.retry_count = 0
         else:
             self.retry_count = 0
@@ -888,6 +1644,136 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
             'ipAddress': self.config.manageIp})
         defer.returnValue(None)
 
+    def restart_failed_chunks(self, result):
+        """Restart commands which failed while others returned data.
+
+        Return the result of the remaining commands. If all commands
+        failed, the result is returned as is to be handled as a whole.
+        """
+        failed = []
+        for index, (success, data) in itertools.izip(self.receiving, result):
+            if success:
+                self.chunk_failures.pop(index, None)
+            elif index in self.restarting_chunks:
+                # The command was stopped to be restarted.
+                continue
+            elif not (data.check(defer.CancelledError) or 'OperationTimeout' in str(data.value)):
+                failed.append(index)
+        if not failed or len(failed) == len(result):
+            return result
+
+        for index in failed:
+            LOG.debug('Windows Perfmon command %d failed for id %s: %s',
+                      index, self.unique_id, result[self.receiving.index(index)][1].value)
+            self.retry_chunk(index)
+        return [command_result for index, command_result in itertools.izip(self.receiving, result)
+                if index not in failed]
+
+    def retry_chunk(self, index):
+        """Restart a single command, again in the next collection if it fails."""
+        self.failed_chunks.discard(index)
+        d = self.restart_chunk(index)
+        d.addErrback(self.onRetryChunkFail, index)
+        return d
+
+    def onRetryChunkFail(self, failure, index):
+        LOG.warn('Windows Perfmon failed to restart command %d for id %s: %s',
+                 index, self.unique_id, failure.getErrorMessage())
+        self.restarting_chunks.discard(index)
+        self.failed_chunks.add(index)
+
+    @coroutine
+    def restart_chunk(self, index):
+        """Stop then start a single command after a backoff delay.
+
+        All commands are restarted after MAX_RETRIES failures in a row.
+        """
+        failures = self.chunk_failures[index] = self.chunk_failures.get(index, 0) + 1
+        if failures > MAX_RETRIES:
+            LOG.debug('Windows Perfmon command %d failed %d times for id %s, restarting all commands',
+                      index, failures - 1, self.unique_id)
+            self.chunk_failures.clear()
+            yield self.restart()
+            defer.returnValue(None)
+
+        command = self.complex_command.commands[index]
+        generation = self.generation
+        delay = min(CHUNK_RETRY_DELAY * 2 ** (failures - 1), self.sample_interval * MAX_RETRIES)
+        self.restarting_chunks.add(index)
+        yield self.complex_command.stop_command(command)
+        yield deferLater(reactor, delay, lambda: None)
+
+        # All commands may have been restarted meanwhile.
+        if self.state != PluginStates.STARTED or self.generation != generation:
+            self.restarting_chunks.discard(index)
+            defer.returnValue(None)
+
+        if self.compact_readings:
+            self.compact_readings.reset(str(index))
+        LOG.debug('Windows Perfmon restarting command %d for id %s', index, self.unique_id)
+        self.pipeline.record_restart()
+        try:
+            yield self.complex_command.start_command(command, self.commandlines[index])
+        except Exception as e:
+            LOG.debug('Windows Perfmon failed to restart command %d for id %s: %s', index, self.unique_id, e)
+            self.restarting_chunks.discard(index)
+            self.retry_chunk(index)
+            defer.returnValue(None)
+        self.restarting_chunks.discard(index)
+
+        # Receive from the restarted command if nothing else is received.
+        if self.receive_deferreds is None or self.receive_deferreds.called:
+            self.receive()
+
+    @coroutine
+    def restart_changed_chunks(self, commandlines):
+        """Restart the commands whose command line is not in commandlines.
+
+        All commands are restarted if their number changed.
+        """
+        if self.state != PluginStates.STARTED:
+            defer.returnValue(None)
+        changed = [index for index, commandline in enumerate(self.commandlines)
+                   if index >= len(commandlines) or commandline != commandlines[index]]
+        if len(commandlines) != len(self.commandlines) or \
+                len(self.complex_command.commands) != len(self.commandlines) or \
+                len(changed) == len(self.commandlines):
+            yield self.stop()
+            defer.returnValue(None)
+
+        generation = self.generation
+        for index in changed:
+            command = self.complex_command.commands[index]
+            LOG.debug('Windows Perfmon restarting changed command %d for id %s', index, self.unique_id)
+            self.restarting_chunks.add(index)
+            self.chunk_failures.pop(index, None)
+            yield self.complex_command.stop_command(command)
+            if self.state != PluginStates.STARTED or self.generation != generation:
+                self.restarting_chunks.discard(index)
+                defer.returnValue(None)
+            if self.compact_readings:
+                self.compact_readings.reset(str(index))
+            self.pipeline.record_restart()
+            try:
+                yield self.complex_command.start_command(command, self.commandlines[index])
+            except Exception as e:
+                LOG.debug('Windows Perfmon failed to restart command %d for id %s: %s',
+                          index, self.unique_id, e)
+                self.restarting_chunks.discard(index)
+                yield self.stop()
+                defer.returnValue(None)
+            self.restarting_chunks.discard(index)
+
+        # Receive from the restarted commands if nothing else is received.
+        if self.receive_deferreds is None or self.receive_deferreds.called:
+            self.receive()
+
+    def session_members(self):
+        """Return plugins to route received values to."""
+        if self.session:
+            return self.session.members.values()
+        return [self]
+
     @coroutine
     def onReceiveFail(self, failure):
         e = failure.value
@@ -1016,47 +1902,34 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
         defer.returnValue(None)
 
     @coroutine
-    def search_corrupt_counters(self, winrs, counter_list, corrupt_list):
-        """Bisect the counters to determine which of them are corrupt."""
-        ps_command = "powershell -NoLogo -NonInteractive -NoProfile -Command"
-        ps_script = lambda counters: (
-            "\"get-counter -counter @({})\"".format(format_counters(counters)))
+    def probe_counters(self, pool, counters):
+        """Return True if Get-Counter succeeds for all counters.
 
-        num_counters = len(counter_list)
-
-        if num_counters == 0:
-            pass
-        elif num_counters == 1:
-            result = yield add_timeout(winrs.run_command(ps_command, ps_script(counter_list)),
+        Return None if the result is inconclusive.
+        """
+        ps_script = "\"get-counter -counter @({})\"".format(format_counters(counters))
+        winrs = yield pool.get()
+        try:
+            result = yield add_timeout(winrs.run_command(PS_COMMAND.strip(), ps_script),
                                        self.config.datasources[0].zWinRMConnectTimeout + 5)
-            if result.stderr:
-                if 'not recognized as the name of a cmdlet' in result.stderr:
-                    PERSISTER.add_event(self.unique_id, self.config.datasources, {
-                        'device': self.config.id,
-                        'severity': ZenEventClasses.Error,
-                        'eventClass': '/Status/Winrm',
-                        'eventKey': 'WindowsPerfmonCollection',
-                        'summary': self.ps_mod_path_msg,
-                    })
-                    defer.returnValue(corrupt_list)
-
-                LOG.debug('Received error checking for corrupt counter: %s', result.stderr)
-                # double check that no counter sample was returned
-                if not counter_returned(result):
-                    corrupt_list.extend(counter_list)
-        else:
-            mid_index = num_counters / 2
-            slices = (counter_list[:mid_index], counter_list[mid_index:])
-            for counter_slice in slices:
-                result = yield add_timeout(winrs.run_command(ps_command, ps_script(counter_slice)),
-                                           self.config.datasources[0].zWinRMConnectTimeout + 5)
-                if result.stderr:
-                    LOG.debug('Received error checking for corrupt counters for %s: %s', self.unique_id,
-                              result.stderr)
-                    yield self.search_corrupt_counters(
-                        winrs, counter_slice, corrupt_list)
-
-        defer.returnValue(corrupt_list)
+        finally:
+            pool.put(winrs)
+
+        if not result.stderr:
+            defer.returnValue(True)
+        if 'not recognized as the name of a cmdlet' in result.stderr:
+            PERSISTER.add_event(self.unique_id, self.config.datasources, {
+                'device': self.config.id,
+                'severity': ZenEventClasses.Error,
+                'eventClass': '/Status/Winrm',
+                'eventKey': 'WindowsPerfmonCollection',
+                'summary': self.ps_mod_path_msg,
+            })
+            defer.returnValue(None)
+
+        LOG.debug('Received error checking for corrupt counters for %s: %s', self.unique_id, result.stderr)
+        # double check that no counter sample was returned
+        defer.returnValue(len(counters) == 1 and counter_returned(result))
 
     @coroutine
     def remove_corrupt_counters(self):
@@ -1068,112 +1941,114 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
         # this device (node), but at another. So need to change connection info accordingly.
         conn_info = modify_connection_info(conn_info, dsconf0)
 
-        winrs = SingleCommandClient(conn_info)
-
-        counter_list = sorted(
-            set(self.ps_counter_map.keys()) - set(CORRUPT_COUNTERS[dsconf0.device]))
-        corrupt_counters = yield self.search_corrupt_counters(winrs, counter_list, [])
-
-        # Add newly found corrupt counters to the previously checked ones.
-        if corrupt_counters:
-            CORRUPT_COUNTERS[dsconf0.device].extend(corrupt_counters)
+        # Each client runs one command at a time.
+        pool = defer.DeferredQueue()
+        for _ in xrange(CORRUPT_SEARCH_PROBES):
+            pool.put(SingleCommandClient(conn_info))
+        searcher = CorruptCounterSearch(
+            lambda counters: self.probe_counters(pool, counters), COUNTER_STATE, dsconf0.device)
+
+        members = self.session_members()
+        requested = set()
+        for member in members:
+            requested.update(member.ps_counter_map)
+        requested.difference_update(COUNTER_STATE.corrupt(dsconf0.device))
+
+        # Counters known to be good are not checked, unless nothing else
+        # is found to be corrupt.
+        known_good = requested & COUNTER_STATE.good(dsconf0.device)
+        corrupt_counters = yield searcher.search(sorted(requested - known_good))
+        if not corrupt_counters and known_good:
+            COUNTER_STATE.discard_good(dsconf0.device, known_good)
+            corrupt_counters = yield searcher.search(sorted(known_good))
+        LOG.debug('%s: Windows Perfmon found %d corrupt counter(s) in %d probe(s)',
+                  self.config.id, len(corrupt_counters), searcher.probes)
+        self.pipeline.record_search(searcher.probes)
 
         # Remove the error counters from the counter map.
-        for counter in CORRUPT_COUNTERS[dsconf0.device]:
-            if self.ps_counter_map.get(counter):
-                LOG.debug("Counter '{0}' not found. Removing".format(counter))
-                del self.ps_counter_map[counter]
+        for counter in COUNTER_STATE.corrupt(dsconf0.device):
+            for member in members:
+                if member.ps_counter_map.get(counter):
+                    LOG.debug("Counter '{0}' not found. Removing".format(counter))
+                    del member.ps_counter_map[counter]
+                    if member.config.id != dsconf0.device:
+                        COUNTER_STATE.add(member.config.id, 'corrupt', [counter])
+                        COUNTER_STATE.save(member.config.id)
 
         # Rebuild the command.
         self._build_commandlines()
 
         defer.returnValue(None)
 
-    def reportCorruptCounters(self, requested):
+    def reportCorruptCounters(self, corrupt):
         """Emit event for corrupt counters"""
-        default_eventClass = '/Status/Winrm'
-        dsconf0 = self.config.datasources[0]
-
-        events = {}
-        for req_counter in requested:
-            if req_counter in CORRUPT_COUNTERS[dsconf0.device]:
-                comp_ds_ec_l = requested.get(req_counter, [])
-                for component, datasource, event_class in comp_ds_ec_l:
-                    if event_class and event_class != default_eventClass:
-                        if event_class not in events:
-                            events[event_class] = []
-                        events[event_class].append(req_counter)
-                    else:
-                        if default_eventClass not in events:
-                            events[default_eventClass] = []
-                        events[default_eventClass].append(req_counter)
+        events = self.counter_index.group_by_event_class(
+            counter for counter in corrupt if counter in self.counter_index)
 
-        if events:
-            for event in events:
-                PERSISTER.add_event(self.unique_id, self.config.datasources, {
-                    'device': self.config.id,
-                    'severity': ZenEventClasses.Error,
-                    'eventClass': event,
-                    'eventKey': 'Windows Perfmon Corrupt Counters',
-                    'summary': self.corrupt_counters_summary(len(events[event])),
-                    'corrupt_counters': self.missing_counters_str(events[event]).decode('UTF-8'),
-                })
-
-        for req_counter in requested:
-            comp_ds_ec_l = requested.get(req_counter, [])
-            for component, datasource, event_class in comp_ds_ec_l:
-                event_class = event_class or default_eventClass
-                if event_class not in events:
-                    PERSISTER.add_event(self.unique_id, self.config.datasources, {
-                        'device': self.config.id,
-                        'severity': ZenEventClasses.Clear,
-                        'eventClass': event_class or default_eventClass,
-                        'eventKey': 'Windows Perfmon Corrupt Counters',
-                        'summary': '0 counters corrupt in collection',
-                    })
+        for event_class, counters in events.iteritems():
+            if not self.counter_event_due('Windows Perfmon Corrupt Counters', event_class, counters):
+                continue
+            PERSISTER.add_event(self.unique_id, self.config.datasources, {
+                'device': self.config.id,
+                'severity': ZenEventClasses.Error,
+                'eventClass': event_class,
+                'eventKey': 'Windows Perfmon Corrupt Counters',
+                'summary': self.corrupt_counters_summary(len(counters)),
+                'corrupt_counters': self.missing_counters_str(counters).decode('UTF-8'),
+            })
+
+        for event_class in self.counter_index.all_event_classes.difference(events):
+            if not self.counter_event_due('Windows Perfmon Corrupt Counters', event_class, ()):
+                continue
+            PERSISTER.add_event(self.unique_id, self.config.datasources, {
+                'device': self.config.id,
+                'severity': ZenEventClasses.Clear,
+                'eventClass': event_class,
+                'eventKey': 'Windows Perfmon Corrupt Counters',
+                'summary': '0 counters corrupt in collection',
+            })
 
-    def reportMissingCounters(self, requested, returned):
+    def reportMissingCounters(self, returned):
         """Emit logs and events for counters requested but not returned."""
-        missing_counters = set(requested).difference(returned)
-        default_eventClass = '/Status/Winrm'
+        events = self.counter_index.group_by_event_class(
+            self.counter_index.missing(returned))
 
-        events = {}
-        for req_counter in requested:
-            if req_counter in missing_counters:
-                comp_ds_ec_l = requested.get(req_counter, [])
-                for component, datasource, event_class in comp_ds_ec_l:
-                    if event_class and event_class != default_eventClass:
-                        if event_class not in events:
-                            events[event_class] = []
-                        events[event_class].append(req_counter)
-                    else:
-                        if default_eventClass not in events:
-                            events[default_eventClass] = []
-                        events[default_eventClass].append(req_counter)
+        for event_class, counters in events.iteritems():
+            if not self.counter_event_due('Windows Perfmon Missing Counters', event_class, counters):
+                continue
+            PERSISTER.add_event(self.unique_id, self.config.datasources, {
+                'device': self.config.id,
+                'severity': ZenEventClasses.Info,
+                'eventClass': event_class,
+                'eventKey': 'Windows Perfmon Missing Counters',
+                'summary': self.missing_counters_summary(len(counters)),
+                'missing_counters': self.missing_counters_str(counters).decode('UTF-8'),
+            })
+
+        for event_class in self.counter_index.all_event_classes.difference(events):
+            if not self.counter_event_due('Windows Perfmon Missing Counters', event_class, ()):
+                continue
+            PERSISTER.add_event(self.unique_id, self.config.datasources, {
+                'device': self.config.id,
+                'severity': ZenEventClasses.Clear,
+                'eventClass': event_class,
+                'eventKey': 'Windows Perfmon Missing Counters',
+                'summary': '0 counters missing in collection',
+            })
 
-        if events:
-            for event in events:
-                PERSISTER.add_event(self.unique_id, self.config.datasources, {
-                    'device': self.config.id,
-                    'severity': ZenEventClasses.Info,
-                    'eventClass': event,
-                    'eventKey': 'Windows Perfmon Missing Counters',
-                    'summary': self.missing_counters_summary(len(events[event])),
-                    'missing_counters': self.missing_counters_str(events[event]).decode('UTF-8'),
-                })
-
-        for req_counter in requested:
-            comp_ds_ec_l = requested.get(req_counter, [])
-            for component, datasource, event_class in comp_ds_ec_l:
-                event_class = event_class or default_eventClass
-                if event_class not in events:
-                    PERSISTER.add_event(self.unique_id, self.config.datasources, {
-                        'device': self.config.id,
-                        'severity': ZenEventClasses.Clear,
-                        'eventClass': event_class or default_eventClass,
-                        'eventKey': 'Windows Perfmon Missing Counters',
-                        'summary': '0 counters missing in collection',
-                    })
+    def counter_event_due(self, event_key, event_class, counters):
+        """Return True if a counters event should be sent.
+
+        Events are sent when the set of counters for the event key and
+        class changes, and again every event_heartbeat seconds.
+        """
+        counters = frozenset(counters)
+        now = time.time()
+        sent = self.counter_events.get((event_key, event_class))
+        if sent is not None and sent[0] == counters and now - sent[1] < self.event_heartbeat:
+            return False
+        self.counter_events[(event_key, event_class)] = (counters, now)
+        return True
 
     def missing_counters_summary(self, count):
         return (
@@ -1192,6 +2067,11 @@ class PerfmonDataSourcePlugin(PythonDataSourcePlugin):
         This can happen when zenpython terminates, or anytime config is
         deleted or modified.
         """
+        SESSIONS.leave(self)
+        PIPELINES.pop(self.unique_id, None)
+        START_SCHEDULER.unconfigure(self)
+        if self._delayed_start and self._delayed_start.active():
+            self._delayed_start.cancel()
         return reactor.callLater(self.sample_interval, self.stop)
 
     def _errorMsgCheck(self, errorMessage):
@@ -1222,21 +2102,199 @@ def counter_returned(result):
     return False
 
 
+def format_counter(counter):
+    """Return a counter formatted for the ps command line."""
+    # check for unicode apostrophe present in foreign langs
+    return "('{0}')".format(counter.replace(u'\u2019', "'+[char]8217+'"))
+
+
 def format_counters(ps_counters):
     """Convert a list of supplied counters into a string, which will
     be further used to cteate ps command line.
     """
-    counters = []
-    for counter in ps_counters:
-        # check for unicode apostrophe present in foreign langs
-        counter = counter.replace(u'\u2019', "'+[char]8217+'")
-        counters.append("('{0}')".format(counter))
-    return ','.join(counters)
+    return ','.join(format_counter(counter) for counter in ps_counters)
+
+
+def wildcard_counters(counters, min_instances=WILDCARD_MIN_INSTANCES):
+    """Return counters with instances of one object and counter name
+    replaced by a wildcard path.
+
+    E.g. '\\process(a)\\% processor time' and '\\process(b)\\% processor time'
+    are replaced by '\\process(*)\\% processor time' if there are at least
+    min_instances of them. Returned instances are routed by their full
+    path, so instances which are not monitored are ignored.
+    """
+    wildcards = {}
+    result = []
+    for counter in counters:
+        match = INSTANCE_COUNTER_RE.match(counter)
+        if match and '*' not in match.group('instance'):
+            wildcards.setdefault(
+                (match.group('object'), match.group('counter')), []).append(counter)
+        else:
+            result.append(counter)
+
+    for (obj, name), instances in wildcards.iteritems():
+        if len(instances) >= min_instances:
+            result.append(u'{}(*){}'.format(obj, name))
+        else:
+            result.extend(instances)
+    return sorted(result)
+
+
+def pack_counters(counters, limit, previous=()):
+    """Pack counters into groups whose formatted line fits the limit.
+
+    Groups of the previous packing keep their counters, so that
+    unchanged command lines stay the same. New counters are placed
+    first-fit decreasing by their formatted length. If keeping the
+    previous groups would need more groups than packing from scratch,
+    the counters are repacked. A counter which does not fit the limit
+    on its own gets a group of its own.
+    """
+    sizes = dict((counter, len(format_counter(counter))) for counter in counters)
+
+    def first_fit(groups, lengths, new_counters):
+        # Sort by decreasing length, then by counter for determinism.
+        for counter in sorted(new_counters, key=lambda c: (-sizes[c], c)):
+            for i, length in enumerate(lengths):
+                # Account for the comma separating counters.
+                if length + 1 + sizes[counter] <= limit:
+                    groups[i].append(counter)
+                    lengths[i] += 1 + sizes[counter]
+                    break
+            else:
+                groups.append([counter])
+                lengths.append(sizes[counter])
+        return groups
+
+    remaining = set(sizes)
+    groups = []
+    lengths = []
+    for group in previous:
+        kept = [counter for counter in group if counter in remaining]
+        length = len(format_counters(kept))
+        # The limit may have changed since the previous packing.
+        if kept and (length <= limit or len(kept) == 1):
+            remaining.difference_update(kept)
+            groups.append(kept)
+            lengths.append(length)
+    groups = first_fit(groups, lengths, remaining)
+
+    if previous:
+        repacked = first_fit([], [], sizes)
+        if len(repacked) < len(groups):
+            groups = repacked
+
+    return [sorted(group) for group in groups]
+
+
+def is_sample_start(stdout_lines):
+    """Return True if the Get-Counter output starts a new sample.
+
+    The BOM marker (if present) may precede the property name.
+    """
+    for line in stdout_lines[:2]:
+        if line.startswith(READINGS_MARKER):
+            return True
+        if line != BOM:
+            break
+    return False
 
 
-def chunkify(lst, n):
-    """Yield successive n-sized chunks from the list."""
-    return [lst[i::n] for i in xrange(n)]
+def iter_readings(stdout_lines):
+    """Yield (path, value) pairs from Get-Counter Readings output.
+
+    The lines are read once, without intermediate copies. The BOM
+    marker and property name are dropped from the first line as it is
+    read. Paths are returned as is, e.g.
+        '\\\\amazona-q2r281f\\web service(another web site)\\move requests/sec :'
+    """
+    lines = iter(stdout_lines)
+    first = next(lines, None)
+    if first == BOM:
+        first = next(lines, None)
+    if first is None:
+        return
+    if first.startswith(READINGS_MARKER):
+        first = first[len(READINGS_MARKER):]
+
+    for path in itertools.chain((first,), lines):
+        value = next(lines, None)
+        if value is None:
+            return
+
+        # ZEN-12024: Some locales use ',' as the decimal point.
+        if ',' in value:
+            value = value.replace(',', '.', 1)
+
+        yield path, value
+
+
+class CompactReadings(object):
+    """Decoder of compact Get-Counter output.
+
+    Counter paths are remembered by command and index as they are
+    defined, e.g.
+        '#0 3 \\\\amazona-q2r281f\\memory\\available bytes'
+    and sample lines are decoded into (path, value) pairs, e.g.
+        '0 1519856886 3:2736390144 4:12.5'
+    The number of samples of the first command is counted in samples.
+    """
+
+    def __init__(self):
+        self.paths = {}
+        self.samples = 0
+        # Timestamp of the last sample of the first command.
+        self.timestamp = None
+
+    def reset(self, command=None):
+        """Forget counter paths of all commands or of one command."""
+        if command is None:
+            self.paths.clear()
+        else:
+            self.paths.pop(command, None)
+
+    def decode(self, stdout_lines):
+        """Yield (path, value) pairs from compact Get-Counter output."""
+        paths = self.paths
+        for line in stdout_lines:
+            if line.startswith(BOM):
+                line = line[len(BOM):]
+            if line.startswith('#'):
+                try:
+                    command, index, path = line[1:].split(' ', 2)
+                except ValueError:
+                    LOG.debug('Windows Perfmon could not parse counter definition: %s', line)
+                    continue
+                paths.setdefault(command, {})[index] = path
+                continue
+
+            fields = line.split(' ')
+            command = fields[0]
+            if command == '0':
+                self.samples += 1
+                try:
+                    self.timestamp = int(fields[1])
+                except (IndexError, ValueError):
+                    pass
+            command_paths = paths.get(command, {})
+            for field in itertools.islice(fields, 2, None):
+                index, _, value = field.partition(':')
+                path = command_paths.get(index)
+                if path is not None:
+                    yield path, value
+
+
+def counter_from_path(path):
+    """Return the counter for a host-qualified Get-Counter path.
+
+    Path to counter conversion:
+        '\\\\amazona-q2r281f\\web service(another web site)\\move requests/sec :'
+        '\\\\amazona-q2r281f\\web service(another web site)\\move requests/sec'
+        '\\web service(another web site)\\move requests/sec'
+    """
+    return u'\\' + path.strip(' :').split('\\', 3)[3]
 
 
 def format_stdout(stdout_lines):
@@ -1246,12 +2304,12 @@ def format_stdout(stdout_lines):
     """
     sample_start = False
     # Remove BOM marker(if present).
-    if stdout_lines and stdout_lines[0] == unicode(codecs.BOM_UTF8, "utf8"):
+    if stdout_lines and stdout_lines[0] == BOM:
         stdout_lines = stdout_lines[1:]
 
     # Remove property name from the first stdout line.
-    if stdout_lines and stdout_lines[0].startswith('Readings : '):
-        stdout_lines[0] = stdout_lines[0].replace('Readings : ', '', 1)
+    if stdout_lines and stdout_lines[0].startswith(READINGS_MARKER):
+        stdout_lines[0] = stdout_lines[0].replace(READINGS_MARKER, '', 1)
         sample_start = True
 
     return stdout_lines, sample_start
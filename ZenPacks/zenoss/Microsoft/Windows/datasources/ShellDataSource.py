@@ -14,6 +14,10 @@ See Products.ZenModel.ZenPack._getClassesByPath() to understand how this class
 gets discovered as a datasource type in Zenoss.
 """
 
+import base64
+import collections
+import copy
+import hashlib
 import time
 import logging
 import urllib
@@ -27,7 +31,9 @@ from zope.component import queryUtility
 from zope.interface import implements
 from zope.interface import Interface
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.internet.error import TimeoutError
+from twisted.internet.task import deferLater
 from twisted.python.failure import Failure
 from Products.DataCollector.plugins.DataMaps import ObjectMap
 from Products.DataCollector.Plugins import getParserLoader, loadParserPlugins
@@ -50,16 +56,17 @@ from ZenPacks.zenoss.Microsoft.Windows.utils import filter_sql_stdout, \
     parseDBUserNamePass, getSQLAssembly, parse_winrs_response
 from ..utils import (
     check_for_network_error, save, errorMsgCheck,
-    generateClearAuthEvents, get_dsconf, SqlConnection,
+    generateClearAuthEvents, get_dsconf_index, SqlConnection,
     lookup_databasesummary, lookup_database_status,
     lookup_ag_state, lookup_ag_quorum_state, fill_ag_om, fill_ar_om, fill_al_om, fill_adb_om,
     get_default_properties_value_for_component, get_prop_value_events, get_db_om, get_db_monitored)
 from EventLogDataSource import string_to_lines
+from PerfmonDataSource import CMD_LINE_LIMIT
 from . import send_to_debug
 
 # Requires that txwinrm_utils is already imported.
 from txwinrm.util import RequestError
-from txwinrm.WinRMClient import SingleCommandClient
+from txwinrm.WinRMClient import SingleCommandClient, LongCommandClient
 
 log = logging.getLogger("zen.MicrosoftWindows")
 ZENPACKID = 'ZenPacks.zenoss.Microsoft.Windows'
@@ -78,6 +85,92 @@ AVAILABLE_STRATEGIES = [
 
 BUFFER_SIZE = '$Host.UI.RawUI.BufferSize = New-Object Management.Automation.Host.Size (4096, 512);'
 
+# Prefixes of the lines delimiting sections of batched custom commands
+# and requests to a persistent PowerShell host.
+BATCH_MARKER = '##zenbatch##'
+HOST_MARKER = '##zenhost##'
+# Run a script in a delimited section. Errors are written to stdout after
+# the output of the section, each line prefixed with ERR, followed by the
+# exit code of the section: $LASTEXITCODE, or 1 after a terminating error
+# or when $? is false after the script, as with powershell -Command.
+SECTION = (
+    "'{marker} {index} BEGIN'; $global:LASTEXITCODE = 0; "
+    "try {{ $o = & ([scriptblock]::Create('{script}')) 2>&1; $c = [int](-not $?) }} catch {{ $o = @($_); $c = 1 }}; "
+    "$e = @($o | ? {{ $_ -is [Management.Automation.ErrorRecord] }}); "
+    "$o | ? {{ $_ -isnot [Management.Automation.ErrorRecord] }} | Out-String -Stream -Width 4096; "
+    "$e | Out-String -Stream -Width 4096 | % {{ '{marker} {index} ERR ' + $_ }}; "
+    "'{marker} {index} END ' + $(if ($global:LASTEXITCODE) {{ $global:LASTEXITCODE }} else {{ $c }});"
+)
+# Prefix of the status lines of an asynchronous dcdiag run.
+DCDIAG_MARKER = '##zendcdiag##'
+# Seconds between checks for the output of an asynchronous dcdiag run, and
+# seconds after which a run that did not finish is stopped.
+DCDIAG_POLL_INTERVAL = 30
+DCDIAG_MAX_RUNTIME = 3600
+# Start dcdiag in a process created by WMI, outside of the WinRS shell, with
+# its output moved to <file>.txt when it ends, or report the output of the
+# previous run. Status lines are the key of the tests run followed by DONE
+# and the output, RUNNING, KILLED, STARTED and FAILED <code>.
+DCDIAG_JOB = (
+    "$f = Join-Path ([IO.Path]::GetTempPath()) 'zenoss_dcdiag_{key}'; $q = [char]34; "
+    "if (Test-Path ($f + '.txt')) {{ "
+    "'{marker} {key} DONE'; Get-Content ($f + '.txt'); "
+    "Remove-Item ($f + '.txt'), ($f + '.pid') -EA SilentlyContinue }} "
+    "elseif (Test-Path ($f + '.pid')) {{ "
+    "$p = Get-Item ($f + '.pid'); $id = [int](Get-Content $p); "
+    "if (-not (Get-Process -Id $id -EA SilentlyContinue)) {{ Remove-Item $p, ($f + '.tmp') -EA SilentlyContinue }} "
+    "elseif ($p.LastWriteTime -lt (Get-Date).AddSeconds(-{max_runtime})) {{ "
+    "taskkill /T /F /PID $id | Out-Null; Remove-Item $p, ($f + '.tmp') -EA SilentlyContinue; '{marker} {key} KILLED' }} "
+    "else {{ '{marker} {key} RUNNING' }} }}; "
+    "if ({launch} -and -not (Test-Path ($f + '.pid'))) {{ "
+    "$cmd = 'cmd /c {command} > ' + $q + $f + '.tmp' + $q + ' 2>&1 & move /y ' + $q + $f + '.tmp' + $q + "
+    "' ' + $q + $f + '.txt' + $q + ' > nul'; "
+    "$r = ([wmiclass]'Win32_Process').Create($cmd); "
+    "if ($r.ReturnValue -eq 0) {{ Set-Content ($f + '.pid') $r.ProcessId; '{marker} {key} STARTED' }} "
+    "else {{ '{marker} {key} FAILED ' + $r.ReturnValue }} }}"
+)
+# Status of all databases, as SMO Database.Status, and their counters.
+SET_BASED_QUERY = (
+    "SET NOCOUNT ON; "
+    "SELECT 'S' + CHAR(9) + d.name + CHAR(9) + "
+    "CASE d.state "
+    "WHEN 0 THEN CASE WHEN HAS_DBACCESS(d.name) = 0 THEN 'Inaccessible' ELSE 'Normal' END "
+    "WHEN 1 THEN 'Restoring' "
+    "WHEN 2 THEN 'Recovering' "
+    "WHEN 3 THEN 'RecoveryPending' "
+    "WHEN 4 THEN 'Suspect' "
+    "WHEN 5 THEN 'EmergencyMode' "
+    "ELSE 'Offline' END + "
+    "CASE WHEN d.is_in_standby = 1 THEN ', Standby' ELSE '' END + "
+    "CASE WHEN d.is_auto_close_on = 1 AND d.is_cleanly_shutdown = 1 THEN ', AutoClosed' ELSE '' END "
+    "FROM sys.databases AS d "
+    "UNION ALL "
+    "SELECT 'C' + CHAR(9) + RTRIM(pc.instance_name) + CHAR(9) + RTRIM(pc.counter_name) + CHAR(9) + "
+    "CAST(pc.cntr_value AS varchar(20)) "
+    "FROM sys.dm_os_performance_counters AS pc "
+    "WHERE RTRIM(pc.instance_name) COLLATE DATABASE_DEFAULT IN "
+    "(SELECT name COLLATE DATABASE_DEFAULT FROM sys.databases);"
+)
+# Strategies collected by one script per SQL instance when
+# zWinMSSQLUnifiedCollection is set, and the prefix of its section lines.
+UNIFIED_MSSQL_STRATEGIES = (
+    'powershell MSSQL',
+    'powershell MSSQL Job',
+    'powershell MSSQL Instance',
+    'powershell MSSQL AO AG',
+    'powershell MSSQL AO AR',
+    'powershell MSSQL AO ADB',
+)
+MSSQL_MARKER = '##zenmssql##'
+# Seconds a persistent PowerShell host is kept without requests.
+KEEPALIVE_IDLE = 900
+# Requests run by a persistent PowerShell host before it is restarted.
+KEEPALIVE_MAX_REQUESTS = 1000
+# Seconds to wait for a request without a connection timeout.
+KEEPALIVE_TIMEOUT = 60
+# PowerShell treats typographic single quotes as quotes too.
+SINGLE_QUOTES_RE = re.compile(u"(['\u2018\u2019\u201a\u201b])")
+
 gsm = getGlobalSiteManager()
 
 
@@ -216,13 +309,17 @@ class IStrategy(Interface):
     ''' Interface for strategy '''
 
 
+def dcdiag_key(tests):
+    """Return the key of the files of an asynchronous dcdiag run of tests."""
+    return hashlib.md5(' '.join(sorted(set(tests)))).hexdigest()[:12]
+
+
 class DCDiagStrategy(object):
     implements(IStrategy)
 
     key = 'DCDiag'
 
     def build_command_line(self, tests, testparms, username, password):
-        self.run_tests = set(tests)
         user_parts = username.split('@')
         domain = user_parts[1] if len(user_parts) > 1 else ''
         dcuser = '{}\\{}'.format(domain.split('.')[0], user_parts[0])
@@ -231,7 +328,47 @@ class DCDiagStrategy(object):
             dcdiagcommand += ' ' + ' '.join(testparms)
         return dcdiagcommand
 
-    def parse_result(self, config, result):
+    def build_async_command_line(self, dcdiagcommand, tests, launch):
+        """Return the command line checking for the output of a dcdiag run
+        of the tests, and starting a new run if launch is True and none is
+        running.
+        """
+        pscommand = "powershell -NoLogo -NonInteractive -NoProfile -OutputFormat TEXT -Command "
+        script = "\"& {{{}}}\"".format(BUFFER_SIZE + DCDIAG_JOB.format(
+            key=dcdiag_key(tests),
+            marker=DCDIAG_MARKER,
+            max_runtime=DCDIAG_MAX_RUNTIME,
+            launch='$true' if launch else '$false',
+            command=dcdiagcommand.replace("'", "''")))
+        return pscommand, script
+
+    def parse_async_result(self, result, tests):
+        """Return the status lines of an asynchronous run of tests and the
+        output of a finished run as result, or None.
+        """
+        key = dcdiag_key(tests)
+        states = set()
+        output = None
+        collecting = False
+        for line in result.stdout:
+            if line.startswith(DCDIAG_MARKER):
+                parts = line[len(DCDIAG_MARKER):].strip().split(' ', 1)
+                collecting = False
+                if parts[0] != key or len(parts) < 2:
+                    log.debug('DCDiag run of other tests: %s', line)
+                    continue
+                state = parts[1]
+                log.debug('DCDiag run: %s', state)
+                states.add(state.split(' ')[0])
+                collecting = state == 'DONE'
+                if collecting:
+                    output = ShellResult()
+                    output.stdout, output.stderr = [], []
+            elif collecting:
+                output.stdout.append(line)
+        return states, output
+
+    def parse_result(self, config, result, tests):
         log.debug('DCDiag error on {}: {}'.format(config.id, '\n'.join(result.stderr)))
         log.debug('DCDiag results on {}: {}'.format(config.id, '\n'.join(result.stdout)))
 
@@ -243,7 +380,7 @@ class DCDiagStrategy(object):
         # ZPS-1146: Correctly join output to avoid situations when test name
         # jumps to next line:
         # ......................... <COMP-NAME> failed test\n<TEST-NAME>
-        output = self._clean_output(result.stdout)
+        output = self._clean_output(result.stdout, tests)
         collectedResults = ParsedResults()
         tests_in_error = set()
         if output:
@@ -281,7 +418,7 @@ class DCDiagStrategy(object):
                     error_str = ''
                 else:
                     error_str += line if not error_str else ' ' + line
-        for diag_test in self.run_tests.difference(tests_in_error):
+        for diag_test in set(tests).difference(tests_in_error):
             # Clear events
             msg = "'DCDiag /test:{}' passed".format(diag_test)
             eventkey = 'WindowsActiveDirectory{}'.format(diag_test)
@@ -301,7 +438,7 @@ class DCDiagStrategy(object):
                 'device': config.id})
         return collectedResults
 
-    def _clean_output(self, output):
+    def _clean_output(self, output, tests):
         if len(output) == 0:
             return output
 
@@ -318,8 +455,8 @@ class DCDiagStrategy(object):
             # going to be another test result)
             if last_ln.startswith('........') and not ln.startswith('........') \
                     and any('failed test {}'.format(test) in joined_ln
-                            for test in self.run_tests) \
-                    and any(test in ln for test in self.run_tests):
+                            for test in tests) \
+                    and any(test in ln for test in tests):
                 cleaned_lines[-1] = joined_ln
             else:
                 cleaned_lines.append(ln)
@@ -341,8 +478,39 @@ class CustomCommandStrategy(object):
         pscommand = 'powershell -NoLogo -NonInteractive -NoProfile -OutputFormat TEXT -Command'
         return pscommand, '"{}{}"'.format(BUFFER_SIZE, script)
 
-    def parse_result(self, config, result):
-        dsconf = config.datasources[0]
+    def build_batch_command_line(self, scripts):
+        """Return the command line running the scripts in one PowerShell.
+
+        Returns the number of leading scripts the command runs, at least
+        one, and the command line and arguments as build_command_line.
+        """
+        pscommand = 'powershell -NoLogo -NonInteractive -NoProfile -OutputFormat TEXT -Command'
+        limit = CMD_LINE_LIMIT - len(pscommand) - len(BUFFER_SIZE) - 3
+        sections = []
+        for index, script in enumerate(scripts):
+            # Run the code powershell.exe would see for the script alone.
+            text = command_line_text('"{}"'.format(script.replace('"', r'\"')))
+            section = command_line_argument(SECTION.format(
+                marker=BATCH_MARKER,
+                index=index,
+                script=SINGLE_QUOTES_RE.sub(r'\1\1', text)))[1:-1]
+            limit -= len(section)
+            if limit < 0 and sections:
+                break
+            sections.append(section)
+        return len(sections), pscommand, '"{}{}"'.format(BUFFER_SIZE, ' '.join(sections))
+
+    def parse_batch_result(self, result):
+        """Split the result of a batch into a result per section.
+
+        Returns results of the sections that started, in order. A section
+        which did not end, because its script called exit, gets the exit
+        code and errors of the batch.
+        """
+        return split_sections(result, BATCH_MARKER)
+
+    def parse_result(self, config, result, dsconf=None):
+        dsconf = dsconf or config.datasources[0]
         parserLoader = dsconf.params['parser']
         log.debug('{}: Trying to use the {} parser'.format(config.id, parserLoader.pluginName))
 
@@ -435,8 +603,19 @@ class PowershellMSSQLStrategy(object):
 
     key = 'PowershellMSSQL'
 
-    def build_command_line(self, sqlConnection):
+    def build_command_line(self, sqlConnection, set_based=False):
         pscommand = "powershell -NoLogo -NonInteractive -NoProfile -OutputFormat TEXT -Command "
+        script = "\"& {{{}}}\"".format(
+            ''.join([BUFFER_SIZE] +
+                    getSQLAssembly(sqlConnection.version) +
+                    sqlConnection.sqlConnection +
+                    [self.build_script_body(set_based)]))
+        return pscommand, script
+
+    def build_script_body(self, set_based=False):
+        """Return the script run with the SMO $server of the instance."""
+        if set_based:
+            return self.build_set_based_script_body()
 
         # We should not be running this per database.  Bad performance problems when there are
         # a lot of databases.  Run script per instance
@@ -468,12 +647,27 @@ class PowershellMSSQLStrategy(object):
         counters_sqlConnection.append("$ds = $dbMaster.ExecuteWithResults($query);")
         counters_sqlConnection.append("if($ds.Tables[0].rows.count -gt 0) {$ds.Tables[0].rows"
                                       "| % {write-host $_.Column1':counter:'$_.Column2':value:'$_.Column3;} } }")
-        script = "\"& {{{}}}\"".format(
-            ''.join([BUFFER_SIZE] +
-                    getSQLAssembly(sqlConnection.version) +
-                    sqlConnection.sqlConnection +
-                    counters_sqlConnection))
-        return pscommand, script
+        return ''.join(counters_sqlConnection)
+
+    def build_set_based_script_body(self):
+        """Return the script getting status and counters of all databases
+        with one T-SQL query instead of enumerating SMO databases.
+
+        Each row is a tab separated line, S<tab>database<tab>status or
+        C<tab>database<tab>counter<tab>value, read with a SqlDataReader and
+        written at once. The connection is shared with SMO, which may have
+        opened it in an earlier section, and is left open for later ones.
+        """
+        script = []
+        script.append("if ($sqlconn.State -ne [System.Data.ConnectionState]::Open) {$sqlconn.Open()};")
+        script.append("$cmd = $sqlconn.CreateCommand();")
+        script.append("$cmd.CommandText = '{}';".format(SET_BASED_QUERY.replace("'", "''")))
+        script.append("$reader = $cmd.ExecuteReader();")
+        script.append("$sb = New-Object System.Text.StringBuilder;")
+        script.append("while ($reader.Read()) {[void]$sb.AppendLine($reader.GetString(0))};")
+        script.append("$reader.Close();")
+        script.append("Write-Host $sb.ToString();")
+        return ''.join(script)
 
     def parse_result(self, dsconfs, result):
         if result.stderr:
@@ -492,6 +686,14 @@ class PowershellMSSQLStrategy(object):
         self.valuemap = {}
         db_regex = re.compile('(.*):counter:(.*):value:(.*)')
         for counterline in filter_sql_stdout(result.stdout):
+            if counterline.startswith(('S\t', 'C\t')):
+                # Output of the set-based script.
+                fields = counterline.split('\t')
+                if len(fields) == 3:
+                    self.valuemap.setdefault(fields[1], {})['status'] = fields[2].strip()
+                elif len(fields) == 4:
+                    self.valuemap.setdefault(fields[1], {})[fields[2].strip().lower()] = fields[3].strip()
+                continue
             try:
                 databasename, _counter, value = db_regex.match(counterline).groups()
                 databasename = databasename.strip()
@@ -532,7 +734,15 @@ class PowershellMSSQLJobStrategy(object):
 
     def build_command_line(self, sqlConnection):
         pscommand = "powershell -NoLogo -NonInteractive -NoProfile -OutputFormat TEXT -Command "
+        script = "\"& {{{}}}\"".format(
+            ''.join([BUFFER_SIZE] +
+                    getSQLAssembly(sqlConnection.version) +
+                    sqlConnection.sqlConnection +
+                    [self.build_script_body()]))
+        return pscommand, script
 
+    def build_script_body(self):
+        """Return the script run with the SMO $server of the instance."""
         jobs_sqlConnection = []
         jobs_sqlConnection.append("if ($server.JobServer -ne $null) {")
         jobs_sqlConnection.append("foreach ($job in $server.JobServer.Jobs) {")
@@ -543,12 +753,7 @@ class PowershellMSSQLJobStrategy(object):
         jobs_sqlConnection.append("'|LastRunOutcome:'$job.LastRunOutcome")
         jobs_sqlConnection.append("'|CurrentRunStatus:'$job.CurrentRunStatus;")
         jobs_sqlConnection.append("}}")
-        script = "\"& {{{}}}\"".format(
-            ''.join([BUFFER_SIZE] +
-                    getSQLAssembly(sqlConnection.version) +
-                    sqlConnection.sqlConnection +
-                    jobs_sqlConnection))
-        return pscommand, script
+        return ''.join(jobs_sqlConnection)
 
     def parse_result(self, dsconfs, result):
         log.debug('MSSQLJob results: {}'.format(result))
@@ -637,15 +842,16 @@ class PowershellMSSQLInstanceStrategy(object):
 
     def build_command_line(self, instance):
         pscommand = "powershell -NoLogo -NonInteractive -OutputFormat TEXT -Command "
+        script = "\"& {{{}}}\"".format(
+            ''.join([BUFFER_SIZE, self.build_script_body(instance)]))
+        return pscommand, script
 
+    def build_script_body(self, instance):
+        """Return the script reporting the service status of the instance."""
         psInstanceCommands = []
-        psInstanceCommands.append(BUFFER_SIZE)
         psInstanceCommands.append("$inst = Get-Service -DisplayName 'SQL Server ({0})';".format(instance))
         psInstanceCommands.append("Write-Host $inst.Status'|'$inst.Name;")
-
-        script = "\"& {{{}}}\"".format(
-            ''.join(psInstanceCommands))
-        return pscommand, script
+        return ''.join(psInstanceCommands)
 
     def parse_result(self, dsconfs, result):
         if result.exit_code != 0:
@@ -689,7 +895,19 @@ class PowershellMSSQLAlwaysOnAGStrategy(object):
     @staticmethod
     def build_command_line(sql_connection, ag_names):
         ps_command = "powershell -NoLogo -NonInteractive -OutputFormat TEXT -Command "
+        script = "\"& {{{}}}\"".format(
+            ''.join([BUFFER_SIZE] +
+                    getSQLAssembly(sql_connection.version) +
+                    sql_connection.sqlConnection +
+                    [PowershellMSSQLAlwaysOnAGStrategy.build_script_body(ag_names)]))
+
+        log.debug('Powershell MSSQL Always On AG Strategy script: {}'.format(script))
 
+        return ps_command, script
+
+    @staticmethod
+    def build_script_body(ag_names):
+        """Return the script run with the SMO $server of the instance."""
         ps_ao_ag_script = \
             ("$res = New-Object 'system.collections.generic.dictionary[string, object]';"
 
@@ -745,15 +963,7 @@ class PowershellMSSQLAlwaysOnAGStrategy(object):
              "$result_in_json = ConvertTo-Json $res;"
              "Write-Host $result_in_json;").replace('ag_names_placeholder',
                                                     ','.join(("'{}'".format(ag_name) for ag_name in ag_names)))
-        script = "\"& {{{}}}\"".format(
-            ''.join([BUFFER_SIZE] +
-                    getSQLAssembly(sql_connection.version) +
-                    sql_connection.sqlConnection +
-                    [ps_ao_ag_script]))
-
-        log.debug('Powershell MSSQL Always On AG Strategy script: {}'.format(script))
-
-        return ps_command, script
+        return ps_ao_ag_script
 
     @staticmethod
     def parse_result(config, result):
@@ -885,7 +1095,19 @@ class PowershellMSSQLAlwaysOnARStrategy(object):
     @staticmethod
     def build_command_line(sql_connection, ag_names):
         ps_command = "powershell -NoLogo -NonInteractive -OutputFormat TEXT -Command "
+        script = "\"& {{{}}}\"".format(
+            ''.join([BUFFER_SIZE] +
+                    getSQLAssembly(sql_connection.version) +
+                    sql_connection.sqlConnection +
+                    [PowershellMSSQLAlwaysOnARStrategy.build_script_body(ag_names)]))
+
+        log.debug('Powershell MSSQL Always On AR Strategy script: {}'.format(script))
+
+        return ps_command, script
 
+    @staticmethod
+    def build_script_body(ag_names):
+        """Return the script run with the SMO $server of the instance."""
         ps_ao_ar_script = \
             ("$res = New-Object 'system.collections.generic.dictionary[string, object]';"
 
@@ -937,15 +1159,7 @@ class PowershellMSSQLAlwaysOnARStrategy(object):
              "$res_in_json = ConvertTo-Json $res;"
              "Write-Host $res_in_json;").replace('ag_names_placeholder',
                                                  ','.join(("'{}'".format(ag_name) for ag_name in ag_names)))
-        script = "\"& {{{}}}\"".format(
-            ''.join([BUFFER_SIZE] +
-                    getSQLAssembly(sql_connection.version) +
-                    sql_connection.sqlConnection +
-                    [ps_ao_ar_script]))
-
-        log.debug('Powershell MSSQL Always On AR Strategy script: {}'.format(script))
-
-        return ps_command, script
+        return ps_ao_ar_script
 
     @staticmethod
     def parse_result(config, result):
@@ -1146,7 +1360,19 @@ class PowershellMSSQLAlwaysOnADBStrategy(object):
     @staticmethod
     def build_command_line(sql_connection, adb_indices, counters):
         ps_command = "powershell -NoLogo -NonInteractive -OutputFormat TEXT -Command "
+        script = "\"& {{{}}}\"".format(
+            ''.join([BUFFER_SIZE] +
+                    getSQLAssembly(sql_connection.version) +
+                    sql_connection.sqlConnection +
+                    [PowershellMSSQLAlwaysOnADBStrategy.build_script_body(adb_indices, counters)]))
+
+        log.debug('Powershell MSSQL Always On ADB Strategy script: {}'.format(script))
+
+        return ps_command, script
 
+    @staticmethod
+    def build_script_body(adb_indices, counters):
+        """Return the script run with the SMO $server of the instance."""
         ps_adb_script = (
             # Need to SMO object instead T-SQL, because sys.Databases doesn't have State while SMO has.
             "$opt_tps = @([Microsoft.SqlServer.Management.Smo.AvailabilityGroup], [Microsoft.SqlServer.Management.Smo.Database], [Microsoft.SqlServer.Management.Smo.Table]);"
@@ -1221,16 +1447,7 @@ class PowershellMSSQLAlwaysOnADBStrategy(object):
                                               ','.join(("'{}'".format(counter)
                                                         for counter in set(counters)  # use set to make values unique
                                                         if counter)))
-
-        script = "\"& {{{}}}\"".format(
-            ''.join([BUFFER_SIZE] +
-                    getSQLAssembly(sql_connection.version) +
-                    sql_connection.sqlConnection +
-                    [ps_adb_script]))
-
-        log.debug('Powershell MSSQL Always On ADB Strategy script: {}'.format(script))
-
-        return ps_command, script
+        return ps_adb_script
 
     @staticmethod
     def parse_result(config, result):
@@ -1332,19 +1549,195 @@ class PowershellMSSQLAlwaysOnADBStrategy(object):
 gsm.registerUtility(PowershellMSSQLAlwaysOnADBStrategy(), IStrategy, 'powershell MSSQL AO ADB')
 
 
+class PowerShellHost(object):
+    """A long running PowerShell on a target reading requests from stdin.
+
+    Each request runs a script in a section delimited by HOST_MARKER, so
+    assemblies loaded by a request, like SQL Server SMO, stay loaded for
+    the following requests. Requests run one at a time.
+    """
+
+    command_line = 'powershell -NoLogo -NonInteractive -NoProfile -OutputFormat TEXT -Command -'
+
+    def __init__(self, conn_info):
+        self.conn_info = conn_info
+        self.client = None
+        self.shell_cmd = None
+        self.requests = 0
+        self.lock = defer.DeferredLock()
+        self.idle_call = None
+
+    @coroutine
+    def start(self):
+        self.client = LongCommandClient(self.conn_info)
+        self.shell_cmd = yield self.client.start(self.command_line)
+        self.requests = 0
+        log.debug('%s: started PowerShell host', self.conn_info.hostname)
+        yield self.send(BUFFER_SIZE)
+
+    @coroutine
+    def stop(self):
+        client, shell_cmd = self.client, self.shell_cmd
+        self.client = self.shell_cmd = None
+        if self.idle_call and self.idle_call.active():
+            self.idle_call.cancel()
+        self.idle_call = None
+        if shell_cmd is not None:
+            log.debug('%s: stopping PowerShell host', self.conn_info.hostname)
+            try:
+                yield client.stop(shell_cmd)
+            except Exception as e:
+                log.debug('%s: error stopping PowerShell host: %s', self.conn_info.hostname, e)
+
+    def send(self, line):
+        shell_id, command_id = self.shell_cmd
+        return self.client.send_request(
+            'send',
+            shell_id=shell_id,
+            command_id=command_id,
+            base64_encoded_command=base64.encodestring('{0}\r\n'.format(line)))
+
+    def run(self, script, timeout):
+        """Run a -Command argument as a request and return its ShellResult."""
+        return self.lock.run(self._run, script, timeout)
+
+    @coroutine
+    def _run(self, script, timeout):
+        if self.idle_call and self.idle_call.active():
+            self.idle_call.cancel()
+        if self.shell_cmd is not None and self.requests >= KEEPALIVE_MAX_REQUESTS:
+            yield self.stop()
+        started = self.shell_cmd is None
+        if started:
+            yield self.start()
+        self.requests += 1
+        request = self.requests
+        section = SECTION.format(
+            marker=HOST_MARKER,
+            index=request,
+            script=SINGLE_QUOTES_RE.sub(r'\1\1', command_line_text(script)))
+        line = "iex ([Text.Encoding]::UTF8.GetString([Convert]::FromBase64String('{0}')))".format(
+            base64.b64encode(section.encode('utf-8') if isinstance(section, unicode) else section))
+        try:
+            yield self.send(line)
+        except Exception:
+            yield self.stop()
+            if started:
+                raise
+            # The shell may have been deleted by the target, retry once.
+            result = yield self._run(script, timeout)
+            defer.returnValue(result)
+
+        end = '{0} {1} END'.format(HOST_MARKER, request)
+        response = ShellResult()
+        response.stdout, response.stderr = [], []
+        deadline = time.time() + timeout
+        while True:
+            try:
+                received = yield self.client.receive(self.shell_cmd)
+            except Exception as e:
+                if 'OperationTimeout' in str(e) and time.time() < deadline:
+                    continue
+                yield self.stop()
+                raise
+            response.stdout.extend(received.stdout)
+            response.stderr.extend(received.stderr)
+            if received.exit_code is not None:
+                # The script of the request ended the host.
+                response.exit_code = received.exit_code
+                yield self.stop()
+                break
+            if any(line.startswith(end) for line in received.stdout):
+                response.exit_code = 0
+                break
+            if time.time() > deadline:
+                yield self.stop()
+                raise TimeoutError('PowerShell host request timed out after {0} seconds'.format(timeout))
+
+        if self.shell_cmd is not None:
+            self.idle_call = reactor.callLater(KEEPALIVE_IDLE, self.stop)
+        sections = split_sections(response, HOST_MARKER)
+        if not sections:
+            defer.returnValue(response)
+        defer.returnValue(sections[-1])
+
+
+class PowerShellHostManager(object):
+    """PowerShell hosts of all targets by connection information.
+
+    Hosts are shared by the plugins running scripts on the same target,
+    and stopped once all of them are cleaned up.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.users = {}
+
+    def key(self, conn_info):
+        # Strategies change the timeout of the same target.
+        return conn_info._replace(timeout=None)
+
+    def get(self, conn_info):
+        key = self.key(conn_info)
+        host = self.hosts.get(key)
+        if host is None:
+            host = self.hosts[key] = PowerShellHost(conn_info)
+        return host
+
+    def run(self, conn_info, script, user=None):
+        if user is not None:
+            self.users.setdefault(self.key(conn_info), set()).add(user)
+        return self.get(conn_info).run(script, conn_info.timeout or KEEPALIVE_TIMEOUT)
+
+    def release(self, user):
+        """Stop and remove the hosts no other plugin than user runs scripts in."""
+        deferreds = []
+        for key, users in self.users.items():
+            users.discard(user)
+            if users:
+                continue
+            del self.users[key]
+            host = self.hosts.pop(key, None)
+            if host is not None:
+                deferreds.append(host.stop())
+        return defer.DeferredList(deferreds)
+
+
+POWERSHELL_HOSTS = PowerShellHostManager()
+
+
 class ShellDataSourcePlugin(PythonDataSourcePlugin):
     proxy_attributes = ConnectionInfoProperties + (
         'sqlhostname',
-        'cluster_node_server'
+        'cluster_node_server',
+        'zWinCustomCommandBatching',
+        'zWinShellKeepAlive',
+        'zWinMSSQLUnifiedCollection',
+        'zWinMSSQLSetBasedCollection',
+        'zWinDCDiagAsync',
     )
     start = None
+    dsconf_index = None
 
     @classmethod
     def config_key(cls, datasource, context):
         """
         Uniquely pull in datasources
         """
+        if datasource.strategy in UNIFIED_MSSQL_STRATEGIES and \
+                getattr(context, 'zWinMSSQLUnifiedCollection', False):
+            # Collect all MSSQL strategies of the instance together.
+            return (context.device().id,
+                    datasource.getCycleTime(context),
+                    'powershell MSSQL unified',
+                    getattr(context, 'instancename', ''),
+                    getattr(context, 'cluster_node_server', ''))
         if datasource.strategy == 'Custom Command':
+            if datasource.usePowershell and getattr(context, 'zWinCustomCommandBatching', False):
+                # Batch all PowerShell custom commands of the device.
+                return (context.device().id,
+                        datasource.getCycleTime(context),
+                        datasource.strategy)
             return (context.device().id,
                     datasource.getCycleTime(context),
                     datasource.strategy,
@@ -1531,6 +1924,10 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
 
         counters = [dsconf.params['resource'] for dsconf in config.datasources]
 
+        if dsconf0.params['strategy'] in UNIFIED_MSSQL_STRATEGIES and \
+                getattr(dsconf0, 'zWinMSSQLUnifiedCollection', False):
+            results = yield self.collect_unified(config, conn_info)
+            defer.returnValue(results)
         if dsconf0.params['strategy'].startswith('powershell MSSQL'):
             cmd_line_input, conn_info = self.getSQLConnection(dsconf0,
                                                               conn_info)
@@ -1563,16 +1960,25 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
                               for dsconf in config.datasources
                               if dsconf.params['database_index'] is not None}
                 command_line, script = strategy.build_command_line(cmd_line_input, db_indices, counters)
+            elif dsconf0.params['strategy'] == 'powershell MSSQL':
+                command_line, script = strategy.build_command_line(
+                    cmd_line_input, getattr(dsconf0, 'zWinMSSQLSetBasedCollection', False))
             else:
                 command_line, script = strategy.build_command_line(cmd_line_input)
         elif dsconf0.params['strategy'] == 'powershell AO AL':
             cmd_line_input = dsconf0.params.get('instanceid', '')  # Take listener ID as input parameter.
             command_line, script = strategy.build_command_line(cmd_line_input)
+        elif dsconf0.params['strategy'] == 'Custom Command' and is_batch(dsconf0):
+            results = yield self.collect_batch(strategy, config, conn_info)
+            defer.returnValue((strategy, config.datasources, results))
         elif dsconf0.params['strategy'] == 'Custom Command':
             check_datasource(dsconf0)
             script = dsconf0.params['script']
             usePowershell = dsconf0.params['usePowershell']
             command_line, script = strategy.build_command_line(script, usePowershell)
+        elif dsconf0.params['strategy'] == 'DCDiag' and getattr(dsconf0, 'zWinDCDiagAsync', False):
+            results = yield self.collect_dcdiag(strategy, config, conn_info, counters)
+            defer.returnValue((strategy, config.datasources, results))
         elif dsconf0.params['strategy'] == 'DCDiag':
             testparms = [dsconf.params['script'] for dsconf in config.datasources if dsconf.params['script']]
             command_line = strategy.build_command_line(counters, testparms, dsconf0.windows_user,
@@ -1582,14 +1988,163 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
         else:
             command_line, script = strategy.build_command_line(counters)
 
-        command = SingleCommandClient(conn_info)
         self.start = time.mktime(time.localtime())
-        results = yield command.run_command(command_line, script)
+        results = yield self.run_command(dsconf0, conn_info, command_line, script)
 
         defer.returnValue((strategy, config.datasources, results))
 
+    def run_command(self, dsconf, conn_info, command_line, script):
+        """Run a command, PowerShell scripts in a persistent host if enabled."""
+        if script is not None and command_line.startswith('powershell') \
+                and getattr(dsconf, 'zWinShellKeepAlive', False):
+            return POWERSHELL_HOSTS.run(conn_info, script, self)
+        return SingleCommandClient(conn_info).run_command(command_line, script)
+
+    @coroutine
+    def collect_unified(self, config, conn_info):
+        """Collect datasources of all MSSQL strategies of an instance.
+
+        The scripts of the strategies run in sections of one script sharing
+        the SQL connection and assemblies, unless the command line limit
+        requires more. Returns a (strategy, dsconfs, result) triple for
+        each strategy, with the section of the strategy as result.
+        """
+        dsconf0 = config.datasources[0]
+        sql_connection, conn_info = self.getSQLConnection(dsconf0, conn_info)
+        conn_info = conn_info._replace(timeout=dsconf0.cycletime - 5)
+
+        strategies = collections.OrderedDict()
+        for dsconf in config.datasources:
+            strategies.setdefault(dsconf.params['strategy'], []).append(dsconf)
+        pending = []
+        for name, dsconfs in strategies.iteritems():
+            strategy = queryUtility(IStrategy, name)
+            pending.append((strategy, dsconfs, self.build_script_body(strategy, name, dsconfs)))
+
+        # A persistent host receives the script on stdin.
+        limit = None if getattr(dsconf0, 'zWinShellKeepAlive', False) else CMD_LINE_LIMIT
+        results = []
+        self.start = time.mktime(time.localtime())
+        while pending:
+            count, command_line, script = build_unified_command_line(
+                sql_connection, [body for _, _, body in pending], limit)
+            result = yield self.run_command(dsconf0, conn_info, command_line, script)
+            sections = split_sections(result, MSSQL_MARKER)[:count]
+            if not sections:
+                # The script failed before its first section.
+                sections = [result] * count
+            results.extend((strategy, dsconfs, section)
+                           for (strategy, dsconfs, _), section in zip(pending, sections))
+            pending = pending[len(sections):]
+
+        defer.returnValue(results)
+
+    def build_script_body(self, strategy, name, dsconfs):
+        """Return the script of a strategy run by collect_unified."""
+        if name == 'powershell MSSQL Instance':
+            owner_node, server = dsconfs[0].cluster_node_server.split('//')
+            if len(server.split('\\')) < 2:
+                return strategy.build_script_body('MSSQLSERVER')
+            return strategy.build_script_body(dsconfs[0].params['instancename'])
+        elif name == 'powershell MSSQL AO AG':
+            return strategy.build_script_body([
+                dsconf.params['contexttitle'] for dsconf in dsconfs if dsconf.params['contexttitle']])
+        elif name == 'powershell MSSQL AO AR':
+            return strategy.build_script_body([
+                dsconf.params['availability_group_name'] for dsconf in dsconfs
+                if dsconf.params['availability_group_name']])
+        elif name == 'powershell MSSQL AO ADB':
+            return strategy.build_script_body(
+                {dsconf.params['database_index'] for dsconf in dsconfs
+                 if dsconf.params['database_index'] is not None},
+                [dsconf.params['resource'] for dsconf in dsconfs])
+        elif name == 'powershell MSSQL':
+            return strategy.build_script_body(getattr(dsconfs[0], 'zWinMSSQLSetBasedCollection', False))
+        return strategy.build_script_body()
+
+    @coroutine
+    def collect_dcdiag(self, strategy, config, conn_info, tests):
+        """Run dcdiag in a process on the device and wait for its output.
+
+        The run is checked every DCDIAG_POLL_INTERVAL seconds for half of
+        the cycle time, after which the output is picked up by the next
+        cycle. Returns the output of the run as a result, or None.
+        """
+        dsconf0 = config.datasources[0]
+        testparms = [dsconf.params['script'] for dsconf in config.datasources if dsconf.params['script']]
+        dcdiagcommand = strategy.build_command_line(tests, testparms, dsconf0.windows_user,
+                                                    dsconf0.windows_password)
+        deadline = time.time() + dsconf0.cycletime / 2
+        self.start = time.mktime(time.localtime())
+        launch = True
+        while True:
+            command_line, script = strategy.build_async_command_line(dcdiagcommand, tests, launch)
+            result = yield self.run_command(dsconf0, conn_info, command_line, script)
+            states, output = strategy.parse_async_result(result, tests)
+            if output is not None:
+                defer.returnValue(output)
+            if 'FAILED' in states or (launch and not states):
+                raise WindowsShellException('Unable to start DCDiag: {0}'.format(
+                    ' '.join(result.stderr) or ', '.join(states)))
+            if 'KILLED' in states:
+                log.warn('%s: DCDiag ran for more than %d seconds and was stopped',
+                         config.id, DCDIAG_MAX_RUNTIME)
+            if not states & {'RUNNING', 'STARTED'} or time.time() + DCDIAG_POLL_INTERVAL > deadline:
+                defer.returnValue(None)
+            launch = False
+            yield deferLater(reactor, DCDIAG_POLL_INTERVAL, lambda: None)
+
+    @coroutine
+    def collect_batch(self, strategy, config, conn_info):
+        """Run custom commands of all datasources in batches.
+
+        Returns (dsconf, result) pairs, where result is the
+        WindowsShellException of an incorrect datasource.
+        """
+        results = []
+        pending = []
+        for dsconf in config.datasources:
+            try:
+                check_datasource(dsconf)
+            except WindowsShellException as e:
+                results.append((dsconf, e))
+            else:
+                pending.append(dsconf)
+
+        self.start = time.mktime(time.localtime())
+        while pending:
+            count, command_line, script = strategy.build_batch_command_line(
+                [dsconf.params['script'] for dsconf in pending])
+            result = yield self.run_command(config.datasources[0], conn_info, command_line, script)
+            sections = strategy.parse_batch_result(result)[:count]
+            if not sections:
+                # The batch failed before its first section.
+                sections = [result]
+            log.debug('%s: Custom Command batch ran %d of %d script(s)',
+                      config.id, len(sections), len(pending))
+            results.extend(zip(pending, sections))
+            pending = pending[len(sections):]
+
+        defer.returnValue(results)
+
     @save
     def onSuccess(self, results, config):
+        if not isinstance(results, list):
+            return self.parse_results(results, config)
+
+        # Results of the strategies of a unified MSSQL collection.
+        data = self.new_data()
+        for strategy, dsconfs, result in results:
+            strategy_config = copy.copy(config)
+            strategy_config.datasources = dsconfs
+            strategy_data = self.parse_results((strategy, dsconfs, result), strategy_config)
+            for component, values in strategy_data['values'].iteritems():
+                data['values'][component].update(values)
+            data['events'].extend(strategy_data['events'])
+            data['maps'].extend(strategy_data['maps'])
+        return data
+
+    def parse_results(self, results, config):
         elapsed = time.mktime(time.localtime()) - self.start
         log.debug('%s Shell query took %d seconds', config.id, elapsed)
         data = self.new_data()
@@ -1603,21 +2158,44 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
 
         strategy, dsconfs, result = results
         log.debug('results: {}'.format(result))
+        # Datasources to clear collection and configuration events for.
+        collected = [dsconf0]
         if strategy.key == 'CustomCommand':
-            cmdResult = strategy.parse_result(config, result)
-            data['events'] = cmdResult.events
-            if result.exit_code == 0:
-                dsconf = dsconfs[0]
-                for dp, value in cmdResult.values:
-                    data['values'][dsconf.component][dp.id] = value, 'N'
-            elif len(cmdResult.values) != 0:
-                dsconf = dsconfs[0]
-                for dp, value in cmdResult.values:
-                    data['values'][dsconf.component][dp.id] = value, 'N'
+            if isinstance(result, list):
+                # Results of batched custom commands.
+                collected = []
+                for dsconf, cmd_result in result:
+                    if isinstance(cmd_result, WindowsShellException):
+                        data['events'].append(dict(
+                            severity=ZenEventClasses.Warning,
+                            eventClass='/Status',
+                            eventKey='datasourceWarning_{0}'.format(dsconf.datasource),
+                            summary='WinRS: ShellDataSourcePlugin: {0} on {1}'.format(cmd_result, config.id),
+                            device=config.id))
+                        continue
+                    collected.append(dsconf)
+                    cmdResult = strategy.parse_result(config, cmd_result, dsconf)
+                    data['events'].extend(cmdResult.events)
+                    for dp, value in cmdResult.values:
+                        data['values'][dsconf.component][dp.id] = value, 'N'
+            else:
+                cmdResult = strategy.parse_result(config, result)
+                data['events'] = cmdResult.events
+                if result.exit_code == 0:
+                    dsconf = dsconfs[0]
+                    for dp, value in cmdResult.values:
+                        data['values'][dsconf.component][dp.id] = value, 'N'
+                elif len(cmdResult.values) != 0:
+                    dsconf = dsconfs[0]
+                    for dp, value in cmdResult.values:
+                        data['values'][dsconf.component][dp.id] = value, 'N'
         elif strategy.key == 'DCDiag':
-            diagResult = strategy.parse_result(config, result)
+            # No output while an asynchronous run is not finished.
+            if result is not None:
+                diagResult = strategy.parse_result(
+                    config, result, [dsconf.params['resource'] for dsconf in dsconfs])
+                data['events'] = diagResult.events
             dsconf = dsconfs[0]
-            data['events'] = diagResult.events
         elif strategy.key == 'MSSQLJob':
             diagResult = strategy.parse_result(dsconfs, result)
             dsconf = dsconfs[0]
@@ -1679,11 +2257,13 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
                     dsnames = set([dsconf.datasource for dsconf in dsconfs])
                     if 'status' in dsnames:
                         get_eventClass = get_valid_dsconf(dsconfs)
+                        self.dsconf_index = get_dsconf_index(
+                            self.dsconf_index, dsconfs, param='contexttitle')
                         for db in getattr(strategy, 'valuemap', []):
                             # only set if status is our only datasource
                             if not set('status').symmetric_difference(dsnames):
                                 checked_result = True
-                            dsconf = get_dsconf(dsconfs, db, param='contexttitle')
+                            dsconf = self.dsconf_index.get(db)
                             if dsconf:
                                 component = prepId(dsconf.component)
                                 eventClass = dsconf.eventClass or get_eventClass
@@ -1749,16 +2329,17 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
                     component=i,
                     device=config.id))
         else:
-            data['events'].append(dict(
-                severity=severity,
-                eventClass=dsconf0.eventClass or "/Status",
-                eventClassKey='winrsCollection',
-                eventKey='winrsCollection {}'.format(
-                    dsconf0.params['contexttitle']
-                ),
-                summary=msg,
-                component=dsconf0.component,
-                device=config.id))
+            for dsconf in collected:
+                data['events'].append(dict(
+                    severity=severity,
+                    eventClass=dsconf.eventClass or "/Status",
+                    eventClassKey='winrsCollection',
+                    eventKey='winrsCollection {}'.format(
+                        dsconf.params['contexttitle']
+                    ),
+                    summary=msg,
+                    component=dsconf.component,
+                    device=config.id))
 
         data['events'].append(dict(
             severity=ZenEventClasses.Clear,
@@ -1769,12 +2350,13 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
 
         # Clear warning events created for specific datasources,
         # e.g. when paster/script not chosen.
-        data['events'].append(dict(
-            severity=ZenEventClasses.Clear,
-            eventClassKey='winrsCollectionError',
-            eventKey='datasourceWarning_{0}'.format(dsconf0.datasource),
-            summary='Monitoring ok',
-            device=config.id))
+        for datasource in sorted(set(dsconf.datasource for dsconf in collected)):
+            data['events'].append(dict(
+                severity=ZenEventClasses.Clear,
+                eventClassKey='winrsCollectionError',
+                eventKey='datasourceWarning_{0}'.format(datasource),
+                summary='Monitoring ok',
+                device=config.id))
 
         # Clear previous error event
         data['events'].append(dict(
@@ -1820,6 +2402,10 @@ class ShellDataSourcePlugin(PythonDataSourcePlugin):
                 device=config.id))
         return data
 
+    def cleanup(self, config):
+        """Stop the PowerShell hosts no other task runs scripts in."""
+        return POWERSHELL_HOSTS.release(self)
+
 
 def check_datasource(dsconf):
     '''
@@ -1838,6 +2424,123 @@ def check_datasource(dsconf):
         )
 
 
+def command_line_text(arguments):
+    '''
+    Return the PowerShell code of -Command arguments on a command line.
+
+    Arguments are split as by CommandLineToArgvW and joined with spaces,
+    as powershell.exe does.
+    '''
+    args = []
+    arg = []
+    started = quoted = False
+    backslashes = 0
+    for char in arguments:
+        if char == '\\':
+            backslashes += 1
+            continue
+        if char == '"':
+            arg.append('\\' * (backslashes // 2))
+            if backslashes % 2:
+                arg.append('"')
+            else:
+                quoted = not quoted
+            started = True
+        elif char in ' \t' and not quoted:
+            arg.append('\\' * backslashes)
+            if started or ''.join(arg):
+                args.append(''.join(arg))
+            arg = []
+            started = False
+        else:
+            arg.append('\\' * backslashes + char)
+        backslashes = 0
+    arg.append('\\' * backslashes)
+    if started or ''.join(arg):
+        args.append(''.join(arg))
+    return ' '.join(args)
+
+
+def command_line_argument(text):
+    '''
+    Return text quoted as one argument of a command line.
+
+    The inverse of command_line_text for a single argument.
+    '''
+    text = re.sub(r'(\\*)"', lambda m: m.group(1) * 2 + '\\"', text)
+    return '"{}"'.format(re.sub(r'(\\+)$', r'\1\1', text))
+
+
+def build_unified_command_line(sql_connection, bodies, limit=None):
+    '''
+    Return the command line running the scripts of MSSQL strategies with
+    one SQL connection.
+
+    Returns the number of leading scripts the command runs, at least one,
+    and the command line and arguments as build_command_line.
+    '''
+    pscommand = "powershell -NoLogo -NonInteractive -NoProfile -OutputFormat TEXT -Command "
+    prefix = ''.join([BUFFER_SIZE] +
+                     getSQLAssembly(sql_connection.version) +
+                     sql_connection.sqlConnection)
+    length = len(pscommand) + len(prefix) + 5
+    sections = []
+    for index, body in enumerate(bodies):
+        section = SECTION.format(
+            marker=MSSQL_MARKER,
+            index=index,
+            script=SINGLE_QUOTES_RE.sub(r'\1\1', body))
+        length += len(section)
+        if limit and length > limit and sections:
+            break
+        sections.append(section)
+    return len(sections), pscommand, "\"& {{{}}}\"".format(prefix + ''.join(sections))
+
+
+def split_sections(result, marker):
+    '''
+    Return a ShellResult for each section delimited by marker in result.
+    '''
+    sections = []
+    section = None
+    for line in result.stdout:
+        if not line.startswith(marker):
+            if section is not None:
+                section.stdout.append(line)
+            continue
+        fields = line[len(marker) + 1:].split(' ', 2)
+        if len(fields) < 2:
+            continue
+        kind = fields[1]
+        if kind == 'BEGIN':
+            section = ShellResult()
+            section.stdout = []
+            section.stderr = []
+            section.exit_code = None
+            sections.append(section)
+        elif section is None:
+            continue
+        elif kind == 'ERR':
+            section.stderr.append(fields[2] if len(fields) > 2 else '')
+        elif kind == 'END':
+            try:
+                section.exit_code = int(fields[2])
+            except (IndexError, ValueError):
+                section.exit_code = 1
+            section = None
+    if section is not None:
+        section.exit_code = result.exit_code
+        section.stderr.extend(result.stderr)
+    return sections
+
+
+def is_batch(dsconf):
+    '''
+    Return True if the custom command of the datasource runs in a batch.
+    '''
+    return bool(dsconf.params['usePowershell'] and getattr(dsconf, 'zWinCustomCommandBatching', False))
+
+
 def parse_stdout(result, check_stderr=False):
     '''
     Get cmd result list with string elements separated by "|" inside,
@@ -0,0 +1,32 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2026, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Collector-side benchmarks.
+
+These are not collected as unit tests. Run them from a Zenoss
+environment, e.g.:
+
+    python -m ZenPacks.zenoss.Microsoft.Windows.tests.benchmarks.perfmon_parsing
+"""
+
+import timeit
+
+
+def best_of(func, number=10, repeat=5):
+    """Return the best time per call of func in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def report(title, results):
+    """Print a table of (name, seconds) pairs relative to the first one."""
+    print title
+    baseline = results[0][1]
+    for name, seconds in results:
+        print '  {:<40} {:>10.3f} ms {:>8.2f}x'.format(
+            name, seconds * 1000, baseline / seconds if seconds else 0)
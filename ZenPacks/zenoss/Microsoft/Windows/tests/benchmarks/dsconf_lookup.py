@@ -0,0 +1,80 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2026, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Benchmark datasource config lookup when routing results to components.
+
+Compares a get_dsconf scan per returned line with a reused DsconfIndex,
+and times ClusterDataSourcePlugin.onSuccess for a growing number of
+cluster resources to show it stays linear.
+
+    python -m ZenPacks.zenoss.Microsoft.Windows.tests.benchmarks.dsconf_lookup
+"""
+
+from ZenPacks.zenoss.Microsoft.Windows.datasources.ClusterDataSource import ClusterDataSourcePlugin
+from ZenPacks.zenoss.Microsoft.Windows.utils import get_dsconf, get_dsconf_index
+from . import best_of, report
+
+
+class DataSourceConfig(object):
+    datasource = 'ClusterState'
+    plugin_classname = ClusterDataSourcePlugin.__module__ + '.ClusterDataSourcePlugin'
+    eventClass = '/Status'
+    eventKey = 'clusterCollection'
+    severity = 3
+
+    def __init__(self, index):
+        self.component = 'resource{}'.format(index)
+        self.params = {
+            'contexttitle': self.component,
+            'ownernode': 'node1',
+            'cluster': 'cluster1',
+            'collector_timeout': 180,
+        }
+
+
+class Config(object):
+    id = 'cluster1'
+
+    def __init__(self, datasources):
+        self.datasources = datasources
+
+
+class Results(object):
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+
+def scan(config, components):
+    return sum(1 for c in components if get_dsconf(config.datasources, c, param='contexttitle'))
+
+
+def indexed(plugin, config, components):
+    plugin.dsconf_index = get_dsconf_index(plugin.dsconf_index, config.datasources, param='contexttitle')
+    return sum(1 for c in components if plugin.dsconf_index.get(c))
+
+
+def main():
+    for count in (100, 1000, 3000):
+        config = Config([DataSourceConfig(i) for i in xrange(count)])
+        components = [dsconf.component for dsconf in config.datasources]
+        results = Results(['{}|Online|{}|node1'.format(c, c) for c in components])
+        plugin = ClusterDataSourcePlugin()
+        assert scan(config, components) == indexed(plugin, config, components) == count
+        on_success = best_of(lambda: plugin.onSuccess(results, config), number=1)
+        report('Cluster resource lookup, {} resources:'.format(count), [
+            ('get_dsconf per line', best_of(lambda: scan(config, components), number=1)),
+            ('reused DsconfIndex', best_of(lambda: indexed(plugin, config, components), number=1)),
+            ('onSuccess with DsconfIndex', on_success),
+        ])
+        print '  onSuccess per resource: {:.1f} us'.format(on_success * 1e6 / count)
+
+
+if __name__ == '__main__':
+    main()
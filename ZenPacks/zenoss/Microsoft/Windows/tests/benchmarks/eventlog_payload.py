@@ -0,0 +1,141 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2026, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Benchmark the size and parsing of Windows EventLog payloads.
+
+Recorded payloads, the stdout of get_new_recent_entries saved to files,
+are rewritten as the script writes them for the fields and max message
+length of a datasource, then parsed by EventLogPlugin.parse_results.
+Without files, Security log logon events are generated. Time spent on
+the device formatting messages and translating SIDs is not measured.
+
+    python -m ZenPacks.zenoss.Microsoft.Windows.tests.benchmarks.eventlog_payload [EVENTS | FILE...]
+"""
+
+import json
+import sys
+
+from ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource import (
+    EventLogPlugin,
+    BatchResult,
+    EVENT_FIELDS,
+    iter_records,
+)
+from . import best_of, report
+
+LOGON_MESSAGE = (
+    'An account was successfully logged on.  Subject:  Security ID:  S-1-5-18  '
+    'Account Name:  SQLSRV02$  Account Domain:  SOLUTIONS-DEV  Logon ID:  0x3E7  '
+    'Logon Information:  Logon Type:  3  Restricted Admin Mode:  -  Virtual Account:  No  '
+    'Elevated Token:  Yes  Impersonation Level:  Impersonation  New Logon:  '
+    'Security ID:  S-1-5-21-3623811015-3361044348-30300820-{index}  Account Name:  svc{index}  '
+    'Account Domain:  SOLUTIONS-DEV  Logon ID:  0x{index:X}  Linked Logon ID:  0x0  '
+    'Network Account Name:  -  Network Account Domain:  -  '
+    'Logon GUID:  {{00000000-0000-0000-0000-000000000000}}  Process Information:  '
+    'Process ID:  0x2d4  Process Name:  C:\\Windows\\System32\\lsass.exe  '
+    'Network Information:  Workstation Name:  -  Source Network Address:  10.88.120.{octet}  '
+    'Source Port:  {port}  Detailed Authentication Information:  Logon Process:  Kerberos  '
+    'Authentication Package:  Kerberos  Transited Services:  -  Package Name (NTLM only):  -  '
+    'Key Length:  0  This event is generated when a logon session is created. '
+    'It is generated on the computer that was accessed.'
+)
+
+
+class DataSourceConfig(object):
+    severity = 3
+
+    def __init__(self, fields='', max_message_length='0'):
+        self.params = {
+            'eventlog': 'Security',
+            'eventid': 'Logons',
+            'max_events': '0',
+            'fields': fields,
+            'max_message_length': max_message_length,
+        }
+
+
+class Config(object):
+    id = 'sqlsrv02'
+
+    def __init__(self, dsconf):
+        self.datasources = [dsconf]
+
+
+def generate_records(num_events):
+    return [{
+        'EntryType': 'Information',
+        'TimeGenerated': '10/18/2026 09:{:02d}:{:02d}'.format(index / 60 % 60, index % 60),
+        'Source': 'Microsoft-Windows-Security-Auditing',
+        'InstanceId': '4624',
+        'Message': LOGON_MESSAGE.format(index=index, octet=index % 250, port=49152 + index % 16000),
+        'UserName': '',
+        'MachineName': 'SQLSRV02.solutions-dev.local',
+        'EventID': '4624',
+        'RecordId': str(1000000 + index),
+    } for index in xrange(num_events)]
+
+
+def read_records(filenames):
+    records = []
+    for filename in filenames:
+        with open(filename) as payload:
+            records.extend(iter_records(payload.read().splitlines()))
+    return records
+
+
+def write_payload(records, fields=None, max_message=0):
+    """Return the stdout of the script for records."""
+    lines = ['[']
+    for index, record in enumerate(records):
+        values = []
+        for name in (fields or EVENT_FIELDS) + ('RecordId',):
+            value = record.get(name, '')
+            if name == 'Message' and max_message:
+                value = value[:max_message]
+            values.append(u'"{}": {}'.format(name, json.dumps(value, ensure_ascii=False)))
+        lines.append((u',' if index else u'') + u'{' + u', '.join(values) + u'}')
+    lines.append(']')
+    return BatchResult([line.encode('utf-8') for line in lines], [], 0)
+
+
+def payload_size(result):
+    return sum(len(line) + 2 for line in result.stdout)
+
+
+def parse(result, config):
+    return len(EventLogPlugin().parse_results(result, config)['events'])
+
+
+def main(argv):
+    if argv and not argv[0].isdigit():
+        records = read_records(argv)
+    else:
+        records = generate_records(int(argv[0]) if argv else 20000)
+    without_message = tuple(f for f in EVENT_FIELDS if f != 'Message')
+    variants = [
+        ('all fields', DataSourceConfig(), write_payload(records)),
+        ('Message truncated to 256', DataSourceConfig(max_message_length='256'),
+         write_payload(records, max_message=256)),
+        ('without Message', DataSourceConfig(fields=','.join(without_message)),
+         write_payload(records, without_message)),
+        ('Source, InstanceId', DataSourceConfig(fields='Source,InstanceId'),
+         write_payload(records, ('Source', 'InstanceId'))),
+    ]
+    print 'Payload of {} events:'.format(len(records))
+    for name, dsconf, result in variants:
+        assert parse(result, Config(dsconf)) == len(records) + 2
+        print '  {:<40} {:>10} bytes'.format(name, payload_size(result))
+    report('EventLog parsing, {} events:'.format(len(records)), [
+        (name, best_of(lambda: parse(result, Config(dsconf)), number=1, repeat=3))
+        for name, dsconf, result in variants
+    ])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2026, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Benchmark parsing of MSSQL database status and counters.
+
+Compares the output of the SMO based script, a line per database status
+and counter, with the tab separated rows of the set-based T-SQL query,
+for a generated instance with thousands of databases. Both are parsed by
+PowershellMSSQLStrategy.parse_result for datasources of every database.
+Time spent on the instance to enumerate databases is not measured.
+
+    python -m ZenPacks.zenoss.Microsoft.Windows.tests.benchmarks.mssql_parsing [DATABASES]
+"""
+
+import sys
+
+from ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource import (
+    PowershellMSSQLStrategy,
+    ShellResult,
+)
+from . import best_of, report
+
+class DataSourceConfig(object):
+    device = 'sqlsrv02'
+
+    def __init__(self, resource, contexttitle):
+        self.params = {'resource': resource, 'contexttitle': contexttitle}
+
+
+COUNTERS = (
+    'Active Transactions',
+    'Data File(s) Size (KB)',
+    'Log Bytes Flushed/sec',
+    'Log File(s) Used Size (KB)',
+    'Transactions/sec',
+    'Write Transactions/sec',
+)
+
+
+def generate_result(num_databases):
+    """Return SMO and set-based results and datasources of databases."""
+    smo, tsv, dsconfs = ShellResult(), ShellResult(), []
+    smo.stdout, tsv.stdout = [], []
+    for index in xrange(num_databases):
+        name = 'database{}'.format(index)
+        smo.stdout.append('{} :counter: databasestatus :value: Normal'.format(name))
+        tsv.stdout.append('S\t{}\tNormal'.format(name))
+        dsconfs.append(DataSourceConfig('status', name))
+        for counter in COUNTERS:
+            # DMV values are padded to the width of the nchar columns.
+            smo.stdout.append('{}:counter:{}:value:{}'.format(
+                name.ljust(128), counter.ljust(128), index))
+            tsv.stdout.append('C\t{}\t{}\t{}'.format(name, counter, index))
+            dsconfs.append(DataSourceConfig(counter, name))
+    return smo, tsv, dsconfs
+
+
+def payload_size(result):
+    return sum(len(line) + 2 for line in result.stdout)
+
+
+def parse(result, dsconfs):
+    return len(list(PowershellMSSQLStrategy().parse_result(dsconfs, result)))
+
+
+def main(argv):
+    num_databases = int(argv[0]) if argv else 5000
+    smo, tsv, dsconfs = generate_result(num_databases)
+    assert parse(smo, dsconfs) == parse(tsv, dsconfs) == len(dsconfs)
+    print 'Payload of {} databases: SMO script {} bytes, set-based {} bytes'.format(
+        num_databases, payload_size(smo), payload_size(tsv))
+    report('MSSQL status and counters parsing, {} databases:'.format(num_databases), [
+        ('SMO script', best_of(lambda: parse(smo, dsconfs), number=1)),
+        ('set-based T-SQL', best_of(lambda: parse(tsv, dsconfs), number=1)),
+    ])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2026, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Benchmark Get-Counter Readings parsing in PerfmonDataSourcePlugin.
+
+Compares the previous deque based parsing of onReceive with the single
+pass iter_readings parser routed through a CounterIndex. Samples are either read from recorded
+Get-Counter output (one file per command, as returned by receive) or
+generated in the same Format-List layout. Generated samples are also
+compared with the compact output format, along with the payload size
+of the next sample once counter paths have been sent.
+
+    python -m ZenPacks.zenoss.Microsoft.Windows.tests.benchmarks.perfmon_parsing [FILE ...]
+"""
+
+import collections
+import io
+import sys
+
+from ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource import (
+    BOM,
+    CompactReadings,
+    CounterIndex,
+    counter_from_path,
+    format_stdout,
+    iter_readings,
+)
+from . import best_of, report
+
+HOST = u'sqlsrv02'
+OBJECTS = (
+    u'\\process({})\\% processor time',
+    u'\\network adapter({})\\bytes total/sec',
+    u'\\sqlserver:databases({})\\transactions/sec',
+    u'\\web service({})\\move requests/sec',
+    u'\\hyper-v hypervisor virtual processor({}:hv vp 0)\\% total run time',
+)
+
+
+def generate_sample(num_counters, num_commands=3):
+    """Return stdout line lists of one sample split across commands."""
+    counters = [
+        OBJECTS[i % len(OBJECTS)].format(u'instance number {}'.format(i))
+        for i in xrange(num_counters)]
+    outputs = []
+    for index in xrange(num_commands):
+        lines = [BOM]
+        for counter in counters[index::num_commands]:
+            lines.append(u'\\\\{}{} :'.format(HOST, counter))
+            lines.append(u'12345,678')
+        lines[1] = u'Readings : ' + lines[1]
+        outputs.append(lines)
+    return counters, outputs
+
+
+def generate_compact_sample(counters, num_commands=3):
+    """Return stdout line lists of the first and the next compact sample."""
+    first, following = [], []
+    for command in xrange(num_commands):
+        definitions = []
+        values = [u'{} 1519856886'.format(command)]
+        for index, counter in enumerate(counters[command::num_commands]):
+            definitions.append(u'#{} {} \\\\{}{}'.format(command, index, HOST, counter))
+            values.append(u'{}:12345.678'.format(index))
+        first.append(definitions + [u' '.join(values)])
+        following.append([u' '.join(values)])
+    return first, following
+
+
+def payload_size(outputs):
+    return sum(len(line.encode('utf-8')) + 2 for stdout in outputs for line in stdout)
+
+
+def load_sample(filenames):
+    """Return stdout line lists read from recorded Get-Counter output."""
+    outputs = []
+    for filename in filenames:
+        with io.open(filename, encoding='utf-8') as f:
+            outputs.append([line.strip() for line in f if line.strip()])
+    counters = [counter_from_path(path) for output in outputs for path, _ in iter_readings(output)]
+    return counters, outputs
+
+
+def legacy_parse(outputs, counter_map):
+    """Parsing as done by onReceive before iter_readings."""
+    results = []
+    for index, stdout in enumerate(outputs):
+        if index == 0:
+            results.extend(stdout)
+        else:
+            results.extend(format_stdout(stdout)[0])
+    stdout_lines, sample_start = format_stdout(results)
+    sample_buffer = collections.deque(stdout_lines)
+    routed = 0
+    while len(sample_buffer) > 1:
+        try:
+            counter = '\\{}'.format(
+                sample_buffer.popleft().strip(' :').split('\\', 3)[3]).decode('utf-8')
+            value = sample_buffer.popleft()
+            if ',' in value:
+                value = value.replace(',', '.', 1)
+            routed += len(counter_map.get(counter, ()))
+        except Exception:
+            pass
+    return routed
+
+
+def streaming_parse(outputs, counter_index):
+    """Parsing as done by onReceive with iter_readings."""
+    routed = 0
+    for stdout in outputs:
+        for path, value in iter_readings(stdout):
+            route = counter_index.get(path)
+            if route is not None:
+                routed += len(route.targets)
+    return routed
+
+
+def compact_parse(outputs, readings, counter_index):
+    """Parsing as done by onReceive with CompactReadings."""
+    routed = 0
+    for stdout in outputs:
+        for path, value in readings.decode(stdout):
+            route = counter_index.get(path)
+            if route is not None:
+                routed += len(route.targets)
+    return routed
+
+
+def main(argv):
+    if argv:
+        samples = [('recorded', load_sample(argv))]
+    else:
+        samples = [('{} counters'.format(n), generate_sample(n)) for n in (1000, 3000, 6000)]
+
+    for title, (counters, outputs) in samples:
+        counter_map = {counter: [(None, 'dp', None)] for counter in counters}
+        counter_index = CounterIndex(counter_map)
+        assert legacy_parse(outputs, counter_map) == streaming_parse(outputs, counter_index)
+        results = [
+            ('deque + format_stdout', best_of(lambda: legacy_parse(outputs, counter_map))),
+            ('iter_readings + CounterIndex', best_of(lambda: streaming_parse(outputs, counter_index))),
+        ]
+        if not argv:
+            first, following = generate_compact_sample(counters)
+            readings = CompactReadings()
+            assert compact_parse(first, readings, counter_index) == len(counters)
+            assert compact_parse(following, readings, counter_index) == len(counters)
+            results.append(('CompactReadings + CounterIndex',
+                            best_of(lambda: compact_parse(following, readings, counter_index))))
+            print 'Payload of a sample, {}: Readings {} bytes, compact {} bytes'.format(
+                title, payload_size(outputs), payload_size(following))
+        report('Get-Counter Readings parsing, {}:'.format(title), results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
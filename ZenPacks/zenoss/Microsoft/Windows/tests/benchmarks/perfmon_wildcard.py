@@ -0,0 +1,85 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2026, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Benchmark wildcard instance requests in PerfmonDataSourcePlugin.
+
+Compares the number and length of Get-Counter command lines needed for
+fully qualified counters with the ones needed for wildcard paths, and
+the time to route a sample of wildcard output, in which a part of the
+returned instances is not monitored.
+
+    python -m ZenPacks.zenoss.Microsoft.Windows.tests.benchmarks.perfmon_wildcard
+"""
+
+from ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource import (
+    BOM,
+    CounterIndex,
+    format_counters,
+    iter_readings,
+    pack_counters,
+    wildcard_counters,
+)
+from . import best_of, report
+
+HOST = u'sqlsrv02'
+# The limit left for counters by the Get-Counter command line.
+LIMIT = 7800
+COUNTERS = (
+    u'\\process({})\\% processor time',
+    u'\\process({})\\working set - private',
+    u'\\process({})\\io data bytes/sec',
+)
+
+
+def instance(i):
+    return u'w3wp application pool process number#{}'.format(i)
+
+
+def generate_output(num_instances):
+    """Return stdout lines of one wildcard sample."""
+    lines = [BOM]
+    for counter in COUNTERS:
+        for i in xrange(num_instances):
+            lines.append(u'\\\\{}{} :'.format(HOST, counter.format(instance(i))))
+            lines.append(u'12345,678')
+    lines[1] = u'Readings : ' + lines[1]
+    return lines
+
+
+def route(lines, counter_index):
+    routed = 0
+    for path, value in iter_readings(lines):
+        route = counter_index.get(path)
+        if route is not None:
+            routed += len(route.targets)
+    return routed
+
+
+def main():
+    for num_instances in (100, 300, 1000):
+        # A fifth of the instances on the host is not monitored.
+        monitored = num_instances * 4 // 5
+        counters = [counter.format(instance(i)) for counter in COUNTERS for i in xrange(monitored)]
+        wildcards = wildcard_counters(counters)
+        print '{} instances, {} monitored counters:'.format(num_instances, len(counters))
+        for title, requested in (('fully qualified', counters), ('wildcard', wildcards)):
+            groups = pack_counters(requested, LIMIT)
+            print '  {:<40} {:>4} command(s) {:>8} chars'.format(
+                title, len(groups), sum(len(format_counters(group)) for group in groups))
+
+        counter_index = CounterIndex({counter: [(None, 'dp', None)] for counter in counters})
+        lines = generate_output(num_instances)
+        assert route(lines, counter_index) == len(counters)
+        report('  Routing of a wildcard sample:', [
+            ('iter_readings + CounterIndex', best_of(lambda: route(lines, counter_index))),
+        ])
+
+
+if __name__ == '__main__':
+    main()
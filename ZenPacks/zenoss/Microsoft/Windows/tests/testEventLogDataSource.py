@@ -9,12 +9,20 @@
 ##############################################################################
 
 import Globals
-from mock import Mock, sentinel
+from mock import Mock, patch, sentinel
 import pprint
+import shutil
+import tempfile
+
+from twisted.internet.defer import Deferred, fail, succeed
 
 from Products.ZenTestCase.BaseTestCase import BaseTestCase
 
-from ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource import EventLogPlugin, EventLogInfo
+from ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource import (
+    EventLogPlugin, EventLogInfo, EventLogQuery, EventLogSubscription, BookmarkStore, split_markers, split_batch,
+    iter_records, get_fields, coalesce_events, COUNT_MARKER,
+    BOOKMARK_MARKER, EVENTLOG_MARKER)
+from ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource import CMD_LINE_LIMIT
 from ZenPacks.zenoss.Microsoft.Windows.tests.utils import load_pickle_file
 
 INFO_EXPECTED = {
@@ -102,10 +110,396 @@ class TestDataSourcePlugin(BaseTestCase):
             self.assertTrue(info.get_query())
 
 
+class TestEventLogBookmarks(BaseTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.store = BookmarkStore(self.path)
+
+    def test_store(self):
+        self.assertEquals(self.store.get('machine', 'Security', 'ds'), -1)
+        self.store.set('machine', 'Security', 'ds', 42)
+        # Changes are written every flush_interval seconds.
+        self.assertEquals(BookmarkStore(self.path).get('machine', 'Security', 'ds'), -1)
+        self.store.flushed -= self.store.flush_interval
+        self.store.set('machine', 'Security', 'ds', 43)
+        self.assertEquals(self.store.dirty, set())
+        self.assertEquals(BookmarkStore(self.path).get('machine', 'Security', 'ds'), 43)
+        self.assertEquals(BookmarkStore(self.path).get('machine', 'System', 'ds'), -1)
+
+    def test_store_invalid(self):
+        for saved in ('[42]', '{"Security": 42}'):
+            with open(self.store.filename('machine'), 'w') as bookmark_file:
+                bookmark_file.write(saved)
+            store = BookmarkStore(self.path)
+            self.assertEquals(store.get('machine', 'Security', 'ds'), -1)
+            store.set('machine', 'Security', 'ds', 42)
+            self.assertEquals(store.get('machine', 'Security', 'ds'), 42)
+
+    def test_cleanup(self):
+        self.store.set('machine', 'Security', 'ds', 42)
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.BOOKMARKS', self.store):
+            EventLogPlugin().cleanup(Mock(id='machine', datasources=[Mock(params={'eventid': 'ds'})]))
+        self.assertEquals(BookmarkStore(self.path).get('machine', 'Security', 'ds'), 42)
+
+    def test_split_markers(self):
+        self.assertEquals(split_markers(['{} 42'.format(BOOKMARK_MARKER), '[', ']']), (42, None, ['[', ']']))
+        self.assertEquals(split_markers(['[', ']']), (None, None, ['[', ']']))
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.SingleCommandClient')
+    def test_run(self, client):
+        query = EventLogQuery(Mock())
+        query.run('Security', '*', '24', 'ds', False, 42)
+        script = query.winrs.run_command.call_args[1]['ps_script']
+        self.assertIn('EventRecordID &gt; 42 and EventRecordID &lt;= {latest}', script)
+        self.assertIn('-bookmark 42 -query', script)
+        query.run('Security', '*', '24', 'ds', False)
+        script = query.winrs.run_command.call_args[1]['ps_script']
+        self.assertNotIn('EventRecordID', script)
+        self.assertIn('-bookmark $null -query', script)
+
+    def test_onSuccess(self):
+        config = Mock(id='machine', datasources=[Mock(params={'eventlog': 'Security', 'eventid': 'ds'},
+                                                      datasource='DataSource')])
+        results = Mock(stdout=['{} 42'.format(BOOKMARK_MARKER)], stderr=[])
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.BOOKMARKS', self.store):
+            res = EventLogPlugin().onSuccess(results, config)
+        self.assertEquals(res['events'][0]['summary'], 'Windows EventLog: successful event collection')
+        self.assertEquals(self.store.get('machine', 'Security', 'ds'), 42)
+
+
+class TestEventLogBatch(BaseTestCase):
+
+    def setUp(self):
+        patcher = patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.SingleCommandClient')
+        self.winrs = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.query = EventLogQuery(Mock())
+
+    def dsconf(self, eventid, eventlog, query_error=False):
+        return Mock(params={'eventlog': eventlog, 'eventid': eventid, 'query': '*', 'max_age': '24',
+                            'use_xml': False, 'query_error': query_error},
+                    datasource=eventid, zWinEventLogBookmarks=False, zWinEventLogBatching=True,
+                    zWinEventLogSubscription=False)
+
+    def test_build_batch(self):
+        queries = [('System', '*', '24', 'ds{}'.format(i), False, None) for i in range(100)]
+        count, script = self.query.build_batch(queries)
+        self.assertTrue(1 < count < 100)
+        self.assertLessEqual(len(EventLogQuery.PS_COMMAND) + len(script), CMD_LINE_LIMIT)
+        self.assertEquals(script.count('function sstring'), 1)
+        self.assertIn("'{} 0 BEGIN'".format(EVENTLOG_MARKER), script)
+        self.assertIn('-eventid \\"ds1\\"', script)
+
+    def test_split_batch(self):
+        result = Mock(stdout=[
+            '{} 0 BEGIN'.format(EVENTLOG_MARKER), '[', ']', '{} 0 END'.format(EVENTLOG_MARKER),
+            '{} 1 BEGIN'.format(EVENTLOG_MARKER),
+            '{} 1 ERR Get-WinEvent : No events were found'.format(EVENTLOG_MARKER),
+            '{} 1 END'.format(EVENTLOG_MARKER)])
+        sections = split_batch(result)
+        self.assertEquals([s.stdout for s in sections], [['[', ']'], []])
+        self.assertEquals([s.stderr for s in sections], [[], ['Get-WinEvent : No events were found']])
+
+    def test_onSuccess(self):
+        system, security, invalid = (self.dsconf('System', 'System'), self.dsconf('Security', 'Security'),
+                                     self.dsconf('Custom', 'Custom', query_error=True))
+        config = Mock(id='machine', datasources=[system, security, invalid])
+        self.winrs.run_command.return_value = succeed(Mock(stdout=[
+            '{} 0 BEGIN'.format(EVENTLOG_MARKER),
+            '[{"EntryType": "Error", "TimeGenerated": "", "Source": "Disk", "InstanceId": "7",',
+            '"Message": "Bad block.", "UserName": "", "MachineName": "machine", "EventID": "7"}]',
+            '{} 0 END'.format(EVENTLOG_MARKER),
+            '{} 1 BEGIN'.format(EVENTLOG_MARKER),
+            "{} 1 ERR Get-WinEvent : The specified channel could not be found.".format(EVENTLOG_MARKER),
+            '{} 1 END'.format(EVENTLOG_MARKER)], stderr=[]))
+        plugin = EventLogPlugin()
+        results = []
+        plugin.collect_batch(config, self.query).addCallback(results.extend)
+        self.assertEquals(self.winrs.run_command.call_count, 1)
+        res = plugin.onSuccess(results, config)
+        summaries = [e['summary'] for e in res['events']]
+        self.assertEquals(summaries[0], 'WindowsEventLog: failed collection. Please verify EventQuery on datasource Custom')
+        self.assertIn('Bad block', summaries)
+        self.assertIn('Windows EventLog: successful event collection', summaries)
+        self.assertIn("WindowsEventLog: Event Log 'Security' does not exist in machine", summaries)
+
+
+class TestEventLogParsing(BaseTestCase):
+
+    def record(self, record_id, message='Bad block.'):
+        return ('{"EntryType": "Error", "TimeGenerated": "", "Source": "Disk", "InstanceId": "7", '
+                '"Message": "%s", "UserName": "", "MachineName": "machine", "EventID": "7", '
+                '"RecordId": "%d"}' % (message, record_id))
+
+    def config(self, max_events='2'):
+        return Mock(id='machine', datasources=[Mock(
+            params={'eventlog': 'System', 'eventid': 'ds', 'max_events': max_events},
+            datasource='DataSource')])
+
+    def test_iter_records(self):
+        wrapped = self.record(2, 'x' * 50)
+        lines = ['[', self.record(1), ',' + wrapped[:60], wrapped[60:], ',' + self.record(3, '\xff'), ']']
+        records = list(iter_records(lines))
+        self.assertEquals([r['RecordId'] for r in records], ['1', '2', '3'])
+        self.assertEquals(records[2]['Message'], u'\ufffd')
+        self.assertEquals(list(iter_records(['[', ']'])), [])
+        self.assertEquals(len(list(iter_records(['[' + self.record(1) + ',' + self.record(2) + ']']))), 2)
+        with self.assertRaises(ValueError):
+            list(iter_records(['[', self.record(1)[:20]]))
+
+    def test_cap_deferred(self):
+        store = BookmarkStore(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, store.path)
+        results = Mock(stderr=[], stdout=[
+            '{} 90'.format(BOOKMARK_MARKER), '{} 5'.format(COUNT_MARKER),
+            '[', self.record(11), ',' + self.record(12), ']'])
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.BOOKMARKS', store):
+            res = EventLogPlugin().onSuccess(results, self.config())
+        self.assertEquals(len([e for e in res['events'] if e.get('ntevid') == u'7']), 2)
+        summary = [e for e in res['events'] if e.get('eventKey') == 'WindowsEventCollection: ds'][0]
+        self.assertEquals(summary['summary'], 'Windows EventLog: 3 of 5 events of System deferred to the next collection')
+        self.assertEquals(summary['severity'], 3)
+        self.assertEquals(store.get('machine', 'System', 'ds'), 12)
+
+    def test_cap_dropped(self):
+        results = Mock(stderr=[], stdout=['[', self.record(11, '11'), ',' + self.record(12, '12'),
+                                          ',' + self.record(13, '13'), ']'])
+        res = EventLogPlugin().onSuccess(results, self.config())
+        self.assertEquals(len([e for e in res['events'] if e.get('ntevid') == u'7']), 2)
+        summary = [e for e in res['events'] if e.get('eventKey') == 'WindowsEventCollection: ds'][0]
+        self.assertEquals(summary['summary'],
+                          'Windows EventLog: 1 of 3 events of System dropped, the newest 2 were collected')
+        self.assertEquals([e['message'] for e in res['events'] if e.get('ntevid') == u'7'],
+                          ['12', '13'])
+        res = EventLogPlugin().onSuccess(results, self.config(max_events='0'))
+        self.assertEquals(len([e for e in res['events'] if e.get('ntevid') == u'7']), 3)
+
+
+class TestEventLogProjection(BaseTestCase):
+
+    def setUp(self):
+        patcher = patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.SingleCommandClient')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query = EventLogQuery(Mock())
+
+    def test_get_fields(self):
+        self.assertIsNone(get_fields(Mock(params={'fields': ''})))
+        self.assertIsNone(get_fields(Mock(params={})))
+        self.assertEquals(get_fields(Mock(params={'fields': 'source, instanceid,EntryType bogus'})),
+                          ('EntryType', 'Source', 'InstanceId'))
+
+    def test_call(self):
+        call = self.query.call('Security', '*', '24', 'ds', False)
+        self.assertIn('-fields $null -max_message 0 -translate $true -reader $false', call)
+        call = self.query.call('Security', '*', '24', 'ds', False, None, 0, ('Source', 'InstanceId'), 0, False)
+        self.assertIn("-fields @('Source','InstanceId') -max_message 0 -translate $false -reader $true", call)
+        # Messages are formatted by Get-WinEvent for PowerShell selectors.
+        call = self.query.call('Security', '{$_.Id -eq 4625}', '24', 'ds', False, None, 0, ('Source',))
+        self.assertIn('-reader $false', call)
+        call = self.query.call('Security', '*', '24', 'ds', False, None, 0, ('Source', 'Message'), 200)
+        self.assertIn('-max_message 200 -translate $true -reader $false', call)
+
+    def test_onSuccess(self):
+        config = Mock(id='machine', datasources=[Mock(
+            params={'eventlog': 'Security', 'eventid': 'ds', 'fields': 'Source,InstanceId'},
+            datasource='DataSource')])
+        results = Mock(stderr=[], stdout=['[{"Source": "Microsoft-Windows-Security-Auditing", '
+                                          '"InstanceId": "4625", "RecordId": "7"}]'])
+        evt = EventLogPlugin().onSuccess(results, config)['events'][0]
+        self.assertEquals(evt['eventClassKey'], 'Microsoft-Windows-Security-Auditing_4625')
+        self.assertEquals(evt['summary'], 'Microsoft-Windows-Security-Auditing event 4625')
+        self.assertEquals(evt['message'], '')
+        self.assertEquals(evt['severity'], 2)
+
+    def test_onSuccess_unicode(self):
+        config = Mock(id='machine', datasources=[Mock(
+            params={'eventlog': u'S\xe9curit\xe9', 'eventid': 'ds', 'fields': 'InstanceId'},
+            datasource='DataSource')])
+        results = Mock(stderr=[], stdout=['[{"InstanceId": "4625", "RecordId": "7"}]'])
+        evt = EventLogPlugin().onSuccess(results, config)['events'][0]
+        self.assertEquals(evt['summary'], u'S\xe9curit\xe9 event 4625')
+
+
+class TestEventLogSubscription(BaseTestCase):
+
+    def setUp(self):
+        for name in ('SingleCommandClient', 'LongCommandClient'):
+            patcher = patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.subscriptions = {}
+        patcher = patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.SUBSCRIPTIONS',
+                        self.subscriptions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query = EventLogQuery(Mock())
+        self.sections = []
+        self.subscription = EventLogSubscription(Mock(), 'script', 42, self.sections.append)
+        self.command = self.subscription.command
+        self.command.start.return_value = succeed(('shell', 'command'))
+
+    def response(self, *stdout):
+        return succeed(Mock(stdout=list(stdout), stderr=[], exit_code=None))
+
+    def test_subscribe(self):
+        script = self.query.subscribe('Security', '*', '24', 'ds', False, 42)
+        self.assertIn('$bookmark = 42; while ($true)', script)
+        self.assertIn('-bookmark $bookmark -query', script)
+        self.assertIn('EventRecordID &gt; {bookmark} and EventRecordID &lt;= {latest}', script)
+        self.assertIn("'{} 0 BEGIN'".format(EVENTLOG_MARKER), script)
+        self.assertIn('Start-Sleep -Seconds 5', script)
+        self.assertLessEqual(len(EventLogQuery.PS_COMMAND) + len(script), CMD_LINE_LIMIT)
+
+    def test_receive(self):
+        self.command.receive.side_effect = [
+            self.response('{} 0 BEGIN'.format(EVENTLOG_MARKER), '{} 50'.format(BOOKMARK_MARKER), '['),
+            self.response(']', '{} 0 END'.format(EVENTLOG_MARKER)),
+            fail(Exception('a WS-Man OperationTimeout fault')),
+            Deferred()]
+        self.subscription.start()
+        self.assertTrue(self.subscription.running)
+        self.assertEquals(self.command.receive.call_count, 4)
+        self.assertEquals(len(self.sections), 1)
+        self.assertEquals(self.sections[0].stdout, ['{} 50'.format(BOOKMARK_MARKER), '[', ']'])
+        self.assertEquals(self.subscription.bookmark, 50)
+
+    def test_receive_failure(self):
+        self.command.receive.return_value = fail(Exception('invalid selectors for the resource'))
+        self.command.stop.return_value = succeed(None)
+        self.subscription.start()
+        self.assertFalse(self.subscription.running)
+        self.assertEquals(self.subscription.error.message, 'invalid selectors for the resource')
+        self.command.stop.assert_called_with(('shell', 'command'))
+
+    def test_exit(self):
+        self.command.receive.return_value = succeed(Mock(stdout=[], stderr=[], exit_code=1))
+        self.command.stop.return_value = succeed(None)
+        self.subscription.start()
+        self.assertFalse(self.subscription.running)
+        self.assertIsNone(self.subscription.error)
+        self.command.stop.assert_called_once_with(('shell', 'command'))
+
+    def test_collect_subscription(self):
+        dsconf = Mock(params={'eventlog': 'System', 'eventid': 'ds', 'query': '*', 'max_age': '24',
+                              'use_xml': False, 'query_error': False},
+                      datasource='DataSource', zWinEventLogSubscription=True)
+        config = Mock(id='machine', datasources=[dsconf])
+        store = BookmarkStore(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, store.path)
+        plugin = EventLogPlugin()
+        self.query.winrs.run_command.return_value = succeed(Mock(stdout=['{} 42'.format(BOOKMARK_MARKER)], stderr=[]))
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.BOOKMARKS', store):
+            # The latest EventRecordID is not known yet.
+            results = []
+            plugin.collect_subscription(config, self.query).addCallback(results.extend)
+            self.assertIsNone(plugin.subscription)
+            plugin.onSuccess(results, config)
+            plugin.collect_subscription(config, self.query)
+        self.assertTrue(plugin.subscription.running)
+        self.assertEquals(plugin.subscription.bookmark, 42)
+        self.assertIn('$bookmark = 42;', plugin.subscription.command.start.call_args[1]['ps_script'])
+
+        event_service = Mock()
+        result = Mock(stdout=['[{"EntryType": "Error", "Source": "Disk", "InstanceId": "7", '
+                              '"Message": "Bad block.", "RecordId": "43"}]'], stderr=[])
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.queryUtility',
+                   return_value=event_service), \
+                patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.BOOKMARKS', store):
+            plugin.onSubscriptionResult(result, config)
+        self.assertIn('Bad block', [c[0][0].get('summary') for c in event_service.sendEvent.call_args_list])
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.queryUtility',
+                   return_value=None):
+            plugin.onSubscriptionResult(result, config)
+        results = []
+        plugin.collect_subscription(config, self.query).addCallback(results.extend)
+        self.assertEquals(results, [(dsconf, result)])
+        self.assertEquals(self.subscriptions, {'machine': set(['ds'])})
+        plugin.subscription.command.stop.return_value = succeed(None)
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.BOOKMARKS', store):
+            plugin.cleanup(config)
+        self.assertEquals(self.subscriptions, {})
+
+    def test_collect_subscription_limit(self):
+        dsconf = Mock(params={'eventlog': 'System', 'eventid': 'ds', 'query': '*', 'max_age': '24',
+                              'use_xml': False, 'query_error': False},
+                      datasource='DataSource', zWinEventLogSubscription=True)
+        config = Mock(id='machine', datasources=[dsconf])
+        self.subscriptions['machine'] = set('ds{}'.format(i) for i in xrange(5))
+        store = BookmarkStore(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, store.path)
+        store.set('machine', 'System', 'ds', 42)
+        plugin = EventLogPlugin()
+        self.query.winrs.run_command.return_value = succeed(Mock(stdout=['{} 50'.format(BOOKMARK_MARKER)], stderr=[]))
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.EventLogDataSource.BOOKMARKS', store):
+            results = []
+            plugin.collect_subscription(config, self.query).addCallback(results.extend)
+        # Polled while the device runs 5 other subscriptions.
+        self.assertIsNone(plugin.subscription)
+        self.assertEquals(len(results), 1)
+        self.assertEquals(len(self.subscriptions['machine']), 5)
+
+
+class TestEventLogCoalescing(BaseTestCase):
+
+    def record(self, record_id, source='Disk', message='Bad block.'):
+        return ('{"EntryType": "Error", "TimeGenerated": "10/18/2026 09:00:%02d", "Source": "%s", '
+                '"InstanceId": "7", "Message": "%s", "UserName": "", "MachineName": "machine", '
+                '"EventID": "7", "RecordId": "%d"}' % (record_id, source, message, record_id))
+
+    def config(self, threshold):
+        return Mock(id='machine', datasources=[Mock(
+            params={'eventlog': 'System', 'eventid': 'ds'}, datasource='DataSource',
+            zWinEventLogCoalesceThreshold=threshold)])
+
+    def test_coalesce_events(self):
+        events = [{'component': c, 'ntevid': '7', 'severity': 4, 'summary': s, 'message': s,
+                   'originaltime': str(t)} for t, (c, s) in enumerate(
+                       [('Disk', 'a'), ('Ntfs', 'a'), ('Disk', 'a'), ('Disk', 'b'), ('Disk', 'a')])]
+        self.assertEquals(coalesce_events(events, 0), events)
+        coalesced = coalesce_events(events, 3)
+        self.assertEquals([(e['component'], e['summary']) for e in coalesced],
+                          [('Disk', 'a'), ('Ntfs', 'a'), ('Disk', 'b')])
+        self.assertEquals(coalesced[0]['occurrences'], 3)
+        self.assertEquals(coalesced[0]['first_originaltime'], '0')
+        self.assertEquals(coalesced[0]['last_originaltime'], '4')
+        self.assertEquals(coalesced[0]['message'], 'a\n\nLogged 3 times from 0 to 4.')
+        self.assertNotIn('occurrences', coalesced[1])
+
+    def test_onSuccess(self):
+        records = [self.record(i) for i in range(1, 6)] + [self.record(6, 'Ntfs')]
+        results = Mock(stderr=[], stdout=['[', ',\n'.join(records), ']'])
+        res = EventLogPlugin().onSuccess(results, self.config(5))
+        events = [e for e in res['events'] if e.get('ntevid') == u'7']
+        self.assertEquals([e['component'] for e in events], ['Disk', 'Ntfs'])
+        self.assertEquals(events[0]['occurrences'], 5)
+        self.assertEquals(events[0]['originaltime'], '10/18/2026 09:00:05')
+        res = EventLogPlugin().onSuccess(results, self.config(0))
+        self.assertEquals(len([e for e in res['events'] if e.get('ntevid') == u'7']), 6)
+
+    def test_onSuccess_unicode(self):
+        records = [self.record(i, message='Le disque \\u00ab C: \\u00bb est d\\u00e9fectueux.') for i in range(1, 4)]
+        results = Mock(stderr=[], stdout=['[', ',\n'.join(records), ']'])
+        res = EventLogPlugin().onSuccess(results, self.config(3))
+        events = [e for e in res['events'] if e.get('ntevid') == u'7']
+        self.assertEquals(len(events), 1)
+        self.assertEquals(events[0]['message'],
+                          u'Le disque \xab C: \xbb est d\xe9fectueux.\n\n'
+                          u'Logged 3 times from 10/18/2026 09:00:01 to 10/18/2026 09:00:03.')
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestDataSourcePlugin))
+    suite.addTest(makeSuite(TestEventLogBookmarks))
+    suite.addTest(makeSuite(TestEventLogBatch))
+    suite.addTest(makeSuite(TestEventLogParsing))
+    suite.addTest(makeSuite(TestEventLogProjection))
+    suite.addTest(makeSuite(TestEventLogSubscription))
+    suite.addTest(makeSuite(TestEventLogCoalescing))
     return suite
 
 
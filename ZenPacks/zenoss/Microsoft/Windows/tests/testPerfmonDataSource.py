@@ -11,19 +11,37 @@
 ##############################################################################
 
 import Globals
+import random
+import shutil
+import tempfile
+import time
 from itertools import repeat
 from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed, fail
 
 from Products.ZenTestCase.BaseTestCase import BaseTestCase
 from ZenPacks.zenoss.Microsoft.Windows.tests.mock import sentinel, patch, Mock
 from ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource import (
     format_stdout,
     format_counters,
+    pack_counters,
+    wildcard_counters,
+    is_sample_start,
+    iter_readings,
+    CompactReadings,
+    counter_from_path,
+    CounterIndex,
+    PerfmonSessionManager,
+    CounterStateStore,
+    CorruptCounterSearch,
+    StartScheduler,
+    PipelineStats,
+    BOM,
     DataPersister,
     counter_returned,
     PerfmonDataSourcePlugin,
+    PluginStates,
     Failure,
     RequestError
 )
@@ -44,6 +62,208 @@ class Config(namedtuple('Config', ['id'])):
     pass
 
 
+class TestPerfmonSessionManager(BaseTestCase):
+    def setUp(self):
+        self.manager = PerfmonSessionManager()
+
+    def plugin(self, unique_id, cycletime, counters):
+        plugin = Mock(unique_id=unique_id, cycletime=cycletime, session=None)
+        plugin.config.datasources = [sentinel.dsconf]
+        plugin.ps_counter_map = dict.fromkeys(counters, [])
+        return plugin
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.session_key', lambda dsconf: ('host',))
+    def test_join(self):
+        first = self.plugin('a_300', 300, ['\\a', '\\b'])
+        second = self.plugin('a_120', 120, ['\\b', '\\c'])
+        session = first.session = self.manager.join(first)
+        self.assertIs(self.manager.join(second), session)
+        self.assertIs(session.owner, first)
+        self.assertEquals(session.version, 2)
+        self.assertEquals(session.counters(), ['\\a', '\\b', '\\c'])
+        self.assertEquals(session.sample_interval(), 60)
+        # Joining again with the same instance does not change the session.
+        self.manager.join(first)
+        self.assertEquals(session.version, 2)
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.session_key', lambda dsconf: ('host',))
+    def test_leave(self):
+        first = self.plugin('a_300', 300, ['\\a'])
+        second = self.plugin('a_120', 120, ['\\b'])
+        session = first.session = self.manager.join(first)
+        second.session = self.manager.join(second)
+        self.manager.leave(first)
+        self.assertIsNone(first.session)
+        self.assertIs(session.owner, second)
+        self.assertEquals(session.counters(), ['\\b'])
+        self.manager.leave(second)
+        self.assertEquals(self.manager.sessions, {})
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.session_key', lambda dsconf: None)
+    def test_join_without_key(self):
+        self.assertIsNone(self.manager.join(self.plugin('a_300', 300, ['\\a'])))
+
+
+class TestCounterStateStore(BaseTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_save(self):
+        store = CounterStateStore(self.path)
+        store.add('device', 'good', ['\\a', '\\b'])
+        store.add('device', 'corrupt', ['\\b'])
+        store.save('device')
+        store = CounterStateStore(self.path)
+        self.assertEquals(store.corrupt('device'), ['\\b'])
+        self.assertEquals(store.good('device'), set(['\\a']))
+
+    def test_ttl(self):
+        store = CounterStateStore(self.path, ttl=60)
+        store.add('device', 'corrupt', ['\\a', '\\b'])
+        store.get('device')['corrupt']['\\a'] = time.time() - 61
+        self.assertEquals(store.corrupt('device'), ['\\b'])
+
+
+class TestCorruptCounterSearch(BaseTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = CounterStateStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def search(self, counters, corrupt, parallel=4):
+        def probe(group):
+            return succeed(not set(group) & set(corrupt))
+        searcher = CorruptCounterSearch(probe, self.store, 'device', parallel)
+        result = []
+        searcher.search(counters).addCallback(result.extend)
+        return sorted(result), searcher.probes
+
+    def test_search(self):
+        counters = ['\\counter{:04}'.format(i) for i in xrange(2000)]
+        corrupt = [counters[7], counters[1000], counters[1999]]
+        found, probes = self.search(counters, corrupt)
+        self.assertEquals(found, corrupt)
+        self.assertEquals(self.store.corrupt('device'), corrupt)
+        self.assertEquals(len(self.store.good('device')), 1997)
+        self.assertTrue(probes < 100)
+
+    def test_inconclusive(self):
+        searcher = CorruptCounterSearch(lambda group: succeed(None), self.store, 'device')
+        result = []
+        searcher.search(['\\a', '\\b']).addCallback(result.extend)
+        self.assertEquals(result, [])
+        self.assertEquals(self.store.good('device'), set())
+
+
+class TestStartScheduler(BaseTestCase):
+    def test_limit(self):
+        scheduler = StartScheduler(limit=2)
+        starts = [Deferred() for _ in xrange(3)]
+        results = []
+        for d in starts:
+            scheduler.run(lambda d=d: d).addCallback(results.append)
+        self.assertEquals(scheduler.stats()['queued'], 1)
+        self.assertEquals(scheduler.active, 2)
+        starts[0].callback(0)
+        self.assertEquals(scheduler.stats()['queued'], 0)
+        self.assertEquals(scheduler.stats()['waited'], 1)
+        starts[1].callback(1)
+        starts[2].callback(2)
+        self.assertEquals(results, [0, 1, 2])
+        self.assertEquals(scheduler.active, 0)
+
+    def test_configure(self):
+        scheduler = StartScheduler(limit=1)
+        first, second = Deferred(), Deferred()
+        scheduler.run(lambda: first)
+        scheduler.run(lambda: second)
+        self.assertEquals(scheduler.stats()['queued'], 1)
+        # The lowest non-zero limit of the tasks applies.
+        scheduler.configure('task2', 3)
+        scheduler.configure('task3', 2)
+        scheduler.configure('task1', 0)
+        self.assertEquals(scheduler.limit, 2)
+        self.assertEquals(scheduler.stats()['queued'], 0)
+        self.assertEquals(scheduler.active, 2)
+        scheduler.configure('task3', 4)
+        self.assertEquals(scheduler.limit, 3)
+        scheduler.unconfigure('task2')
+        self.assertEquals(scheduler.limit, 4)
+        scheduler.unconfigure('task3')
+        self.assertEquals(scheduler.limit, 0)
+
+    def test_jitter(self):
+        scheduler = StartScheduler()
+        delays = [scheduler.jitter('device{}_300__'.format(i), 300) for i in xrange(100)]
+        self.assertEquals(delays, [scheduler.jitter('device{}_300__'.format(i), 300) for i in xrange(100)])
+        self.assertTrue(all(0 <= delay < 300 for delay in delays))
+        self.assertTrue(len(set(delays)) > 90)
+        self.assertEquals(scheduler.jitter('device', 0), 0)
+
+    def plugin_simplified_init(datasource, config):
+        datasource.config = config
+        datasource.unique_id = 'device_300__'
+        datasource.state = PluginStates.STOPPED
+        datasource.cycling = True
+        datasource.sample_interval = 300
+        datasource.compact_readings = None
+        datasource.commandlines = ['line0']
+        datasource.complex_command = Mock()
+        datasource.complex_command.start.return_value = succeed([])
+        datasource.complex_command.stop.return_value = succeed(None)
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.START_SCHEDULER', StartScheduler())
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.reactor')
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_delayed_start(self, reactor):
+        plugin = PerfmonDataSourcePlugin(Mock(id='device'))
+        d = plugin.start()
+        # The first start is scheduled and collect goes on, with or
+        # without a limit of concurrent starts.
+        self.assertTrue(d.called)
+        self.assertEquals(reactor.callLater.call_args[0][1], plugin.start)
+        self.assertFalse(plugin.complex_command.start.called)
+        reactor.callLater.return_value.active.return_value = True
+        plugin.start()
+        self.assertEquals(reactor.callLater.call_count, 1)
+        self.assertFalse(plugin.complex_command.start.called)
+        reactor.callLater.return_value.active.return_value = False
+        plugin.start()
+        plugin.complex_command.start.assert_called_once_with(['line0'])
+
+
+class TestPipelineStats(BaseTestCase):
+    def test_values(self):
+        stats = PipelineStats()
+        stats.record_receive(0.5, [[u'0 1519856886 0:1'], [u'#1 0 a', u'1 1519856886 0:3']])
+        stats.record_receive(1.5, [])
+        stats.record_restart()
+        stats.record_search(4)
+        values = stats.values(3, 12)
+        self.assertEquals(values['receives'], 2)
+        self.assertEquals(values['receiveTime'], 1000.0)
+        self.assertEquals(values['receiveLines'], 3)
+        self.assertEquals(values['activeShells'], 3)
+        self.assertEquals(values['restartsPerHour'], 1)
+        self.assertEquals(values['corruptProbes'], 4)
+        self.assertEquals(values['bufferedSamples'], 12)
+        self.assertNotIn('sampleLag', values)
+        values = stats.values(3, 12)
+        self.assertEquals(values['receives'], 0)
+        self.assertEquals(values['receiveTime'], 0.0)
+        self.assertEquals(values['restartsPerHour'], 1)
+
+    def test_restarts_expire(self):
+        stats = PipelineStats()
+        stats.restarts.extend([time.time() - 7200, time.time() - 3000])
+        self.assertEquals(stats.values(0, 0)['restartsPerHour'], 1)
+
+
 class TestDataPersister(BaseTestCase):
     def setUp(self):
         self.dp = DataPersister()
@@ -51,9 +271,23 @@ class TestDataPersister(BaseTestCase):
 
     def test_maintenance(self):
         self.dp.devices[sentinel.device0]['last'] = 0
+        self.dp.devices[sentinel.device0]['expiry'] = 0
+        self.dp.expiry = [(0, sentinel.device0)]
         self.dp.maintenance()
         self.assertEquals(len(self.dp.devices), 0)
 
+    def test_maintenance_touched(self):
+        later = time.time() + self.dp.max_data_age + 1
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.time') as mock_time:
+            mock_time.time.return_value = later - 1
+            self.dp.touch(sentinel.device0)
+            self.dp.touch(sentinel.device1)
+            mock_time.time.return_value = later + self.dp.max_data_age
+            self.dp.touch(sentinel.device1)
+            self.dp.maintenance()
+        self.assertEquals(self.dp.devices.keys(), [sentinel.device1])
+        self.assertEquals(len(self.dp.expiry), 1)
+
     def test_touch(self):
         for _ in repeat(None, 2):
             self.dp.touch(sentinel.device1)
@@ -84,16 +318,50 @@ class TestDataPersister(BaseTestCase):
         self.dp.add_event(sentinel.device0, [datasources], event0)
         self.assertEquals(len(self.dp.devices[sentinel.device0]['events']), 1)
 
+    def test_add_event_bounded(self):
+        self.dp.max_events = 3
+        datasources = [DataSource('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource',
+                                  'test_add_event')]
+        for key, severity in (('a', 0), ('b', 3), ('c', 3), ('d', 0), ('e', 3)):
+            self.dp.add_event(sentinel.device0, datasources, {
+                'device': 'device', 'eventKey': key, 'severity': severity, 'summary': key})
+        events = self.dp.devices[sentinel.device0]['events']
+        # The oldest events other than Clear events are dropped first.
+        self.assertEquals([event['eventKey'] for event in events], ['a', 'd', 'e'])
+        self.assertEquals(self.dp.dropped_events, 2)
+        for key in 'fgh':
+            self.dp.add_event(sentinel.device0, datasources, {
+                'device': 'device', 'eventKey': key, 'severity': 0, 'summary': key})
+        self.assertEquals([event['eventKey'] for event in events], ['f', 'g', 'h'])
+        self.assertEquals(self.dp.dropped_events, 5)
+
     def test_add_value(self):
         self.dp.add_value(sentinel.device0,
                           sentinel.component0,
                           sentinel.datasource0,
                           sentinel.value0,
                           sentinel.collect_time0)
-        self.assertEquals(self.dp.devices[sentinel.device0]['values']
+        self.assertEquals(self.dp.get(sentinel.device0)['values']
                           [sentinel.component0][sentinel.datasource0],
                           (sentinel.value0, sentinel.collect_time0))
 
+    def test_add_value_bounded(self):
+        for i in xrange(10):
+            self.dp.add_value(sentinel.device0, sentinel.component0, sentinel.datasource0, i, i)
+        self.assertEquals(self.dp.get(sentinel.device0)['values'][sentinel.component0][sentinel.datasource0],
+                          (9, 9))
+        self.assertEquals(self.dp.count(sentinel.device0), 1)
+
+    def test_stats(self):
+        self.dp.add_value(sentinel.device0, sentinel.component0, sentinel.datasource0, 1, 1)
+        self.dp.add_value(sentinel.device0, sentinel.component0, sentinel.datasource1, 1, 1)
+        stats = self.dp.stats()
+        self.assertEquals(stats['devices'], 1)
+        self.assertEquals(stats['samples'], 2)
+        self.assertTrue(stats['bytes'] > 0)
+        self.assertEquals(self.dp.count(sentinel.device0), 2)
+        self.assertEquals(self.dp.count(sentinel.device1), 0)
+
     def test_pop(self):
         d0 = self.dp.pop(sentinel.device0)
         self.assertEquals(d0['maps'], [])
@@ -112,6 +380,186 @@ class TestFormat_stdout(BaseTestCase):
         self.assertEquals(format_stdout(["Readings : "]), ([""], True))
 
 
+class TestPackCounters(BaseTestCase):
+    def setUp(self):
+        rnd = random.Random(42)
+        self.counters = [
+            u'\\sqlserver$instance{}(database {})\\log bytes flushed/sec{}'.format(
+                i, u'x' * rnd.randint(0, 300), u'\u2019' * rnd.randint(0, 3))
+            for i in xrange(500)]
+
+    def assertFits(self, groups, limit):
+        for group in groups:
+            self.assertTrue(len(format_counters(group)) <= limit or len(group) == 1)
+
+    def test_limit(self):
+        for limit in (500, 2000, 7700):
+            groups = pack_counters(self.counters, limit)
+            self.assertFits(groups, limit)
+            self.assertEquals(sorted(sum(groups, [])), sorted(self.counters))
+
+    def test_minimum(self):
+        groups = pack_counters(self.counters, 7700)
+        # Groups are filled close to the limit.
+        lower_bound = len(format_counters(self.counters)) // 7700 + 1
+        self.assertTrue(len(groups) <= lower_bound + 1)
+
+    def test_oversized_counter(self):
+        groups = pack_counters(['a' * 100, 'b', 'c'], 50)
+        self.assertEquals(groups, [['a' * 100], ['b', 'c']])
+
+    def test_stable(self):
+        previous = pack_counters(self.counters, 7700)
+        removed = previous[0][0]
+        added = u'\\memory\\available bytes'
+        counters = [c for c in self.counters if c != removed] + [added]
+        groups = pack_counters(counters, 7700, previous)
+        self.assertFits(groups, 7700)
+        self.assertEquals(groups[1:], previous[1:])
+        self.assertEquals(set(groups[0]), set(previous[0]) - set([removed]) | set([added]))
+
+    def test_repack(self):
+        previous = [[c] for c in self.counters[:10]]
+        self.assertEquals(len(pack_counters(self.counters[:10], 7700, previous)), 1)
+
+
+class TestWildcardCounters(BaseTestCase):
+    def test_wildcard_counters(self):
+        counters = [
+            '\\process(svchost#1)\\% processor time',
+            '\\process(svchost)\\% processor time',
+            '\\process(svchost)\\working set',
+            '\\network interface(intel[r] pro_1000 mt (2))\\bytes total/sec',
+            '\\network interface(isatap.{a1b2})\\bytes total/sec',
+            '\\memory\\available bytes',
+            '\\logicaldisk(*)\\% free space',
+        ]
+        self.assertEquals(wildcard_counters(counters), [
+            '\\logicaldisk(*)\\% free space',
+            '\\memory\\available bytes',
+            '\\network interface(*)\\bytes total/sec',
+            '\\process(*)\\% processor time',
+            '\\process(svchost)\\working set',
+        ])
+
+    def test_routing(self):
+        counters = ['\\process(a)\\working set', '\\process(b)\\working set']
+        counter_index = CounterIndex({counter: [(counter, 'dp', None)] for counter in counters})
+        self.assertEquals(wildcard_counters(counters), ['\\process(*)\\working set'])
+        self.assertEquals(counter_index.get('\\\\host\\process(b)\\working set :').targets,
+                          (('\\process(b)\\working set', 'dp'),))
+        self.assertIsNone(counter_index.get('\\\\host\\process(c)\\working set :'))
+
+
+class TestIterReadings(BaseTestCase):
+    def test_iter_readings(self):
+        self.assertEquals(list(iter_readings([])), [])
+        self.assertEquals(list(iter_readings([BOM])), [])
+        stdout = [
+            BOM,
+            u'Readings : \\\\sqlsrv02\\memory\\available bytes :',
+            u'2736390144',
+            u'\\\\sqlsrv02\\web service(another web site)\\move requests/sec :',
+            u'0,5',
+            u'\\\\sqlsrv02\\system\\system up time :']
+        self.assertEquals(list(iter_readings(stdout)), [
+            (u'\\\\sqlsrv02\\memory\\available bytes :', u'2736390144'),
+            (u'\\\\sqlsrv02\\web service(another web site)\\move requests/sec :', u'0.5')])
+
+    def test_counter_from_path(self):
+        self.assertEquals(
+            counter_from_path(u'\\\\sqlsrv02\\web service(another web site)\\move requests/sec :'),
+            u'\\web service(another web site)\\move requests/sec')
+        self.assertRaises(IndexError, counter_from_path, u'bad path :')
+
+    def test_is_sample_start(self):
+        self.assertFalse(is_sample_start([]))
+        self.assertTrue(is_sample_start([u'Readings : \\\\sqlsrv02\\memory\\available bytes :']))
+        self.assertTrue(is_sample_start([BOM, u'Readings : \\\\sqlsrv02\\memory\\available bytes :']))
+        self.assertFalse(is_sample_start([u'\\\\sqlsrv02\\memory\\available bytes :', u'Readings : ']))
+
+
+class TestCompactReadings(BaseTestCase):
+    def setUp(self):
+        self.readings = CompactReadings()
+
+    def test_decode(self):
+        # The same sample as Readings text and in compact format.
+        text = [
+            BOM,
+            'Readings : \\\\sqlsrv02\\memory\\available bytes :',
+            '2736390144',
+            '\\\\sqlsrv02\\processor(_total)\\% processor time :',
+            '12,5',
+            '\\\\sqlsrv02\\system\\system up time :',
+            '1234,5678']
+        compact = [
+            '#0 0 \\\\sqlsrv02\\memory\\available bytes',
+            '#0 1 \\\\sqlsrv02\\processor(_total)\\% processor time',
+            '#1 0 \\\\sqlsrv02\\system\\system up time',
+            '0 1519856886 0:2736390144 1:12.5',
+            '1 1519856886 0:1234.5678']
+        expected = [(counter_from_path(path), float(value)) for path, value in iter_readings(text)]
+        decoded = [(counter_from_path(path), float(value)) for path, value in self.readings.decode(compact)]
+        self.assertEquals(decoded, expected)
+        self.assertEquals(self.readings.samples, 1)
+        self.assertEquals(self.readings.timestamp, 1519856886)
+
+    def test_decode_next_sample(self):
+        list(self.readings.decode(['#0 0 \\\\host\\memory\\available bytes', '0 1 0:1']))
+        self.assertEquals(list(self.readings.decode(['0 2 0:2 1:3'])),
+                          [('\\\\host\\memory\\available bytes', '2')])
+        self.assertEquals(self.readings.samples, 2)
+        self.readings.reset()
+        self.assertEquals(list(self.readings.decode(['0 3 0:3'])), [])
+
+
+class TestCounterIndex(BaseTestCase):
+    def setUp(self):
+        self.index = CounterIndex({
+            u'\\memory\\available bytes': [
+                ('', 'memoryAvailableBytes', ''),
+                ('', '', '/Perf/Memory')],
+            u'\\web service(site)\\move requests/sec': [
+                ('site', 'moveRequestsSec', '/Perf/Web')]})
+
+    def test_get(self):
+        path = u'\\\\sqlsrv02\\memory\\available bytes :'
+        route = self.index.get(path)
+        self.assertEquals(route.counter, u'\\memory\\available bytes')
+        self.assertEquals(route.targets, (('', 'memoryAvailableBytes'),))
+        self.assertIs(self.index.paths[path], route)
+        self.assertIsNone(self.index.get(u'\\\\sqlsrv02\\memory\\committed bytes :'))
+        self.assertIsNone(self.index.get(u'bad path :'))
+        # Misses are cached too.
+        self.assertIn(u'\\\\sqlsrv02\\memory\\committed bytes :', self.index.paths)
+        with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.counter_from_path') as parse:
+            self.assertIsNone(self.index.get(u'\\\\sqlsrv02\\memory\\committed bytes :'))
+            self.assertIsNone(self.index.get(u'bad path :'))
+            self.assertFalse(parse.called)
+
+    def test_get_bounded(self):
+        self.index.max_paths = 3
+        for instance in range(5):
+            self.index.get(u'\\\\sqlsrv02\\process(p{})\\id process :'.format(instance))
+        self.assertEquals(len(self.index.paths), 2)
+        self.assertIsNotNone(self.index.get(u'\\\\sqlsrv02\\memory\\available bytes :'))
+        self.assertEquals(len(self.index.paths), 3)
+
+    def test_missing(self):
+        self.assertEquals(self.index.missing(set(self.index.routes)), ())
+        self.assertEquals(
+            self.index.missing({u'\\memory\\available bytes'}),
+            [u'\\web service(site)\\move requests/sec'])
+
+    def test_group_by_event_class(self):
+        self.assertEquals(self.index.all_event_classes, {'/Status/Winrm', '/Perf/Memory', '/Perf/Web'})
+        self.assertEquals(
+            self.index.group_by_event_class([u'\\memory\\available bytes']),
+            {'/Status/Winrm': [u'\\memory\\available bytes'],
+             '/Perf/Memory': [u'\\memory\\available bytes']})
+
+
 class TestCounterReturned(BaseTestCase):
     def test_counter_returned(self):
         result = CommandResponse(STDOUT.split('\n'), [], 0)
@@ -120,6 +568,147 @@ class TestCounterReturned(BaseTestCase):
         self.assertFalse(counter_returned(result))
 
 
+class TestCounterEvents(BaseTestCase):
+    def plugin_simplified_init(datasource, config):
+        datasource.config = config
+        datasource.unique_id = 'test_counter_events'
+        datasource.counter_index = CounterIndex({
+            '\\a': [('c', 'a', '/Status/Winrm')],
+            '\\b': [('c', 'b', '/Status/Winrm')],
+            '\\c': [('c', 'c', '/Perf')]})
+        datasource.counter_events = {}
+        datasource.event_heartbeat = 3600
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_reportMissingCounters(self):
+        config = Mock(id='test_config_id', datasources=[
+            DataSource('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource', 'a')])
+        plugin = PerfmonDataSourcePlugin(config)
+        persister = DataPersister()
+
+        def events(returned):
+            with patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PERSISTER', persister):
+                plugin.reportMissingCounters(returned)
+            data = persister.pop(plugin.unique_id) or {'events': []}
+            return [(e['eventClass'], e['severity']) for e in data['events']]
+
+        self.assertEquals(sorted(events(set(['\\a']))), [('/Perf', 2), ('/Status/Winrm', 2)])
+        self.assertEquals(events(set(['\\a'])), [])
+        self.assertEquals(events(set(['\\a', '\\c'])), [('/Perf', 0)])
+        plugin.event_heartbeat = 0
+        self.assertEquals(len(events(set(['\\a', '\\c']))), 2)
+
+
+class TestContinuous(BaseTestCase):
+    def plugin_simplified_init(datasource, config):
+        datasource.config = config
+        datasource.sample_interval = 300
+        datasource.max_samples = 2
+        datasource.continuous = True
+        datasource.state = PluginStates.STARTED
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_samples_argument(self):
+        plugin = PerfmonDataSourcePlugin(None)
+        self.assertEquals(plugin.samples_argument(), '-Continuous')
+        plugin.continuous = False
+        self.assertEquals(plugin.samples_argument(), '-MaxSamples 2')
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_stalled(self):
+        config = Mock(datasources=[Mock(zWinRMLongRunningCommandOperationTimeout=310)])
+        plugin = PerfmonDataSourcePlugin(config)
+        plugin.checkpoint = time.time() - 600
+        self.assertFalse(plugin.stalled())
+        plugin.checkpoint = time.time() - 1000
+        self.assertTrue(plugin.stalled())
+        plugin.continuous = False
+        self.assertFalse(plugin.stalled())
+
+
+class TestRestartFailedChunks(BaseTestCase):
+    def plugin_simplified_init(datasource, config):
+        datasource.config = config
+        datasource.unique_id = 'test_chunks'
+        datasource.state = PluginStates.STARTED
+        datasource.sample_interval = 300
+        datasource.commandlines = ['line0', 'line1', 'line2']
+        datasource.receiving = [0, 1, 2]
+        datasource.chunk_failures = {}
+        datasource.restarting_chunks = set()
+        datasource.failed_chunks = set()
+        datasource.compact_readings = None
+        datasource.complex_command = Mock(commands=[sentinel.cmd0, sentinel.cmd1, sentinel.cmd2])
+        datasource.complex_command.stop_command.return_value = succeed(None)
+        datasource.complex_command.start_command.return_value = succeed(None)
+        datasource.receive = Mock()
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.deferLater', lambda *args: succeed(None))
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_restart_failed_chunks(self):
+        plugin = PerfmonDataSourcePlugin(None)
+        result = [(True, sentinel.response0),
+                  (False, Failure(RequestError('HTTP status: 500. internal error'))),
+                  (True, sentinel.response2)]
+        self.assertEquals(plugin.restart_failed_chunks(result), [result[0], result[2]])
+        plugin.complex_command.stop_command.assert_called_once_with(sentinel.cmd1)
+        plugin.complex_command.start_command.assert_called_once_with(sentinel.cmd1, 'line1')
+        self.assertEquals(plugin.chunk_failures, {1: 1})
+        self.assertEquals(plugin.restarting_chunks, set())
+        plugin.receive.assert_called_once_with()
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.LOG', Mock())
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_restart_failure(self):
+        plugin = PerfmonDataSourcePlugin(None)
+        plugin.complex_command.stop_command.return_value = fail(RequestError('HTTP status: 500. internal error'))
+        result = [(True, sentinel.response0),
+                  (False, Failure(RequestError('HTTP status: 500. internal error'))),
+                  (True, sentinel.response2)]
+        plugin.restart_failed_chunks(result)
+        # Restarted again in the next collection.
+        self.assertEquals(plugin.failed_chunks, set([1]))
+        self.assertEquals(plugin.restarting_chunks, set())
+        self.assertFalse(plugin.complex_command.start_command.called)
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_not_restarted(self):
+        plugin = PerfmonDataSourcePlugin(None)
+        timeout = [(True, sentinel.response0),
+                   (False, Failure(RequestError('HTTP status: 500. OperationTimeout'))),
+                   (True, sentinel.response2)]
+        self.assertEquals(plugin.restart_failed_chunks(timeout), timeout)
+        failed = [(False, Failure(RequestError('HTTP status: 500. internal error')))] * 3
+        self.assertEquals(plugin.restart_failed_chunks(failed), failed)
+        self.assertFalse(plugin.complex_command.stop_command.called)
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_restarting_not_restarted(self):
+        plugin = PerfmonDataSourcePlugin(None)
+        plugin.restarting_chunks.add(1)
+        result = [(True, sentinel.response0),
+                  (False, Failure(RequestError('HTTP status: 500. invalid selectors for the resource'))),
+                  (True, sentinel.response2)]
+        self.assertEquals(plugin.restart_failed_chunks(result), result)
+        self.assertFalse(plugin.complex_command.stop_command.called)
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.PerfmonDataSource.PerfmonDataSourcePlugin.__init__', plugin_simplified_init)
+    def test_restart_changed_chunks(self):
+        plugin = PerfmonDataSourcePlugin(None)
+        plugin.stop = Mock(return_value=succeed(None))
+        plugin.restart_changed_chunks(['line0', 'old1', 'line2'])
+        plugin.complex_command.stop_command.assert_called_once_with(sentinel.cmd1)
+        plugin.complex_command.start_command.assert_called_once_with(sentinel.cmd1, 'line1')
+        self.assertEquals(plugin.restarting_chunks, set())
+        self.assertFalse(plugin.stop.called)
+        plugin.receive.assert_called_once_with()
+
+        # All commands are restarted when their number changes.
+        plugin.restart_changed_chunks(['line0', 'line1'])
+        plugin.stop.assert_called_once_with()
+        self.assertEquals(plugin.complex_command.start_command.call_count, 1)
+
+
 def dummy_generateClearAuthEvents(config, events):
     pass
 
@@ -174,10 +763,23 @@ def test_suite():
     suite = TestSuite()
     suite.addTest(makeSuite(TestFormat_stdout))
     suite.addTest(makeSuite(TestFormat_counters))
+    suite.addTest(makeSuite(TestPackCounters))
+    suite.addTest(makeSuite(TestWildcardCounters))
+    suite.addTest(makeSuite(TestIterReadings))
+    suite.addTest(makeSuite(TestCompactReadings))
+    suite.addTest(makeSuite(TestCounterIndex))
+    suite.addTest(makeSuite(TestPerfmonSessionManager))
+    suite.addTest(makeSuite(TestCounterStateStore))
+    suite.addTest(makeSuite(TestCorruptCounterSearch))
+    suite.addTest(makeSuite(TestStartScheduler))
+    suite.addTest(makeSuite(TestPipelineStats))
     suite.addTest(makeSuite(TestDataPersister))
     suite.addTest(makeSuite(TestCounterReturned))
     suite.addTest(makeSuite(TestCounterReturned))
     suite.addTest(makeSuite(TestPerfmonDataSourcePlugin))
+    suite.addTest(makeSuite(TestCounterEvents))
+    suite.addTest(makeSuite(TestContinuous))
+    suite.addTest(makeSuite(TestRestartFailedChunks))
     return suite
 
 
@@ -10,8 +10,10 @@
 
 import Globals
 import time
+from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
 from txwinrm.WinRMClient import SingleCommandClient
 from twisted.python.failure import Failure
 from ..txwinrm_utils import createConnectionInfo
@@ -23,7 +25,10 @@ from ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource import (
     ShellDataSourcePlugin, DCDiagStrategy, SqlConnection,
     PowershellMSSQLAlwaysOnAGStrategy, PowershellMSSQLAlwaysOnARStrategy,
     PowershellMSSQLAlwaysOnALStrategy, PowershellMSSQLAlwaysOnADBStrategy,
-    PowershellMSSQLJobStrategy, CustomCommandStrategy
+    PowershellMSSQLJobStrategy, CustomCommandStrategy, ShellResult,
+    WindowsShellException, BATCH_MARKER, HOST_MARKER, PowerShellHost, PowerShellHostManager,
+    command_line_text, build_unified_command_line, MSSQL_MARKER,
+    PowershellMSSQLStrategy, DCDIAG_MARKER, DCDIAG_POLL_INTERVAL, dcdiag_key, SINGLE_QUOTES_RE, BUFFER_SIZE
 )
 
 from ZenPacks.zenoss.Microsoft.Windows.lib.txwinrm.shell import CommandResponse
@@ -108,30 +113,30 @@ class TestShellDataSourcePlugin(BaseTestCase):
 
     def test_clean_output(self):
         strategy = DCDiagStrategy()
-        strategy.run_tests = {'testFoo', 'testBar', 'testBaz'}
+        tests = {'testFoo', 'testBar', 'testBaz'}
 
         inp = [u'No Such Object',
                u'......................... COMP-NAME failed test',
                u'testFoo']
-        out = strategy._clean_output(inp)
+        out = strategy._clean_output(inp, tests)
         self.assertEquals(out, [inp[0], inp[1] + ' ' + inp[2]])
 
         inp2 = [u'Missing Expected Value',
                 u'......................... COMP-NAME failed test',
                 u'testBar']
-        out = strategy._clean_output(inp + inp2)
+        out = strategy._clean_output(inp + inp2, tests)
         self.assertEquals(out, [inp[0], inp[1] + ' ' + inp[2],
                                 inp2[0], inp2[1] + ' ' + inp2[2]])
 
         inp3 = [u'......................... COMP-NAME failed test testBaz']
 
-        out = strategy._clean_output(inp + inp3)
+        out = strategy._clean_output(inp + inp3, tests)
         self.assertEquals(out, [inp[0], inp[1] + ' ' + inp[2]] + inp3)
 
-        out = strategy._clean_output(inp3 + inp)
+        out = strategy._clean_output(inp3 + inp, tests)
         self.assertEquals(out, inp3 + [inp[0], inp[1] + ' ' + inp[2]])
 
-        out = strategy._clean_output(inp3)
+        out = strategy._clean_output(inp3, tests)
         self.assertEquals(out, inp3)
 
     @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource.log', Mock())
@@ -586,6 +591,365 @@ class TestCustomCommandDatasourceStrategy(BaseTestCase):
         self.check_custom_command_event_json_parser(monitoring_results.events)
 
 
+class TestCustomCommandBatch(BaseTestCase):
+
+    def setUp(self):
+        self.strategy = CustomCommandStrategy()
+
+    def result(self, stdout, stderr=(), exit_code=0):
+        result = ShellResult()
+        result.stdout = list(stdout)
+        result.stderr = list(stderr)
+        result.exit_code = exit_code
+        return result
+
+    def test_build_batch_command_line(self):
+        count, command_line, script = self.strategy.build_batch_command_line(
+            ['Write-Host "it\'s"', 'exit 2'])
+        self.assertEquals(count, 2)
+        self.assertTrue(command_line.startswith('powershell'))
+        self.assertIn("'{} 0 BEGIN'".format(BATCH_MARKER), script)
+        self.assertIn("'{} 1 BEGIN'".format(BATCH_MARKER), script)
+        self.assertIn("Create('Write-Host \\\"it''s\\\"')", script)
+
+    def test_build_batch_command_line_quoting(self):
+        for script in ('Write-Host \\"a b\\"', 'Write-Host "a  b" C:\\', "'it''s'"):
+            _, single = self.strategy.build_command_line(script, True)
+            _, _, batch = self.strategy.build_batch_command_line([script])
+            code = SINGLE_QUOTES_RE.sub(r'\1\1', command_line_text(single)[len(BUFFER_SIZE):])
+            self.assertIn("Create('{}')".format(code), command_line_text(batch))
+
+    def test_build_batch_command_line_limit(self):
+        count, _, script = self.strategy.build_batch_command_line(['x' * 3000] * 5)
+        self.assertEquals(count, 2)
+        self.assertTrue(len(script) < 8191)
+        count, _, _ = self.strategy.build_batch_command_line(['x' * 9000, 'y'])
+        self.assertEquals(count, 1)
+
+    def test_parse_batch_result(self):
+        sections = self.strategy.parse_batch_result(self.result([
+            '{} 0 BEGIN'.format(BATCH_MARKER),
+            'OK|value=1',
+            '{} 0 END 0'.format(BATCH_MARKER),
+            '{} 1 BEGIN'.format(BATCH_MARKER),
+            '{} 1 ERR Get-Item : Cannot find path'.format(BATCH_MARKER),
+            '{} 1 ERR At line:1 char:1'.format(BATCH_MARKER),
+            '{} 1 END 1'.format(BATCH_MARKER),
+            '{} 2 BEGIN'.format(BATCH_MARKER),
+            'CRITICAL|value=3'], exit_code=2))
+        self.assertEquals(len(sections), 3)
+        self.assertEquals(sections[0].stdout, ['OK|value=1'])
+        self.assertEquals(sections[0].stderr, [])
+        self.assertEquals(sections[0].exit_code, 0)
+        self.assertEquals(sections[1].stdout, [])
+        self.assertEquals(sections[1].stderr, ['Get-Item : Cannot find path', 'At line:1 char:1'])
+        self.assertEquals(sections[1].exit_code, 1)
+        # The script of the last section called exit.
+        self.assertEquals(sections[2].stdout, ['CRITICAL|value=3'])
+        self.assertEquals(sections[2].exit_code, 2)
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource.ShellDataSourcePlugin.start', time.mktime(time.localtime()))
+    def test_onSuccess_batch(self):
+        dsconfs = [Mock(datasource='ds{}'.format(i), component='comp{}'.format(i), eventClass='',
+                        params={'contexttitle': 'comp{}'.format(i)}) for i in xrange(3)]
+        config = Mock(id='device', datasources=dsconfs)
+        strategy = Mock(key='CustomCommand')
+        strategy.parse_result.side_effect = lambda config, result, dsconf: Mock(
+            events=[], values=[(Mock(id='dp'), result.stdout[0])])
+        data = ShellDataSourcePlugin().onSuccess((strategy, dsconfs, [
+            (dsconfs[0], self.result(['1'])),
+            (dsconfs[1], WindowsShellException('No parser chosen for ds1')),
+            (dsconfs[2], self.result(['3']))]), config)
+        self.assertEquals(dict(data['values']), {'comp0': {'dp': ('1', 'N')}, 'comp2': {'dp': ('3', 'N')}})
+        warnings = [e for e in data['events'] if e['eventKey'] == 'datasourceWarning_ds1']
+        self.assertEquals(len(warnings), 1)
+        self.assertEquals(warnings[0]['severity'], 3)
+        collected = [e['component'] for e in data['events'] if e.get('eventClassKey') == 'winrsCollection']
+        self.assertEquals(collected, ['comp0', 'comp2'])
+
+
+class TestPowerShellHost(BaseTestCase):
+
+    def setUp(self):
+        patcher = patch('ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource.LongCommandClient')
+        self.client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.client.start.return_value = succeed(('shell', 'command'))
+        self.client.send_request.return_value = succeed(None)
+        self.host = PowerShellHost(Mock(hostname='host', timeout=60))
+        self.addCleanup(self.host.stop)
+
+    def response(self, stdout, exit_code=None):
+        return succeed(Mock(stdout=stdout, stderr=[], exit_code=exit_code))
+
+    def test_command_line_text(self):
+        self.assertEquals(command_line_text('"& {write-host \\"a  b\\"}"'), '& {write-host "a  b"}')
+        self.assertEquals(command_line_text('get-date  -f \\\\server'), 'get-date -f \\\\server')
+
+    def test_run(self):
+        self.client.receive.side_effect = [
+            self.response(['{} 1 BEGIN'.format(HOST_MARKER), 'db01 :counter: status :value: Normal']),
+            self.response(['{} 1 END 0'.format(HOST_MARKER)]),
+            self.response(['{} 2 BEGIN'.format(HOST_MARKER), '{} 2 END 1'.format(HOST_MARKER)])]
+        results = []
+        self.host.run('"& {write-host 1}"', 60).addCallback(results.append)
+        self.host.run('"& {write-host 2}"', 60).addCallback(results.append)
+        self.assertEquals(self.client.start.call_count, 1)
+        self.assertEquals([r.stdout for r in results], [['db01 :counter: status :value: Normal'], []])
+        self.assertEquals([r.exit_code for r in results], [0, 1])
+        # BUFFER_SIZE and two requests
+        self.assertEquals(self.client.send_request.call_count, 3)
+
+    def test_run_exit(self):
+        self.client.receive.side_effect = [
+            self.response(['{} 1 BEGIN'.format(HOST_MARKER), 'CRITICAL'], exit_code=2)]
+        results = []
+        self.host.run('"& {write-host CRITICAL; exit 2}"', 60).addCallback(results.append)
+        self.assertEquals(results[0].stdout, ['CRITICAL'])
+        self.assertEquals(results[0].exit_code, 2)
+        self.assertIsNone(self.host.shell_cmd)
+        self.client.stop.assert_called_once_with(('shell', 'command'))
+
+    def test_release(self):
+        manager = PowerShellHostManager()
+        conn_info = namedtuple('ConnectionInfo', 'hostname timeout')('host', 60)
+        self.client.receive.return_value = self.response(['{} 1 END 0'.format(HOST_MARKER)])
+        manager.run(conn_info, '"& {write-host 1}"', sentinel.plugin0)
+        manager.run(conn_info._replace(timeout=180), '"& {write-host 2}"', sentinel.plugin1)
+        self.assertEquals(len(manager.hosts), 1)
+        manager.release(sentinel.plugin0)
+        self.assertEquals(len(manager.hosts), 1)
+        self.assertFalse(self.client.stop.called)
+        manager.release(sentinel.plugin1)
+        self.assertEquals(manager.hosts, {})
+        self.assertEquals(manager.users, {})
+        self.client.stop.assert_called_once_with(('shell', 'command'))
+
+
+class TestUnifiedMSSQLCollection(BaseTestCase):
+
+    def setUp(self):
+        self.sql_connection = Mock(version=11, sqlConnection=['$server = 1;'])
+        self.plugin = ShellDataSourcePlugin()
+
+    def dsconf(self, strategy, **params):
+        params.update(strategy=strategy, contexttitle=params.get('contexttitle', ''))
+        return Mock(params=params, cycletime=300, component=params['contexttitle'],
+                    cluster_node_server='node//SQL1', zWinShellKeepAlive=False)
+
+    def test_build_unified_command_line(self):
+        count, command_line, script = build_unified_command_line(
+            self.sql_connection, ["write-host 'a'", 'write-host b'])
+        self.assertEquals(count, 2)
+        self.assertTrue(command_line.startswith('powershell'))
+        self.assertEquals(script.count('$server = 1;'), 1)
+        self.assertIn("'{} 0 BEGIN'".format(MSSQL_MARKER), script)
+        self.assertIn("'{} 1 BEGIN'".format(MSSQL_MARKER), script)
+        self.assertIn("Create('write-host ''a''')", script)
+
+    def test_build_unified_command_line_limit(self):
+        count, _, _ = build_unified_command_line(self.sql_connection, ['x' * 3000] * 4, 8191)
+        self.assertEquals(count, 2)
+        count, _, _ = build_unified_command_line(self.sql_connection, ['x' * 3000] * 4)
+        self.assertEquals(count, 4)
+
+    def test_collect_unified(self):
+        job = self.dsconf('powershell MSSQL Job', contexttitle='job1')
+        ag = self.dsconf('powershell MSSQL AO AG', contexttitle='ag1')
+        config = Mock(datasources=[job, ag])
+        result = Mock(stdout=[
+            '{} 0 BEGIN'.format(MSSQL_MARKER), 'job:job1|LastRunOutcome:Succeeded',
+            '{} 0 END 0'.format(MSSQL_MARKER),
+            '{} 1 BEGIN'.format(MSSQL_MARKER), '{"ag1": {}}',
+            '{} 1 END 0'.format(MSSQL_MARKER)], stderr=[], exit_code=0)
+        self.plugin.getSQLConnection = Mock(return_value=(self.sql_connection, Mock()))
+        self.plugin.run_command = Mock(return_value=succeed(result))
+        results = []
+        self.plugin.collect_unified(config, Mock()).addCallback(results.extend)
+        self.assertEquals(self.plugin.run_command.call_count, 1)
+        self.assertEquals([(strategy.key, dsconfs) for strategy, dsconfs, _ in results],
+                          [('MSSQLJob', [job]), ('MSSQLAlwaysOnAG', [ag])])
+        self.assertEquals(results[0][2].stdout, ['job:job1|LastRunOutcome:Succeeded'])
+        self.assertEquals(results[1][2].stdout, ['{"ag1": {}}'])
+        script = self.plugin.run_command.call_args[0][3]
+        self.assertIn("@(''ag1'')", script)
+
+    def test_collect_unified_set_based(self):
+        job = self.dsconf('powershell MSSQL Job', contexttitle='job1')
+        db = self.dsconf('powershell MSSQL', contexttitle='db1', resource='Transactions/sec')
+        db.zWinMSSQLSetBasedCollection = True
+        config = Mock(datasources=[job, db])
+        self.plugin.getSQLConnection = Mock(return_value=(self.sql_connection, Mock()))
+        self.plugin.run_command = Mock(return_value=succeed(Mock(stdout=[], stderr=[], exit_code=0)))
+        self.plugin.collect_unified(config, Mock())
+        script = self.plugin.run_command.call_args[0][3]
+        # The connection may be open from the SMO section of the job strategy.
+        self.assertLess(script.index("'{} 0 BEGIN'".format(MSSQL_MARKER)), script.index('FROM sys.databases'))
+        self.assertIn('if ($sqlconn.State -ne [System.Data.ConnectionState]::Open) {$sqlconn.Open()};', script)
+        self.assertNotIn('$sqlconn.Close()', script)
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource.ShellDataSourcePlugin.start', time.mktime(time.localtime()))
+    def test_onSuccess_unified(self):
+        job = self.dsconf('powershell MSSQL Job', contexttitle='job1')
+        ag = self.dsconf('powershell MSSQL AO AG', contexttitle='ag1')
+        config = Mock(id='device', datasources=[job, ag])
+        job_strategy = Mock(key='MSSQLJob')
+        job_strategy.parse_result.return_value = Mock(events=[{'summary': 'job'}])
+        ag_strategy = Mock(key='MSSQLAlwaysOnAG')
+        ag_strategy.parse_result.side_effect = lambda config, result: {
+            'values': {'ag1': {'IsOnline': (1, 'N')}},
+            'events': [{'summary': 'ag', 'datasources': config.datasources}],
+            'maps': ['ag_om']}
+        data = self.plugin.onSuccess([
+            (job_strategy, [job], Mock()),
+            (ag_strategy, [ag], Mock())], config)
+        self.assertEquals(dict(data['values']), {'ag1': {'IsOnline': (1, 'N')}})
+        self.assertEquals(data['maps'], ['ag_om'])
+        summaries = [e['summary'] for e in data['events']]
+        self.assertIn('job', summaries)
+        self.assertIn('ag', summaries)
+        self.assertEquals([e for e in data['events'] if e['summary'] == 'ag'][0]['datasources'], [ag])
+
+
+class TestPowershellMSSQLSetBased(BaseTestCase):
+
+    def setUp(self):
+        self.strategy = PowershellMSSQLStrategy()
+
+    def dsconf(self, resource, contexttitle):
+        return Mock(params={'resource': resource, 'contexttitle': contexttitle}, device='device')
+
+    def test_build_script_body(self):
+        script = self.strategy.build_script_body(set_based=True)
+        self.assertNotIn('$server.Databases', script)
+        self.assertIn('FROM sys.databases', script)
+        self.assertIn('sys.dm_os_performance_counters', script)
+        self.assertIn("''Normal''", script)
+
+    def test_parse_result(self):
+        dsconfs = [self.dsconf('Transactions/sec', 'db1'),
+                   self.dsconf('Log Bytes Flushed/sec', 'db2'),
+                   self.dsconf('status', 'db1')]
+        result = Mock(stderr=[], exit_code=0, stdout=[
+            'S\tdb1\tNormal',
+            'S\tdb2\tOffline, AutoClosed',
+            'C\tdb1\tTransactions/sec                    \t42',
+            'C\tdb2\tLog Bytes Flushed/sec\t7',
+        ])
+        values = [(dsconf.params['resource'], value)
+                  for dsconf, value, _ in self.strategy.parse_result(dsconfs, result)]
+        self.assertEquals(values, [('Transactions/sec', 42.0), ('Log Bytes Flushed/sec', 7.0), ('status', '')])
+        self.assertEquals(self.strategy.valuemap['db1']['status'], 'Normal')
+        self.assertEquals(self.strategy.valuemap['db2']['status'], 'Offline, AutoClosed')
+
+    def test_parse_result_legacy(self):
+        result = Mock(stderr=[], exit_code=0, stdout=[
+            'db1 :counter: databasestatus :value: Normal',
+            'db1:counter:Transactions/sec:value:42'])
+        values = [value for _, value, _ in self.strategy.parse_result(
+            [self.dsconf('Transactions/sec', 'db1')], result)]
+        self.assertEquals(values, [42.0])
+        self.assertEquals(self.strategy.valuemap['db1']['status'], 'Normal')
+
+
+class TestDCDiagAsync(BaseTestCase):
+
+    def setUp(self):
+        self.strategy = DCDiagStrategy()
+        self.plugin = ShellDataSourcePlugin()
+        self.dsconf = Mock(params={'resource': 'Replications', 'script': ''}, cycletime=1800,
+                           windows_user='admin@example.com', windows_password='pass',
+                           zWinShellKeepAlive=False, zWinDCDiagAsync=True)
+        self.config = Mock(id='dc', datasources=[self.dsconf])
+        self.clock = Clock()
+        patcher = patch('ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource.reactor', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def result(self, *stdout):
+        return succeed(Mock(stdout=list(stdout), stderr=[], exit_code=0))
+
+    def status(self, state, tests=('Replications',)):
+        return '{} {} {}'.format(DCDIAG_MARKER, dcdiag_key(tests), state)
+
+    def test_build_async_command_line(self):
+        dcdiagcommand = self.strategy.build_command_line(['Replications'], [], 'admin@example.com', "p'ss")
+        command_line, script = self.strategy.build_async_command_line(dcdiagcommand, ['Replications'], True)
+        self.assertTrue(command_line.startswith('powershell'))
+        self.assertIn("Win32_Process", script)
+        self.assertIn("/p:p''ss /test:Replications", script)
+        self.assertIn('if ($true -and', script)
+        self.assertIn('zenoss_dcdiag_{}'.format(dcdiag_key(['Replications'])), script)
+        _, script = self.strategy.build_async_command_line(dcdiagcommand, ['Replications'], False)
+        self.assertIn('if ($false -and', script)
+
+    def test_parse_async_result(self):
+        states, output = self.strategy.parse_async_result(Mock(stdout=[
+            self.status('DONE'), 'Starting test: Replications',
+            self.status('STARTED')]), ['Replications'])
+        self.assertEquals(states, {'DONE', 'STARTED'})
+        self.assertEquals(output.stdout, ['Starting test: Replications'])
+        states, output = self.strategy.parse_async_result(Mock(stdout=[self.status('RUNNING')]), ['Replications'])
+        self.assertEquals(states, {'RUNNING'})
+        self.assertIsNone(output)
+        # Output of a run of other tests is ignored.
+        states, output = self.strategy.parse_async_result(Mock(stdout=[
+            self.status('DONE', ['Advertising']), 'Starting test: Advertising']), ['Replications'])
+        self.assertEquals(states, set())
+        self.assertIsNone(output)
+
+    def test_collect_dcdiag_concurrent(self):
+        """Runs of other devices sharing the strategy do not change the
+        tests of a run between polls.
+        """
+        other = ShellDataSourcePlugin()
+        other_config = Mock(id='dc2', datasources=[self.dsconf])
+        self.plugin.run_command = Mock(side_effect=[
+            self.result(self.status('STARTED')),
+            self.result(self.status('DONE'), 'Replications passed')])
+        other.run_command = Mock(side_effect=[
+            self.result(self.status('STARTED', ['Advertising'])),
+            self.result(self.status('DONE', ['Advertising']), 'Advertising passed')])
+        results, other_results = [], []
+        self.plugin.collect_dcdiag(self.strategy, self.config, Mock(), ['Replications']).addCallback(results.append)
+        other.collect_dcdiag(self.strategy, other_config, Mock(), ['Advertising']).addCallback(other_results.append)
+        self.clock.advance(DCDIAG_POLL_INTERVAL)
+        self.assertEquals(results[0].stdout, ['Replications passed'])
+        self.assertEquals(other_results[0].stdout, ['Advertising passed'])
+        self.assertIn(dcdiag_key(['Replications']), self.plugin.run_command.call_args[0][3])
+
+    def test_collect_dcdiag(self):
+        self.plugin.run_command = Mock(side_effect=[
+            self.result(self.status('STARTED')),
+            self.result(self.status('RUNNING')),
+            self.result(self.status('DONE'), 'failed test Replications')])
+        results = []
+        self.plugin.collect_dcdiag(self.strategy, self.config, Mock(), ['Replications']).addCallback(results.append)
+        self.assertEquals(self.plugin.run_command.call_count, 1)
+        self.clock.advance(DCDIAG_POLL_INTERVAL)
+        self.clock.advance(DCDIAG_POLL_INTERVAL)
+        self.assertEquals(self.plugin.run_command.call_count, 3)
+        self.assertEquals(results[0].stdout, ['failed test Replications'])
+        scripts = [c[0][3] for c in self.plugin.run_command.call_args_list]
+        self.assertIn('if ($true -and', scripts[0])
+        self.assertIn('if ($false -and', scripts[1])
+
+    def test_collect_dcdiag_failed(self):
+        self.plugin.run_command = Mock(return_value=self.result(self.status('FAILED 2')))
+        failures = []
+        self.plugin.collect_dcdiag(self.strategy, self.config, Mock(), ['Replications']).addErrback(failures.append)
+        self.assertTrue(failures[0].check(WindowsShellException))
+
+    @patch('ZenPacks.zenoss.Microsoft.Windows.datasources.ShellDataSource.ShellDataSourcePlugin.start', time.mktime(time.localtime()))
+    def test_onSuccess_pending(self):
+        self.dsconf.params.update(strategy='DCDiag', contexttitle='', counter='Replications')
+        self.dsconf.configure_mock(component=None, datasource='DCDiag', eventClass='')
+        data = self.plugin.onSuccess((self.strategy, [self.dsconf], None), self.config)
+        self.assertFalse([e for e in data['events'] if 'DCDiag' in e['summary']])
+        data = self.plugin.onSuccess((self.strategy, [self.dsconf], Mock(stdout=[], stderr=[])), self.config)
+        self.assertIn("'DCDiag /test:Replications' passed", [e['summary'] for e in data['events']])
+
+
 def test_suite():
     """Return test suite for this module."""
     from unittest import TestSuite, makeSuite
@@ -593,6 +957,11 @@ def test_suite():
     suite.addTest(makeSuite(TestShellDataSourcePlugin))
     suite.addTest(makeSuite(TestAlwaysOnDatasourceStrategies))
     suite.addTest(makeSuite(TestCustomCommandDatasourceStrategy))
+    suite.addTest(makeSuite(TestCustomCommandBatch))
+    suite.addTest(makeSuite(TestPowerShellHost))
+    suite.addTest(makeSuite(TestUnifiedMSSQLCollection))
+    suite.addTest(makeSuite(TestPowershellMSSQLSetBased))
+    suite.addTest(makeSuite(TestDCDiagAsync))
     return suite
 
 
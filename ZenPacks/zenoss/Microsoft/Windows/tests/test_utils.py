@@ -12,6 +12,8 @@ from ZenPacks.zenoss.Microsoft.Windows.tests.utils import ItemBuilder
 from Products.ZenTestCase.BaseTestCase import BaseTestCase
 
 from ZenPacks.zenoss.Microsoft.Windows.utils import get_processText, get_processNameAndArgs, get_sql_instance_original_name
+from ZenPacks.zenoss.Microsoft.Windows.utils import get_dsconf, get_dsconf_index
+from ZenPacks.zenoss.Microsoft.Windows.tests.mock import Mock
 
 
 process_wmi_data = {
@@ -96,11 +98,38 @@ class TestUtils(BaseTestCase):
         self.assertEquals(instance_original_name, None)
 
 
+class TestDsconfIndex(BaseTestCase):
+    """Test DsconfIndex."""
+
+    def setUp(self):
+        self.dsconfs = [
+            Mock(component='disk1', params={'contexttitle': 'Cluster Disk 1'}),
+            Mock(component='res1', params={'contexttitle': 'disk1'}),
+            Mock(component='disk1', params={'contexttitle': 'Cluster Disk 1 again'}),
+            Mock(component='res2', params={'contexttitle': 'Resource 2'}),
+        ]
+
+    def test_get(self):
+        """Test index returns the same dsconf as get_dsconf."""
+        index = get_dsconf_index(None, self.dsconfs, param='contexttitle')
+        for component in ('disk1', 'Cluster Disk 1', 'res2', 'Resource 2', 'missing'):
+            self.assertIs(index.get(component),
+                          get_dsconf(self.dsconfs, component, param='contexttitle'))
+
+    def test_reuse(self):
+        """Test index is rebuilt only for other dsconfs."""
+        index = get_dsconf_index(None, self.dsconfs, param='contexttitle')
+        self.assertIs(get_dsconf_index(index, list(self.dsconfs), param='contexttitle'), index)
+        self.assertIsNot(get_dsconf_index(index, self.dsconfs[:2], param='contexttitle'), index)
+        self.assertIsNot(get_dsconf_index(index, self.dsconfs, param='resource'), index)
+
+
 def test_suite():
     """Return test suite for this module."""
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestUtils))
+    suite.addTest(makeSuite(TestDsconfIndex))
     return suite
 
 
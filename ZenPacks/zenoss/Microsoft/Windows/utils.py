@@ -14,10 +14,14 @@ Basic utilities that doesn't cause any Zope stuff to be imported.
 import json
 import base64
 import logging
+import os
+import time
+import urllib
 from datetime import datetime
 import collections
 from Products.AdvancedQuery import In
 from Products.ZenEvents import ZenEventClasses
+from Products.ZenUtils.Utils import zenPath
 from Products.Zuul.interfaces import ICatalogTool
 from Products.DataCollector.plugins.DataMaps import ObjectMap
 
@@ -711,6 +715,120 @@ def get_dsconf(dsconfs, component, param=None):
     return None
 
 
+class DsconfIndex(object):
+    """Datasource configs indexed by component and a parameter.
+
+    get returns the same datasource config as get_dsconf with the same
+    dsconfs and param, without walking them on every call.
+    """
+
+    def __init__(self, dsconfs, param=None):
+        self.dsconfs = list(dsconfs)
+        self.param = param
+        self.components = {}
+        self.values = {}
+        for position, dsconf in enumerate(self.dsconfs):
+            self.components.setdefault(dsconf.component, position)
+            self.values.setdefault(dsconf.params.get(param, None), position)
+
+    def matches(self, dsconfs, param=None):
+        """Return True if the index was built for these dsconfs and param."""
+        return (
+            param == self.param and
+            len(dsconfs) == len(self.dsconfs) and
+            all(a is b for a, b in zip(dsconfs, self.dsconfs)))
+
+    def get(self, component):
+        positions = [p for p in (self.components.get(component),
+                                 self.values.get(component)) if p is not None]
+        if not positions:
+            return None
+        return self.dsconfs[min(positions)]
+
+
+def get_dsconf_index(index, dsconfs, param=None):
+    """Return index, or a new DsconfIndex if index is for other dsconfs.
+
+    Plugins keep the returned index to reuse it while their config does
+    not change.
+    """
+    if index is None or not index.matches(dsconfs, param):
+        index = DsconfIndex(dsconfs, param)
+    return index
+
+
+class DeviceStateStore(object):
+    """State of each device kept in memory and in a json file per device.
+
+    Files are written to a directory of the collector's var directory,
+    so that the state survives restarts of zenpython. Subclasses set
+    directory and description, and override parse to build the state of
+    a device from the dict loaded, empty if there is none. Changes
+    marked with touch are written at most every flush_interval seconds,
+    or by save.
+    """
+
+    directory = None
+    description = 'state'
+    flush_interval = 300
+
+    def __init__(self, path=None):
+        self._path = path
+        self.devices = {}
+        self.dirty = set()
+        self.flushed = time.time()
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = zenPath('var', 'zenpython', self.directory)
+        return self._path
+
+    def filename(self, device):
+        return os.path.join(self.path, '{}.json'.format(urllib.quote(device, safe='')))
+
+    def parse(self, saved):
+        return saved
+
+    def load(self, device):
+        """Return the state of device, read from its file the first time."""
+        if device not in self.devices:
+            try:
+                with open(self.filename(device)) as state_file:
+                    saved = json.load(state_file)
+            except (IOError, OSError, ValueError):
+                saved = None
+            self.devices[device] = self.parse(saved if isinstance(saved, dict) else {})
+        return self.devices[device]
+
+    def touch(self, device):
+        """Mark the state of device changed, writing changes if due."""
+        self.dirty.add(device)
+        if time.time() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the state of all changed devices."""
+        self.flushed = time.time()
+        for device in list(self.dirty):
+            self.save(device)
+
+    def save(self, device):
+        """Write the state of device to its file."""
+        self.dirty.discard(device)
+        if device not in self.devices:
+            return
+        filename = self.filename(device)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(filename + '.tmp', 'w') as state_file:
+                json.dump(self.devices[device], state_file)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            log.debug('Unable to save %s for %s: %s', self.description, device, e)
+
+
 def has_metricfacade():
     '''return True if metricfacade can be imported'''
     try: